@@ -0,0 +1,4 @@
+from trauma_model_framework.async_server import AsyncVisualizationServer
+
+server = AsyncVisualizationServer(model_kwargs={'initial_population': 100}, fps=10)
+server.launch(open_browser=True)
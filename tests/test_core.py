@@ -0,0 +1,19 @@
+import pytest
+
+from trauma_model_framework import core, mesa_check
+from trauma_model_framework.core import MultiGrid
+
+mesa = pytest.importorskip('mesa')
+
+
+def test_copied_classes_match_mesa():
+    assert mesa.__version__ == core.MESA_VERSION
+    assert mesa_check.api_differences() == []
+    assert mesa_check.check_run(steps=100, seed=1) is None
+
+
+def test_cached_neighborhoods_cannot_be_changed():
+    grid = MultiGrid(10, 10, torus=False)
+    neighborhood = grid.get_neighborhood((3, 3), moore=True, radius=2)
+    assert isinstance(neighborhood, tuple)
+    assert grid.get_neighborhood((3, 3), moore=True, radius=2) == neighborhood
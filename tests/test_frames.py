@@ -0,0 +1,28 @@
+import numpy as np
+
+from trauma_model_framework import frames
+from trauma_model_framework.model import SugarscapeTMF
+
+
+def test_replay_frames_decode_to_snapshots():
+    m = SugarscapeTMF(seed=1)
+    encoder = frames.FrameEncoder(keyframe_interval=20)
+    state = None
+    for _ in range(50):
+        m.step()
+        _, frame = encoder.encode(m)
+        state = frames.decode_frame(frame, state)
+        for key in ('raster', 'ids', 'x', 'y', 'trauma'):
+            assert np.array_equal(state[key], encoder.prev[key])
+
+
+def test_trauma_changes_within_a_bucket_are_not_sent():
+    m = SugarscapeTMF(seed=1)
+    m.step()
+    agent = next(iter(m.schedule.agents_by_type[frames.SsAgent].values()))
+    agent.trauma = 0.5
+    prev = frames.snapshot(m)
+    agent.trauma = 0.51
+    assert frames.delta_from_states(prev, frames.snapshot(m)) == frames.delta_from_states(prev, prev)
+    agent.trauma = 0.9
+    assert frames.delta_from_states(prev, frames.snapshot(m)) != frames.delta_from_states(prev, prev)
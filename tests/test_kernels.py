@@ -0,0 +1,17 @@
+import pytest
+
+from trauma_model_framework import kernels
+from trauma_model_framework.model import SugarscapeTMF
+
+
+def test_engines_equivalent():
+    # the kernel (compiled, or uncompiled without numba) follows the same
+    # trajectory as SsAgent.step
+    assert kernels.check_equivalence(steps=100, seed=1) is None
+
+
+def test_numba_engine_falls_back_without_numba(monkeypatch):
+    monkeypatch.setattr(kernels, 'NUMBA_AVAILABLE', False)
+    with pytest.warns(UserWarning, match='numba is not installed'):
+        m = SugarscapeTMF(seed=1, engine='numba')
+    assert m.engine == 'python'
@@ -0,0 +1,40 @@
+import os
+import time
+
+from trauma_model_framework import sweep
+
+
+def _expire(queue, lease):
+    then = queue._now() - 2 * queue.lease
+    os.utime(lease, (then, then))
+
+
+def test_expired_lease_goes_to_the_next_claimer(tmp_path):
+    queue = sweep.WorkQueue(str(tmp_path), lease=60)
+    assert queue.submit(sweep.make_specs(seeds=2)) == 2
+    job_a, lease_a, _ = queue.claim('a')
+    job_b, lease_b, _ = queue.claim('b')
+    assert job_a != job_b
+    assert queue.claim('b') is None
+    assert queue.recover_stale() == 0
+
+    _expire(queue, lease_a)
+    assert queue.recover_stale() == 1
+    assert not os.path.exists(lease_a)
+    job, lease, _ = queue.claim('b')
+    assert job == job_a
+    assert sorted(worker for _, worker, _ in queue.leases()) == ['b', 'b']
+
+    # the worker that lost the lease still finishes; its release is harmless
+    queue.complete(job_a, lease_a, {}, {})
+    assert os.path.exists(lease)
+    assert queue.counts()['results'] == 1
+
+
+def test_lease_age_ignores_the_local_clock(tmp_path, monkeypatch):
+    queue = sweep.WorkQueue(str(tmp_path), lease=60)
+    queue.submit(sweep.make_specs(seeds=1))
+    queue.claim('a')
+    # a worker whose clock is an hour ahead of the file server
+    monkeypatch.setattr(time, 'time', lambda: os.path.getmtime(tmp_path) + 3600)
+    assert queue.recover_stale() == 0
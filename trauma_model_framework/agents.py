@@ -2,9 +2,40 @@ import math
 import numpy as np
 # import random
 
-import mesa
 # import copy
 
+from . import events, lineage
+from .core import Agent
+
+# constants of the trauma rules of SsAgent. SugarscapeTMF(trauma_params=...)
+# overrides any of them for a run (e.g. for sensitivity.py); the agents read
+# them from model.trauma_params
+TRAUMA_PARAMS = {
+    # cortisol level of the initial population
+    'initial_cortisol': 0.05,
+    # offspring cortisol: parent cortisol * (1 - trauma_lifemax) if the
+    # parent's trauma_lifemax reached the threshold, else parent cortisol
+    # + increment, capped at max
+    'offspring_cortisol_threshold': 0.5,
+    'offspring_cortisol_increment': 0.01,
+    'offspring_cortisol_max': 0.1,
+    # trauma added each step an agent is starving
+    'starvation_trauma': 0.05,
+    # probabilities (times the agent's trauma level) of cannibalizing,
+    # killing and mugging in trauma influenced behavior
+    'cannibalize_prob': 0.1,
+    'kill_prob': 0.5,
+    'mug_prob': 1.0,
+    # trauma added by cannibalizing another agent
+    'cannibalize_trauma': 0.05,
+    # epigenetic lifespan change passed on to descendants per step of
+    # prenatal or prepubescent starvation, and their caps
+    'prenatal_lifespan_step': 0.04,
+    'prepubecent_lifespan_step': 0.01,
+    'prenatal_lifespan_cap': 0.2,
+    'prepubecent_lifespan_cap': 0.2,
+}
+
 
 def get_distance(pos_1, pos_2):
     """Get the distance between two point
@@ -19,33 +50,61 @@ def get_distance(pos_1, pos_2):
     return math.sqrt(dx**2 + dy**2)
 
 
-class SsAgent(mesa.Agent):
+class SsAgent(Agent):
+    # attributes that are the same for every agent are kept on the class
+    trauma_capacity = 1
+    pregnancy_time = 5
+    puberty_age = 20
+    # trauma symptoms - unused in model framework
+    # these are here as examples
+    obesity = 0
+    cardio_disease = 0
+
+    # per-agent state is slotted to keep agent construction and memory cheap
+    # (unique_id, model and pos are slots of Agent)
+    __slots__ = (
+        'moore', 'sugar', 'max_sugar_hold', 'metabolism', 'vision', 'age', 'starvation',
+        'sex', 'next_birth_sex', 'generation', 'family', 'death', 'epigenetic_symptoms',
+        'trauma', 'trauma_min', 'trauma_lifemax', 'cortisol', 'pregnant', 'pregnancy_countdown',
+        'future_epigenetic_symptoms', 'epigenetic_lifespan_decrease_prenatal',
+        'epigenetic_lifespan_increase_prepubecent', 'lineage_row',
+    )
+
     def __init__(
         self, unique_id, model, moore=False, sugar=0, trauma=0, trauma_min=0, cortisol=0.05,
-        generation=-1, family=-1, sex=None, epigenetic_symptoms=[],
+        generation=-1, family=-1, sex=None, epigenetic_symptoms=None,
+        pos=None, max_sugar_hold=None, metabolism=None, vision=None, death=None,
     ):
         super().__init__(unique_id, model)
         
+        # pos, sex, max_sugar_hold, metabolism, vision and death are drawn here
+        # one at a time unless they are given, which is how
+        # SugarscapeTMF.spawn_agents passes in attributes drawn in bulk
         self.moore = moore
-        x = self.random.randrange(self.model.width)
-        y = self.random.randrange(self.model.height)
-        self.pos = (x,y)
+        if pos is None:
+            x = self.random.randrange(self.model.width)
+            y = self.random.randrange(self.model.height)
+            pos = (x,y)
+        self.pos = pos
         if sugar == -1:
             sugar = self.random.randrange(6, 25)
         self.sugar = sugar
-        self.max_sugar_hold = self.random.randint(20,60)
+        if max_sugar_hold is None:
+            max_sugar_hold = self.random.randint(20,60)
+        self.max_sugar_hold = max_sugar_hold
 
-        metabolism = self.random.randrange(2, 4)
+        if metabolism is None:
+            metabolism = self.random.randrange(2, 4)
         self.metabolism = metabolism
-        vision = self.random.randrange(1, 6)
+        if vision is None:
+            vision = self.random.randrange(1, 6)
         self.vision = vision
         
         self.age = 0
         self.starvation = 0
         if sex is None:
-            self.sex = self.random.choice(['m','f'])
-        else:
-            self.sex = sex
+            sex = self.random.choice(['m','f'])
+        self.sex = sex
         self.next_birth_sex = None
         self.generation = generation + 1
         # if no family is specified, start a new family line identifier
@@ -53,43 +112,38 @@ class SsAgent(mesa.Agent):
             self.family = unique_id
         else:
             self.family = family
-        self.death = self.random.randint(90,110)
-        self.starvaton = 0
+        if death is None:
+            death = self.random.randint(90,110)
+        self.death = death
         
         # epigenetic_symptoms shoud be a
         # list of lists like [trigger_dict, [function,arg1,arg2,...]] with triggers and triggered function
-        try:
-            if len(epigenetic_symptoms) > 0:
-                self.epigenetic_symptoms = [xx for xx in epigenetic_symptoms if xx[0]['generation'] >= generation]
-            else:
-                self.epigenetic_symptoms = epigenetic_symptoms
-        except:
-            raise Exception('All epigenetic symptoms must have a generation designation')
+        if epigenetic_symptoms:
+            if not all('generation' in xx[0] for xx in epigenetic_symptoms):
+                raise Exception('All epigenetic symptoms must have a generation designation')
+            self.epigenetic_symptoms = [xx for xx in epigenetic_symptoms if xx[0]['generation'] >= generation]
+        else:
+            self.epigenetic_symptoms = []
         # self.epigenetic_symptoms_init = copy.deepcopy(self.epigenetic_symptoms)
         
         # set born trauma level as half of their parent
         self.trauma = trauma * 0.5
         self.trauma_min = trauma_min
-        self.trauma_capacity = 1
         self.trauma_lifemax = 0
         self.cortisol = cortisol
         
         # reproduction
         self.pregnant = False
-        self.pregnancy_time = 5
         self.pregnancy_countdown = self.pregnancy_time
-        self.puberty_age = 20
-        
-        # trauma symptoms - unused in model framework
-        # these are here as examples
-        self.obesity = 0
-        self.cardio_disease = 0
         
         # epigenetic
         self.future_epigenetic_symptoms = dict()
         self.epigenetic_lifespan_decrease_prenatal = 0
         self.epigenetic_lifespan_increase_prepubecent = 0
         
+        # row of this agent in the model's lineage table (set when added to the model)
+        self.lineage_row = -1
+        
     
     def reset_family(self):
         '''
@@ -104,6 +158,25 @@ class SsAgent(mesa.Agent):
         '''
         self.family = self.unique_id
     
+    def die(self, cause):
+        '''
+        Removes this agent from the canvas and the schedule and records
+        the death in the model's lineage table.
+
+        Parameters
+        ----------
+        cause : int
+            cause of death code from the lineage module
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.model.lineage.record_death(self.lineage_row, self.model.schedule.steps, cause, self.trauma)
+        self.model.grid.remove_agent(self)
+        self.model.schedule.remove(self)
+
     def is_cannibalized(self):
         '''
         This function is called by an external agent trying to cannibalize
@@ -117,8 +190,7 @@ class SsAgent(mesa.Agent):
             This agent's sugar + a constant (energy of consuming this agent)
 
         '''
-        self.model.grid.remove_agent(self)
-        self.model.schedule.remove(self)
+        self.die(lineage.CANNIBALIZED)
         return self.sugar + 5
     
     def is_killed(self):
@@ -132,8 +204,7 @@ class SsAgent(mesa.Agent):
             The amount of sugar this agent is holding at the time of being killed
 
         '''
-        self.model.grid.remove_agent(self)
-        self.model.schedule.remove(self)
+        self.die(lineage.KILLED)
         return self.sugar
     
     def is_mugged(self):
@@ -174,10 +245,8 @@ class SsAgent(mesa.Agent):
             returns the sugar tile (which is instantiated as a stationary agent by MESA)
 
         '''
-        this_cell = self.model.grid.get_cell_list_contents([pos])
-        for agent in this_cell:
-            if type(agent) is Sugar:
-                return agent
+        # sugar agents are kept in [x * height + y] order by the model
+        return self.model.sugar_cells[pos[0] * self.model.height + pos[1]]
 
     def is_occupied(self, pos):
         '''
@@ -219,19 +288,24 @@ class SsAgent(mesa.Agent):
         neighborhood = self.model.grid.get_neighborhood(
             self.pos, self.moore, False, radius=self.vision
         )
-        # get all non-sugar agents within agent vision
-        agent_neighbors = [i for i in neighborhood if self.is_occupied(i)]
-        
-        # get all sugar agents within agent vision (sugar tiles)
-        neighbors = [
-            i
-            for i in neighborhood
-            if not self.is_occupied(i)
-        ]
+        # split the cells within vision into cells with other non-sugar agents
+        # and free cells in one pass; every cell holds exactly one sugar agent,
+        # so a cell is occupied if it holds anything else
+        grid = self.model.grid
+        agent_neighbors = []
+        neighbors = []
+        for pos in neighborhood:
+            if len(grid[pos[0]][pos[1]]) > 1:
+                agent_neighbors.append(pos)
+            else:
+                neighbors.append(pos)
         
         neighbors.append(self.pos)
         # Look for location with the most sugar
-        max_sugar = max(self.get_sugar(pos).amount for pos in neighbors)
+        sugar_cells = self.model.sugar_cells
+        height = self.model.height
+        amounts = [sugar_cells[x * height + y].amount for x, y in neighbors]
+        max_sugar = max(amounts)
         
         # enable trauma influenced behavior
         trauma_influenced_behavior = True
@@ -257,13 +331,18 @@ class SsAgent(mesa.Agent):
             # trauma influenced behavior #
             # the starvation level and trauma level affects what the agent is 
             # capable of doing to other agents
-            if self.starvation > 15 and self.random.random() < self.trauma * .1:
+            step = self.model.schedule.steps
+            params = self.model.trauma_params
+            if self.starvation > 15 and self.random.random() < self.trauma * params['cannibalize_prob']:
+                self.model.events.record(step, events.CANNIBALIZE, self.unique_id, agent.unique_id, pos, self.trauma)
                 self.sugar += agent.is_cannibalized()
                 # this agent becomes more traumatized by cannibalizing another
-                self.trauma += .05
-            elif self.starvation > 5 and self.random.random() < self.trauma * .5:
+                self.trauma += params['cannibalize_trauma']
+            elif self.starvation > 5 and self.random.random() < self.trauma * params['kill_prob']:
+                self.model.events.record(step, events.KILL, self.unique_id, agent.unique_id, pos, self.trauma)
                 self.sugar += agent.is_killed()
-            elif self.starvation <= 5 and self.random.random() < self.trauma * 1.0:
+            elif self.starvation <= 5 and self.random.random() < self.trauma * params['mug_prob']:
+                self.model.events.record(step, events.MUG, self.unique_id, agent.unique_id, pos, self.trauma)
                 self.sugar += agent.is_mugged()
             
             self.model.grid.move_agent(self,pos)
@@ -279,7 +358,7 @@ class SsAgent(mesa.Agent):
         
             # Look for location with the most sugar
             candidates = [
-                pos for pos in neighbors if self.get_sugar(pos).amount == max_sugar
+                pos for pos, amount in zip(neighbors, amounts) if amount == max_sugar
             ]
             # Narrow down to the nearest ones
             min_dist = min(get_distance(self.pos, pos) for pos in candidates)
@@ -366,6 +445,8 @@ class SsAgent(mesa.Agent):
         # then make agent pregnant
         if self.random.random() < pr and self.age > self.puberty_age and self.pregnant == False:
             self.pregnant = True
+            self.model.events.record(self.model.schedule.steps, events.PREGNANCY,
+                                     self.unique_id, -1, self.pos, self.trauma)
         
         # give birth
         if self.pregnancy_countdown == 0:
@@ -376,17 +457,19 @@ class SsAgent(mesa.Agent):
             # reset pregnancy countdown
             self.pregnancy_countdown = self.pregnancy_time
             self.pregnant = False
+            params = self.model.trauma_params
             
             # reduce cortisol levels of the offspring of parents that have been
             # extremely traumatized. Often seen in literature about epigenetics
             # and families of Holocaust survivors.
-            if self.trauma_lifemax >= 0.5:
+            if self.trauma_lifemax >= params['offspring_cortisol_threshold']:
                 # cortisol_offspring = self.cortisol/2
                 cortisol_offspring = self.cortisol * (1-self.trauma_lifemax)
             # if no extreme trauma experienced by an agent, then increase the 
             # cortisol level slightly for offspring
             else:
-                cortisol_offspring = min(self.cortisol+0.01,0.1)
+                cortisol_offspring = min(self.cortisol+params['offspring_cortisol_increment'],
+                                         params['offspring_cortisol_max'])
             
             # min possible trauma of offspring is equal to half of the 
             # max trauma experienced by this agent over the course of it's life.
@@ -399,23 +482,26 @@ class SsAgent(mesa.Agent):
             # enable epigenetic effects
             epigenetic_effects = True
             
+            # the child is placed at this agent's pos, so only the remaining
+            # random attributes are drawn (in bulk) by the model
             if epigenetic_effects:
-                ssa = SsAgent(self.model.agent_id, self.model, False, 
-                               sugar = int(self.sugar*.5), trauma = self.trauma,
-                                trauma_min = tm_offspring, cortisol = cortisol_offspring,
-                              generation = self.generation, family = self.family,
-                              sex = self.next_birth_sex,
-                                epigenetic_symptoms = eg_for_birth
-                              )
+                ssa, = self.model.spawn_agents(
+                    1, pos=self.pos, parent=self,
+                    sugar = int(self.sugar*.5), trauma = self.trauma,
+                    trauma_min = tm_offspring, cortisol = cortisol_offspring,
+                    generation = self.generation, family = self.family,
+                    sex = self.next_birth_sex,
+                    epigenetic_symptoms = eg_for_birth
+                )
                 self.next_birth_sex = None
             else:
-                ssa = SsAgent(self.model.agent_id, self.model, False, 
-                               sugar = int(self.sugar*.5), trauma = self.trauma,
-                              generation = self.generation, family = self.family,
-                              )
-            self.model.agent_id += 1
-            self.model.grid.place_agent(ssa, (self.pos[0], self.pos[1]))
-            self.model.schedule.add(ssa)
+                ssa, = self.model.spawn_agents(
+                    1, pos=self.pos, parent=self,
+                    sugar = int(self.sugar*.5), trauma = self.trauma,
+                    generation = self.generation, family = self.family,
+                )
+            self.model.events.record(self.model.schedule.steps, events.BIRTH,
+                                     self.unique_id, ssa.unique_id, self.pos, self.trauma)
         # continue tracking pregnancy timeline
         if self.pregnant:
             self.pregnancy_countdown -= 1
@@ -433,13 +519,13 @@ class SsAgent(mesa.Agent):
         '''
         # if agent is starving, add trauma
         if self.starvation > 0:
-            self.trauma = max(self.trauma + 0.05, 1)
+            self.trauma = max(self.trauma + self.model.trauma_params['starvation_trauma'], 1)
             # pre-pubecent traumas have transgenerational epigenetic effects
             if self.age <= self.puberty_age:
-                self.prepubecent_trauma_create(.01)
+                self.prepubecent_trauma_create(self.model.trauma_params['prepubecent_lifespan_step'])
             # pre-natal traumas have transgenerational epigenetic effects
             if self.pregnant:
-                self.prenatal_trauma_create(.04)
+                self.prenatal_trauma_create(self.model.trauma_params['prenatal_lifespan_step'])
         # trauma decay when not starving
         else:
             self.trauma *= 1 - self.cortisol
@@ -462,14 +548,13 @@ class SsAgent(mesa.Agent):
         None.
 
         '''
-        self_vars = vars(self)
         for epigenetic_expression in self.epigenetic_symptoms:
             triggers, expression = epigenetic_expression
             trigger_expression = 1
             
             for trigger_attr, trigger_val in triggers.items():
                 trigger = 0
-                if trigger_val == self_vars[trigger_attr]:
+                if trigger_val == getattr(self, trigger_attr):
                     trigger = 1
                 trigger_expression = trigger_expression and trigger
                 
@@ -495,9 +580,14 @@ class SsAgent(mesa.Agent):
         self.reproduce()
         self.traumatize()
         self.age += 1
-        if self.starvation > 20 or self.age > self.death:
-            self.model.grid.remove_agent(self)
-            self.model.schedule.remove(self)
+        if self.starvation > 20:
+            self.model.events.record(self.model.schedule.steps, events.STARVATION_DEATH,
+                                     self.unique_id, -1, self.pos, self.trauma)
+            self.die(lineage.STARVATION)
+        elif self.age > self.death:
+            self.model.events.record(self.model.schedule.steps, events.OLD_AGE_DEATH,
+                                     self.unique_id, -1, self.pos, self.trauma)
+            self.die(lineage.OLD_AGE)
     
     # sub functions #
     def get_epigenetics_for_birth(self):
@@ -546,7 +636,8 @@ class SsAgent(mesa.Agent):
 
         '''
         self.epigenetic_lifespan_decrease_prenatal += eld
-        self.epigenetic_lifespan_decrease_prenatal = min(self.epigenetic_lifespan_decrease_prenatal,0.2)
+        self.epigenetic_lifespan_decrease_prenatal = min(self.epigenetic_lifespan_decrease_prenatal,
+                                                         self.model.trauma_params['prenatal_lifespan_cap'])
         # trigger is (gen + 3) b/c it is 2 generations after the agent currently about to be birthed (prenatal)
         # also 'sex' of the next child is chosen now, since the epigenetic effects are based on that
         self.next_birth_sex = self.random.choice(['m','f'])
@@ -574,7 +665,8 @@ class SsAgent(mesa.Agent):
 
         '''
         self.epigenetic_lifespan_increase_prepubecent += eli
-        self.epigenetic_lifespan_increase_prepubecent = min(self.epigenetic_lifespan_increase_prepubecent,0.2)
+        self.epigenetic_lifespan_increase_prepubecent = min(self.epigenetic_lifespan_increase_prepubecent,
+                                                            self.model.trauma_params['prepubecent_lifespan_cap'])
         triggers = {'generation':self.generation+2,'age':0}
         expression = ['prepubescent_trauma_express',self.epigenetic_lifespan_increase_prepubecent]
         self.future_epigenetic_symptoms['prepubecent1'] = [triggers,expression]
@@ -627,70 +719,22 @@ class SsAgent(mesa.Agent):
         
         return None
 
-class Sugar(mesa.Agent):
+class Sugar(Agent):
     def __init__(self, unique_id, pos, model, max_sugar):
         super().__init__(unique_id, model)
         self.amount = max_sugar
         self.max_sugar = max_sugar
-        # self.step_num = 0
-        self.famine = -1e6
-        # conway rule counter
-        self.con_counter = 0
-        self.avg_baseline_trauma = 0
-        self.avg_trauma = -1
-        self.end_sim = False # flag for parent model object to end simulation
-                            # it isn't used in this framework, but it would allow
-                            # triggering an end to the sim at the agent level
+        # probability of growing back one unit of sugar each step;
+        # famines and other scenario events change it (see scenario.py)
+        self.base_growback = 1
+        self.growback = 1
 
     def step(self):
         # step for sugar cell/tile/agent #
         
-        self.step_num = self.model.schedule.steps
-        
-        
-        # other example models of simulating famine
-        # growth = 3**(-self.step_num/500) + 0.05
-        # cyclic_growth = 0.45 * np.cos( (self.step_num) * (2*np.pi/100) ) + 0.5
-
-        constant = 1        
-        growback = constant
-        
-        # conway rule
-        steady_state = False
-        # number of oldest steps truncated for the conway rule set
-        nsteps = 200 
-        # number of consecutive steps within the value set of the last nsteps
-        # necessary for the conway rule to trigger
-        num_conway_steps = 100
-        # start famine
-        if self.step_num > nsteps and self.step_num > 500 and self.famine < 0:
-            last_nsteps = self.model.datacollector.model_vars['Trauma'][-(nsteps+1):]
-            truncated_conway_steps = last_nsteps[:-1]
-            last_step = last_nsteps[-1]
-            if (last_step >= min(truncated_conway_steps)) and \
-                (last_step <= max(truncated_conway_steps)):
-                self.con_counter += 1
-            else:
-                self.con_counter = 0
-            
-            if self.con_counter > num_conway_steps:
-                self.con_counter = 0
-                steady_state = True
-                self.famine = self.step_num
-                # recording to have a variable that has the last trauma
-                # value before the trauma event starts
-                self.avg_baseline_trauma = np.average(last_nsteps)
-        
-        # For this famine model, sugar is wiped from the board
-        # and the growth rate is set to 10% of the initial growth rate
-        if self.step_num == self.famine:
-            if self.random.random() < 0.9:
-                self.amount = 0
-        if self.famine <= self.step_num < self.famine+100:
-            growback = 0.1 * constant
-
-        
-        if self.random.random() < growback:
+        # other example models of simulating famine can be declared as
+        # scenario events, e.g. a GrowbackChange every few steps for
+        # cyclic growth = 0.45 * np.cos( (step) * (2*np.pi/100) ) + 0.5
+        
+        if self.random.random() < self.growback:
             self.amount = min([self.max_sugar, self.amount + 1])
-        # else:
-        #     self.amount = min([self.max_sugar, self.amount])
\ No newline at end of file
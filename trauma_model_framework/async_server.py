@@ -0,0 +1,293 @@
+"""
+Asynchronous visualization server
+================================
+
+Unlike the mesa ModularServer in server.py (where the browser asks for every
+step and each frame is rendered as one JSON portrayal per cell), the model
+here runs in a background thread at full speed and the browser is sent the
+latest state as compact binary frames (see frames.py) at a capped frame rate:
+a keyframe when it connects and delta frames after that. Steps that happen
+between two frames are simply not drawn.
+
+The same page can also play back a replay file recorded with
+SugarscapeTMF(replay=...) instead of running the model.
+"""
+
+import json
+import os
+import threading
+import time
+import webbrowser
+
+import tornado.ioloop
+import tornado.web
+import tornado.websocket
+
+from .frames import PALETTE, ReplayReader, delta_from_states, keyframe_from_state, snapshot
+from .model import SugarscapeTMF
+
+RESOURCES = os.path.join(os.path.dirname(__file__), 'resources')
+
+
+class ModelRunner(threading.Thread):
+    '''
+    Background thread that steps the model as fast as it can (or at most
+    max_steps_per_second) until the run ends, is paused, or max_steps is
+    reached. The lock is held for each step, so frames are always taken
+    between steps.
+    '''
+
+    def __init__(self, model_cls, model_kwargs=None, max_steps=2500, max_steps_per_second=None):
+        super().__init__(daemon=True)
+        self.model_cls = model_cls
+        self.model_kwargs = model_kwargs or {}
+        self.max_steps = max_steps
+        self.max_steps_per_second = max_steps_per_second
+        self.lock = threading.Lock()
+        self.paused = False
+        self._stopped = threading.Event()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.model = self.model_cls(**self.model_kwargs)
+            self.model.set_markers(self.max_steps)
+
+    @property
+    def finished(self):
+        m = self.model
+        return m.end or m.schedule.steps >= self.max_steps
+
+    def run(self):
+        while not self._stopped.is_set():
+            if self.paused or self.finished:
+                time.sleep(0.05)
+                continue
+            t = time.perf_counter()
+            with self.lock:
+                self.model.step()
+            if self.max_steps_per_second:
+                time.sleep(max(0.0, 1 / self.max_steps_per_second - (time.perf_counter() - t)))
+
+    def stop(self):
+        self._stopped.set()
+
+    def snapshot(self, max_raster=256):
+        '''
+        Frame state of the model between two steps (see frames.snapshot).
+        '''
+        with self.lock:
+            return snapshot(self.model, max_raster)
+
+
+class ReplayRunner(threading.Thread):
+    '''
+    Plays a replay file at steps_per_second, with the same interface as
+    ModelRunner so the server does not need to know which one it is using.
+    '''
+
+    def __init__(self, path, steps_per_second=30):
+        super().__init__(daemon=True)
+        self.path = path
+        self.steps_per_second = steps_per_second
+        self.lock = threading.Lock()
+        self.paused = False
+        self._stopped = threading.Event()
+        self.reader = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # close the file of the previous playthrough
+            if self.reader is not None:
+                self.reader.close()
+            self.reader = ReplayReader(self.path)
+            self._states = iter(self.reader)
+            self.state = next(self._states)
+            self.finished = False
+
+    def run(self):
+        while not self._stopped.is_set():
+            time.sleep(1 / self.steps_per_second)
+            if self.paused or self.finished:
+                continue
+            with self.lock:
+                state = next(self._states, None)
+                if state is None:
+                    self.finished = True
+                else:
+                    self.state = state
+
+    def stop(self):
+        self._stopped.set()
+
+    def snapshot(self, max_raster=256):
+        with self.lock:
+            return self.state
+
+
+class PageHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.render('async_viz.html', title=self.application.title)
+
+
+class FrameSocketHandler(tornado.websocket.WebSocketHandler):
+    '''
+    Sends binary frames to the browser and receives JSON control messages:
+    {"type": "pause"}, {"type": "resume"}, {"type": "reset"} and
+    {"type": "fps", "value": frames per second}.
+    '''
+
+    def open(self):
+        self.pending = None
+        self.last_step = -1
+        # a keyframe is needed first, and again after any frame this client missed
+        self.needs_keyframe = True
+        self.application.clients.add(self)
+        self.write_message(json.dumps({
+            'type': 'init',
+            'palette': PALETTE,
+            'fps': self.application.fps,
+        }))
+
+    def on_close(self):
+        self.application.clients.discard(self)
+
+    def check_origin(self, origin):
+        return True
+
+    def on_message(self, message):
+        msg = json.loads(message)
+        app = self.application
+        if msg['type'] == 'pause':
+            app.runner.paused = True
+        elif msg['type'] == 'resume':
+            app.runner.paused = False
+        elif msg['type'] == 'reset':
+            app.runner.reset()
+            app.last_state = None
+            for client in app.clients:
+                client.last_step = -1
+                client.needs_keyframe = True
+        elif msg['type'] == 'fps':
+            app.set_fps(msg['value'])
+
+    def send_frame(self, step, delta, keyframe):
+        '''
+        Send the delta frame, or a keyframe (a callable that encodes it on
+        demand) if this client missed the frame the delta is based on.
+        '''
+        if step == self.last_step:
+            return
+        # skip this client if it has not finished receiving the last frame,
+        # so a slow browser gets fewer frames instead of a growing backlog
+        if self.pending is not None and not self.pending.done():
+            self.needs_keyframe = True
+            return
+        if self.needs_keyframe or delta is None:
+            frame = keyframe()
+            self.needs_keyframe = False
+        else:
+            frame = delta
+        self.last_step = step
+        try:
+            self.pending = self.write_message(frame, binary=True)
+        except tornado.websocket.WebSocketClosedError:
+            self.application.clients.discard(self)
+
+
+class AsyncVisualizationServer(tornado.web.Application):
+    '''
+    Visualization server where the model runs in a background ModelRunner
+    (or a replay file is played by a ReplayRunner) and frames are pushed to
+    every connected browser at most fps times a second.
+
+    Parameters
+    ----------
+    model_cls : class
+        model class to run (SugarscapeTMF by default)
+    model_kwargs : dict, optional
+        keyword arguments for the model
+    fps : float
+        frame rate cap
+    max_steps : int
+        number of steps to run (same as run_model's step_count)
+    max_steps_per_second : float, optional
+        cap on the simulation speed (None for full speed)
+    max_raster : int
+        largest landscape raster side sent to the browser; larger canvases
+        are downsampled
+    port : int
+        port the webserver listens to
+    replay : str, optional
+        path of a replay file to play instead of running the model
+    replay_steps_per_second : float
+        playback speed of the replay
+    '''
+
+    def __init__(self, model_cls=SugarscapeTMF, model_kwargs=None, fps=10, max_steps=2500,
+                 max_steps_per_second=None, max_raster=256, port=None,
+                 title='Basic Trauma Model Framework', replay=None, replay_steps_per_second=30):
+        self.title = title
+        self.fps = fps
+        self.max_raster = max_raster
+        self.port = port if port is not None else int(os.getenv('PORT', '8522'))
+        self.clients = set()
+        if replay is not None:
+            self.runner = ReplayRunner(replay, replay_steps_per_second)
+        else:
+            self.runner = ModelRunner(model_cls, model_kwargs, max_steps, max_steps_per_second)
+        # state the last delta frame was based on
+        self.last_state = None
+        self._frame_callback = None
+        handlers = [
+            (r'/', PageHandler),
+            (r'/ws', FrameSocketHandler),
+        ]
+        super().__init__(handlers, template_path=RESOURCES)
+
+    def set_fps(self, fps):
+        self.fps = max(0.5, min(float(fps), 60))
+        if self._frame_callback is not None:
+            self._frame_callback.stop()
+        self._frame_callback = tornado.ioloop.PeriodicCallback(self.push_frame, 1000 / self.fps)
+        self._frame_callback.start()
+
+    def push_frame(self):
+        if not self.clients:
+            return
+        state = self.runner.snapshot(self.max_raster)
+        prev = self.last_state
+        if prev is not None and prev['step'] != state['step'] \
+                and prev['raster'].shape == state['raster'].shape:
+            delta = delta_from_states(prev, state)
+        else:
+            # nothing new since the last frame (only clients that have not had
+            # a frame yet get one) or nothing to base a delta on
+            delta = None
+        keyframe_cache = []
+
+        def keyframe():
+            if not keyframe_cache:
+                keyframe_cache.append(keyframe_from_state(state))
+            return keyframe_cache[0]
+
+        for client in list(self.clients):
+            client.send_frame(state['step'], delta, keyframe)
+        self.last_state = state
+
+    def launch(self, port=None, open_browser=True):
+        if port is not None:
+            self.port = port
+        url = 'http://127.0.0.1:%d' % self.port
+        print('Interface starting at', url)
+        self.listen(self.port)
+        self.runner.start()
+        self.set_fps(self.fps)
+        if open_browser:
+            webbrowser.open(url)
+        try:
+            tornado.ioloop.IOLoop.current().start()
+        except KeyboardInterrupt:
+            self.runner.stop()
+            tornado.ioloop.IOLoop.current().stop()
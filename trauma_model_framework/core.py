@@ -0,0 +1,316 @@
+"""
+Lightweight model, agent, scheduler, grid and data collector
+================================
+
+The parts of mesa 2.1.1 the model framework is built on (Model, Agent,
+RandomActivationByType, MultiGrid and DataCollector), with the same
+behaviour: the same random number draws, activation order, cell contents
+order and neighborhood order, so a run gives exactly the same results as
+with the mesa classes.
+
+They are kept here because importing anything from mesa imports all of
+mesa first (pandas, networkx and the tornado visualization server), which
+takes longer than a short headless run. mesa itself is still used for the
+browser visualization in server.py, which works with these classes, and
+pandas is only imported when a data frame is asked for.
+
+MESA_VERSION is the mesa release they were copied from (the one
+server.py's visualization needs); mesa_check.py checks them against the
+installed mesa, and has to pass before MESA_VERSION is changed.
+"""
+
+import itertools
+import random
+from collections import defaultdict
+
+# mesa release the classes below were copied from (see mesa_check.py)
+MESA_VERSION = '2.1.1'
+
+
+class Model:
+    '''
+    Base class for models (mesa.Model). The random number generator is
+    created before __init__ runs, from the seed keyword argument.
+    '''
+
+    def __new__(cls, *args, **kwargs):
+        obj = object.__new__(cls)
+        obj._seed = kwargs.get('seed', None)
+        obj.random = random.Random(obj._seed)
+        return obj
+
+    def __init__(self, *args, **kwargs):
+        self.running = True
+        self.schedule = None
+        self.current_id = 0
+
+    def step(self):
+        pass
+
+    def next_id(self):
+        self.current_id += 1
+        return self.current_id
+
+    def reset_randomizer(self, seed=None):
+        if seed is None:
+            seed = self._seed
+        self.random.seed(seed)
+        self._seed = seed
+
+
+class Agent:
+    '''
+    Base class for agents (mesa.Agent).
+    '''
+
+    __slots__ = ('unique_id', 'model', 'pos')
+
+    def __init__(self, unique_id, model):
+        self.unique_id = unique_id
+        self.model = model
+        self.pos = None
+
+    def step(self):
+        pass
+
+    def advance(self):
+        pass
+
+    @property
+    def random(self):
+        return self.model.random
+
+
+class RandomActivationByType:
+    '''
+    Scheduler that steps each type of agent once per step, types and the
+    agents of each type in a random order reshuffled every step
+    (mesa.time.RandomActivationByType).
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self.steps = 0
+        self.time = 0
+        self._agents = {}
+        self.agents_by_type = defaultdict(dict)
+
+    def add(self, agent):
+        if agent.unique_id in self._agents:
+            raise Exception(f'Agent with unique id {agent.unique_id!r} already added to scheduler')
+        self._agents[agent.unique_id] = agent
+        self.agents_by_type[type(agent)][agent.unique_id] = agent
+
+    def remove(self, agent):
+        del self._agents[agent.unique_id]
+        del self.agents_by_type[type(agent)][agent.unique_id]
+
+    @property
+    def agents(self):
+        return list(self._agents.values())
+
+    def get_agent_count(self):
+        return len(self._agents)
+
+    def get_type_count(self, type_class):
+        return len(self.agents_by_type[type_class])
+
+    def step(self, shuffle_types=True, shuffle_agents=True):
+        # lists, so agents can be added and removed while stepping
+        type_keys = list(self.agents_by_type.keys())
+        if shuffle_types:
+            self.model.random.shuffle(type_keys)
+        for agent_class in type_keys:
+            self.step_type(agent_class, shuffle_agents=shuffle_agents)
+        self.steps += 1
+        self.time += 1
+
+    def step_type(self, type_class, shuffle_agents=True):
+        agent_keys = list(self.agents_by_type[type_class].keys())
+        if shuffle_agents:
+            self.model.random.shuffle(agent_keys)
+        agents = self.agents_by_type[type_class]
+        for agent_key in agent_keys:
+            # agents removed earlier in the step are skipped
+            if agent_key in agents:
+                agents[agent_key].step()
+
+
+class MultiGrid:
+    '''
+    Rectangular grid where each cell holds a list of agents in the order
+    they were placed in it (mesa.space.MultiGrid). [0, 0] is the bottom-left
+    cell.
+
+    Von Neumann neighborhoods are taken from the neighborhood tables of
+    landscape (see landscape.py) when it is given and has them.
+    '''
+
+    def __init__(self, width, height, torus, landscape=None):
+        self.width = width
+        self.height = height
+        self.torus = torus
+        self.num_cells = width * height
+        self.landscape = landscape
+        self._grid = [[[] for _ in range(height)] for _ in range(width)]
+        self._neighborhood_cache = {}
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            return self._grid[index]
+        x, y = self.torus_adj(index)
+        return self._grid[x][y]
+
+    def __iter__(self):
+        return itertools.chain(*self._grid)
+
+    def coord_iter(self):
+        for row in range(self.width):
+            for col in range(self.height):
+                yield self._grid[row][col], (row, col)
+
+    def out_of_bounds(self, pos):
+        x, y = pos
+        return x < 0 or x >= self.width or y < 0 or y >= self.height
+
+    def torus_adj(self, pos):
+        if not self.out_of_bounds(pos):
+            return pos
+        elif not self.torus:
+            raise Exception('Point out of bounds, and space non-toroidal.')
+        return pos[0] % self.width, pos[1] % self.height
+
+    def is_cell_empty(self, pos):
+        x, y = pos
+        return not self._grid[x][y]
+
+    def get_neighborhood(self, pos, moore, include_center=False, radius=1):
+        '''
+        Cells within radius of pos (Moore or von Neumann neighborhood), in
+        the same order as mesa: x then y ascending. Results are cached and
+        returned as tuples (mesa returns lists), so a caller cannot change
+        the cached neighborhood of a cell for every later lookup.
+        '''
+        cache_key = (pos, moore, include_center, radius)
+        neighborhood = self._neighborhood_cache.get(cache_key, None)
+        if neighborhood is not None:
+            return neighborhood
+
+        if self.out_of_bounds(pos):
+            raise Exception('The `pos` tuple passed is out of bounds.')
+
+        landscape = self.landscape
+        if (landscape is not None and not moore and not include_center and not self.torus
+                and radius in landscape.tables):
+            # cached by the landscape, for every model of the process
+            return landscape.neighborhood(pos, radius)
+
+        neighborhood = []
+        x, y = pos
+        if self.torus:
+            x_max_radius, y_max_radius = self.width // 2, self.height // 2
+            x_radius, y_radius = min(radius, x_max_radius), min(radius, y_max_radius)
+            # avoid listing a cell twice when the radius wraps all the way
+            # around an even dimension
+            kx = int(x_radius == x_max_radius and self.width % 2 == 0)
+            ky = int(y_radius == y_max_radius and self.height % 2 == 0)
+            for dx in range(-x_radius, x_radius + 1 - kx):
+                for dy in range(-y_radius, y_radius + 1 - ky):
+                    if not moore and abs(dx) + abs(dy) > radius:
+                        continue
+                    neighborhood.append(((x + dx) % self.width, (y + dy) % self.height))
+        else:
+            x_range = range(max(0, x - radius), min(self.width, x + radius + 1))
+            y_range = range(max(0, y - radius), min(self.height, y + radius + 1))
+            for nx in x_range:
+                for ny in y_range:
+                    if not moore and abs(nx - x) + abs(ny - y) > radius:
+                        continue
+                    neighborhood.append((nx, ny))
+
+        if not include_center:
+            neighborhood.remove(pos)
+
+        neighborhood = tuple(neighborhood)
+        self._neighborhood_cache[cache_key] = neighborhood
+        return neighborhood
+
+    def place_agent(self, agent, pos):
+        x, y = pos
+        if agent.pos is None or agent not in self._grid[x][y]:
+            self._grid[x][y].append(agent)
+            agent.pos = pos
+
+    def remove_agent(self, agent):
+        x, y = agent.pos
+        self._grid[x][y].remove(agent)
+        agent.pos = None
+
+    def move_agent(self, agent, pos):
+        pos = self.torus_adj(pos)
+        self.remove_agent(agent)
+        self.place_agent(agent, pos)
+
+    def iter_cell_list_contents(self, cell_list):
+        # a single (x, y) pos is accepted as well as a list of them
+        if isinstance(cell_list, tuple) and len(cell_list) == 2:
+            cell_list = [cell_list]
+        return itertools.chain.from_iterable(
+            self._grid[x][y] for x, y in itertools.filterfalse(self.is_cell_empty, cell_list)
+        )
+
+    def get_cell_list_contents(self, cell_list):
+        return list(self.iter_cell_list_contents(cell_list))
+
+
+class DataCollector:
+    '''
+    Collects model reporters (functions of the model, or model attribute
+    names) and agent reporters (functions of an agent, or agent attribute
+    names) every time collect is called (mesa.DataCollector).
+    '''
+
+    def __init__(self, model_reporters=None, agent_reporters=None):
+        self.model_reporters = {}
+        self.agent_reporters = {}
+        self.model_vars = {}
+        self._agent_records = {}
+        for name, reporter in (model_reporters or {}).items():
+            self.model_reporters[name] = reporter
+            self.model_vars[name] = []
+        for name, reporter in (agent_reporters or {}).items():
+            if isinstance(reporter, str):
+                attribute_name = reporter
+
+                def reporter(agent, attribute_name=attribute_name):
+                    return getattr(agent, attribute_name, None)
+            self.agent_reporters[name] = reporter
+
+    def collect(self, model):
+        for var, reporter in self.model_reporters.items():
+            if isinstance(reporter, str):
+                self.model_vars[var].append(getattr(model, reporter, None))
+            else:
+                self.model_vars[var].append(reporter(model))
+        if self.agent_reporters:
+            steps = model.schedule.steps
+            reporters = list(self.agent_reporters.values())
+            self._agent_records[steps] = [
+                (steps, agent.unique_id, *(rep(agent) for rep in reporters))
+                for agent in model.schedule.agents
+            ]
+
+    def get_model_vars_dataframe(self):
+        import pandas as pd
+
+        return pd.DataFrame(self.model_vars)
+
+    def get_agent_vars_dataframe(self):
+        import pandas as pd
+
+        records = itertools.chain.from_iterable(self._agent_records.values())
+        return pd.DataFrame.from_records(
+            data=records,
+            columns=['Step', 'AgentID', *self.agent_reporters],
+            index=['Step', 'AgentID'],
+        )
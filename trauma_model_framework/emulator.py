@@ -0,0 +1,485 @@
+"""
+Surrogate emulator of the model trained on finished runs
+================================
+
+Gaussian-process regression from run parameters (e.g. famine duration and
+growback, trauma parameters, initial population) to run summaries:
+recovery time (of the runs that recovered), chance of recovering within
+the run, peak trauma, population minimum and the post-famine trauma
+level every 100 steps after the famine end. Runs whose famine did not
+end, or that died out, are left out. It is trained on the results
+of a sweep queue (see sweep.py), so every run ever done for a sweep,
+sensitivity analysis or earlier emulator adds to the corpus, and answers
+"what if" queries in about a millisecond (for a few hundred training
+runs) with a predictive standard deviation, which includes the
+run-to-run noise between seeds.
+
+Queries outside the range of the training runs, or too far from any of
+them for the emulator to know better than its prior, are flagged as out
+of distribution; those should be answered by running the model.
+
+    python -m trauma_model_framework.emulator submit QUEUE --range famine.duration=50,200 \\
+        --range famine.growback=0,0.3 --n 200 --engine numba
+    python -m trauma_model_framework.sweep work QUEUE --processes 8
+    python -m trauma_model_framework.emulator fit QUEUE famine.npz
+    python -m trauma_model_framework.emulator query famine.npz famine.duration=150 famine.growback=0.05
+
+Parameters are named like the SugarscapeTMF arguments of the run specs,
+with nested dicts flattened: 'initial_population', 'famine.duration',
+'trauma_params.kill_prob'.
+"""
+
+import inspect
+import json
+
+import numpy as np
+
+from .agents import TRAUMA_PARAMS
+from .model import SugarscapeTMF
+from .scenario import Famine, SteadyStateFamine
+from .sensitivity import recovery_time
+from .sweep import WorkQueue
+
+# steps after the famine end the post-famine trauma level is emulated at
+POST_FAMINE_OFFSETS = tuple(range(0, 801, 100))
+
+# queries further than this outside the training range (as a fraction of
+# the range) are out of distribution
+RANGE_MARGIN = 0.05
+
+# queries further from the nearest training run than this many times the
+# usual distance between neighbouring training runs are out of
+# distribution (a gap in the training runs)
+OOD_SPACING = 3.0
+
+
+def _after_famine(summary, series):
+    return summary['model_vars'][series][summary['te_start']:]
+
+
+def _followed(summary, step):
+    # the run got to step with a population left (an empty population has
+    # an average trauma level of 0, which is no data point)
+    population = summary['model_vars']['SsAgent']
+    return step < len(population) and population[step] > 0
+
+
+def famine_ended(summary):
+    '''
+    Whether the famine of a run ended within the run and left a population
+    to follow. Other runs (famines still going at the last step, or that
+    killed everyone) say nothing about the recovery and are left out of
+    the corpus.
+    '''
+    return summary['te_end'] < summary['steps'] and _followed(summary, summary['te_end'])
+
+
+def recovered(summary):
+    '''
+    Whether a run recovered within the run, not counting a recovery that
+    only comes from the population dying out.
+    '''
+    return bool(summary['trauma_recovery']) and _followed(summary, summary['t_recovery'])
+
+
+def _recovery_time(summary):
+    # runs that did not recover only tell that the recovery takes longer
+    # than they ran (censored); they are flagged by the recovered output
+    # and left out of this one's training runs
+    return recovery_time(summary) if recovered(summary) else float('nan')
+
+
+def _trauma_post(offset):
+    def output(summary):
+        step = summary['te_end'] + offset
+        if not _followed(summary, step):
+            # the run ended or died out before then; the GPs leave it out
+            # of this output's training runs
+            return float('nan')
+        return summary['model_vars']['Trauma'][step]
+    return output
+
+
+# emulated outputs, as functions of a sweep.run_spec summary (NaN where a
+# run has no value for an output)
+OUTPUTS = {
+    'recovery_time': _recovery_time,
+    # 1 for runs that recovered, 0 for censored ones; the emulated value is
+    # the chance of recovering within the run
+    'recovered': lambda summary: float(recovered(summary)),
+    'peak_trauma': lambda summary: max(_after_famine(summary, 'Trauma')),
+    'population_min': lambda summary: min(_after_famine(summary, 'SsAgent')),
+}
+OUTPUTS.update({'trauma_post_%d' % offset: _trauma_post(offset) for offset in POST_FAMINE_OFFSETS})
+
+
+def _signature_defaults(func):
+    return {name: p.default for name, p in inspect.signature(func).parameters.items()
+            if p.default is not inspect.Parameter.empty}
+
+
+def default_value(name):
+    '''
+    Value a run has for a (flattened) parameter it does not set.
+    '''
+    if name.startswith('trauma_params.'):
+        return TRAUMA_PARAMS[name.split('.', 1)[1]]
+    if name.startswith('famine.'):
+        defaults = _signature_defaults(SteadyStateFamine.__init__)
+        defaults.update(_signature_defaults(Famine.__init__))
+        return defaults[name.split('.', 1)[1]]
+    return _signature_defaults(SugarscapeTMF.__init__)[name]
+
+
+def flatten(kwargs, prefix=''):
+    flat = {}
+    for key, value in kwargs.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def unflatten(params):
+    '''
+    SugarscapeTMF arguments of flattened parameters. Parameters whose
+    default is an int (e.g. famine.duration) are rounded.
+    '''
+    kwargs = {}
+    for name, value in params.items():
+        default = default_value(name)
+        if isinstance(default, int) and not isinstance(default, bool):
+            value = int(round(value))
+        *path, key = name.split('.')
+        d = kwargs
+        for part in path:
+            d = d.setdefault(part, {})
+        d[key] = value
+    return kwargs
+
+
+def load_corpus(queue, inputs=None):
+    '''
+    Inputs and outputs of every finished run of a queue whose famine ended
+    with a population left (see famine_ended).
+
+    Parameters
+    ----------
+    inputs : list of str, optional
+        parameters to emulate over; by default every numeric parameter
+        (other than the seed) that differs between the runs
+
+    Returns
+    -------
+    X : np.ndarray, shape (runs, len(inputs))
+    Y : np.ndarray, shape (runs, len(OUTPUTS))
+        NaN where a run has no value for an output
+    inputs : list of str
+
+    '''
+    runs = [(flatten(r['spec']['model_kwargs']), r['summary']) for r in WorkQueue(queue).results()]
+    runs = [(params, summary) for params, summary in runs if summary['famines'] and famine_ended(summary)]
+    if inputs is None:
+        values = {}
+        for params, _ in runs:
+            for name, value in params.items():
+                if name != 'seed' and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values.setdefault(name, set()).add(value)
+        inputs = sorted(name for name, vals in values.items() if len(vals) > 1)
+    X = np.array([[params.get(name, default_value(name)) for name in inputs] for params, _ in runs],
+                 dtype=np.float64).reshape(len(runs), len(inputs))
+    Y = np.array([[output(summary) for output in OUTPUTS.values()] for _, summary in runs],
+                 dtype=np.float64).reshape(len(runs), len(OUTPUTS))
+    return X, Y, inputs
+
+
+def _output_scale(Y):
+    # mean and standard deviation of every output over the runs it is
+    # finite for (a NaN mean for outputs no run has a value for)
+    finite = np.isfinite(Y)
+    count = np.maximum(finite.sum(axis=0), 1)
+    mean = np.where(finite, Y, 0.0).sum(axis=0) / count
+    std = np.sqrt((np.where(finite, Y - mean, 0.0) ** 2).sum(axis=0) / count)
+    return np.where(finite.any(axis=0), mean, np.nan), np.where(std > 0, std, 1.0)
+
+
+def latin_hypercube(n, d, seed=0):
+    '''
+    n points in the unit cube, one in each of n equal slices of every axis.
+    '''
+    rng = np.random.default_rng(seed)
+    u = (np.argsort(rng.random((d, n)), axis=1).T + rng.random((n, d))) / n
+    return u
+
+
+def _sq_dist(a, b, lengthscales):
+    a, b = a / lengthscales, b / lengthscales
+    return np.maximum((a ** 2).sum(1)[:, None] + (b ** 2).sum(1)[None, :] - 2 * a @ b.T, 0)
+
+
+def _neg_log_likelihood(theta, U, y):
+    d = U.shape[1]
+    lengthscales, signal, noise = np.exp(theta[:d]), np.exp(theta[d]), np.exp(theta[d + 1])
+    K = signal * np.exp(-0.5 * _sq_dist(U, U, lengthscales)) + (noise + 1e-8) * np.eye(len(U))
+    try:
+        L = np.linalg.cholesky(K)
+    except np.linalg.LinAlgError:
+        return 1e10
+    alpha = np.linalg.solve(L.T, np.linalg.solve(L, y))
+    return 0.5 * y @ alpha + np.log(np.diag(L)).sum()
+
+
+def fit_hyperparameters(U, y):
+    '''
+    Log lengthscales (one per input), log signal variance and log noise
+    variance of a squared-exponential GP maximizing the marginal likelihood
+    of the standardized outputs y. Uses scipy's L-BFGS-B when scipy is
+    installed, otherwise a coarse grid search.
+    '''
+    d = U.shape[1]
+    try:
+        from scipy.optimize import minimize
+    except ImportError:
+        best = None
+        for ls in (0.1, 0.2, 0.5, 1.0, 2.0):
+            for noise in (0.01, 0.1, 0.3, 1.0):
+                theta = np.log(np.r_[[ls] * d, 1.0, noise])
+                nll = _neg_log_likelihood(theta, U, y)
+                if best is None or nll < best[0]:
+                    best = (nll, theta)
+        return best[1]
+    theta0 = np.log(np.r_[[0.5] * d, 1.0, 0.1])
+    bounds = [(np.log(0.05), np.log(100.0))] * d + [(np.log(1e-2), np.log(1e2)), (np.log(1e-6), np.log(10.0))]
+    return minimize(_neg_log_likelihood, theta0, args=(U, y), method='L-BFGS-B', bounds=bounds).x
+
+
+class Emulator:
+    '''
+    One Gaussian process per output over the inputs scaled to the unit cube
+    of the training range, with outputs standardized. Each output's GP is
+    trained on the runs that have a finite value for it. Use Emulator.fit or
+    Emulator.from_queue to train one and Emulator.load to load a saved one.
+    '''
+
+    def __init__(self, inputs, outputs, X, Y, thetas):
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.low, self.high = X.min(axis=0), X.max(axis=0)
+        self.span = np.where(self.high > self.low, self.high - self.low, 1.0)
+        self.X, self.Y = X, Y
+        self.y_mean, self.y_std = _output_scale(Y)
+        self.thetas = np.asarray(thetas)
+        d = len(self.inputs)
+        self._U = (X - self.low) / self.span
+        self._lengthscales = np.exp(self.thetas[:, :d])
+        self._signal = np.exp(self.thetas[:, d])
+        self._noise = np.exp(self.thetas[:, d + 1])
+        # K^-1 (for variances) and K^-1 y (for means) of every output, over
+        # all runs with zeros for the runs an output is not trained on, so
+        # every output is predicted at once
+        n = len(X)
+        self._K_inv = np.zeros((len(self.outputs), n, n))
+        self._alpha = np.zeros((len(self.outputs), n))
+        for k in range(len(self.outputs)):
+            train = np.isfinite(Y[:, k])
+            U = self._U[train]
+            K = (self._signal[k] * np.exp(-0.5 * _sq_dist(U, U, self._lengthscales[k]))
+                 + (self._noise[k] + 1e-8) * np.eye(len(U)))
+            L = np.linalg.cholesky(K)
+            L_inv = np.linalg.solve(L, np.eye(len(U)))
+            K_inv = L_inv.T @ L_inv
+            self._K_inv[k][np.ix_(train, train)] = K_inv
+            self._alpha[k, train] = K_inv @ ((Y[train, k] - self.y_mean[k]) / self.y_std[k])
+        # 95th percentile of the distances between neighbouring (distinct)
+        # training runs, in the unit cube
+        points = np.unique(self._U, axis=0)
+        if len(points) > 1:
+            dist = np.sqrt(_sq_dist(points, points, 1.0))
+            np.fill_diagonal(dist, np.inf)
+            self._spacing = np.percentile(dist.min(axis=1), 95)
+        else:
+            self._spacing = np.inf
+
+    @classmethod
+    def fit(cls, X, Y, inputs, outputs=tuple(OUTPUTS)):
+        mean, std = _output_scale(Y)
+        Y_std = (Y - mean) / std
+        span = np.where(X.max(axis=0) > X.min(axis=0), X.max(axis=0) - X.min(axis=0), 1.0)
+        U = (X - X.min(axis=0)) / span
+        # runs without a finite value for an output are left out of its GP
+        train = np.isfinite(Y)
+        thetas = [fit_hyperparameters(U[train[:, k]], Y_std[train[:, k], k]) for k in range(Y.shape[1])]
+        return cls(inputs, outputs, X, Y, thetas)
+
+    @classmethod
+    def from_queue(cls, queue, inputs=None):
+        '''
+        Emulator trained on the finished runs of a sweep queue (see load_corpus).
+        '''
+        X, Y, inputs = load_corpus(queue, inputs)
+        if not inputs:
+            raise ValueError('the runs of %s do not differ in any parameter' % queue)
+        return cls.fit(X, Y, inputs)
+
+    def predict(self, X):
+        '''
+        Parameters
+        ----------
+        X : array of shape (m, len(inputs)), or dict of one value per input
+
+        Returns
+        -------
+        mean, std : np.ndarray, shape (m, len(outputs))
+            predictive mean and standard deviation (run-to-run noise included)
+        ood : np.ndarray of bool, shape (m,)
+            out of distribution: outside the training range, or too far
+            from every training run
+
+        '''
+        if isinstance(X, dict):
+            X = [[X[name] for name in self.inputs]]
+        U = (np.atleast_2d(np.asarray(X, dtype=np.float64)) - self.low) / self.span
+        out_of_range = ((U < -RANGE_MARGIN) | (U > 1 + RANGE_MARGIN)).any(axis=1)
+        # (outputs, m, runs)
+        diff = U[None, :, None, :] - self._U[None, None, :, :]
+        k_star = self._signal[:, None, None] * np.exp(
+            -0.5 * ((diff / self._lengthscales[:, None, None, :]) ** 2).sum(axis=3))
+        mean = np.einsum('kmn,kn->km', k_star, self._alpha)
+        latent_var = self._signal[:, None] - (np.matmul(k_star, self._K_inv) * k_star).sum(axis=2)
+        std = np.sqrt(np.maximum(latent_var, 0) + self._noise[:, None])
+        nearest = np.sqrt(_sq_dist(U, self._U, 1.0).min(axis=1))
+        far = nearest > OOD_SPACING * self._spacing
+        return ((mean * self.y_std[:, None] + self.y_mean[:, None]).T,
+                (std * self.y_std[:, None]).T, out_of_range | far)
+
+    def query(self, **params):
+        '''
+        Prediction for one set of parameters given by (flattened) name, e.g.
+        emulator.query(**{'famine.duration': 150, 'famine.growback': 0.05}).
+        Inputs not given take their default value.
+
+        Returns
+        -------
+        prediction : dict
+            (mean, std) per output, and 'ood'
+
+        '''
+        x = [params[name] if name in params else default_value(name) for name in self.inputs]
+        mean, std, ood = self.predict([x])
+        prediction = {name: (mean[0, k], std[0, k]) for k, name in enumerate(self.outputs)}
+        prediction['ood'] = bool(ood[0])
+        return prediction
+
+    def trauma_bands(self, X, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+        '''
+        Quantile bands of the post-famine trauma level over runs (as in
+        run_and_analyze.py) at POST_FAMINE_OFFSETS, from the normal
+        predictive distributions.
+
+        Returns
+        -------
+        bands : np.ndarray, shape (m, len(POST_FAMINE_OFFSETS), len(quantiles))
+
+        '''
+        from statistics import NormalDist
+
+        mean, std, _ = self.predict(X)
+        cols = [self.outputs.index('trauma_post_%d' % offset) for offset in POST_FAMINE_OFFSETS]
+        z = np.array([NormalDist().inv_cdf(q) for q in quantiles])
+        return mean[:, cols, None] + std[:, cols, None] * z
+
+    def save(self, path):
+        np.savez(path, meta=json.dumps({'inputs': self.inputs, 'outputs': self.outputs}),
+                 X=self.X, Y=self.Y, thetas=self.thetas)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            return cls(meta['inputs'], meta['outputs'], data['X'], data['Y'], data['thetas'])
+
+
+def submit(queue, ranges, n=100, seeds=1, steps=2500, seed=0, **model_kwargs):
+    '''
+    Submits a Latin hypercube of n parameter sets (x seeds runs each) over
+    ranges to a sweep queue, to add to the training corpus.
+
+    Parameters
+    ----------
+    ranges : dict of (low, high)
+        flattened parameter names and ranges
+    **model_kwargs :
+        other SugarscapeTMF arguments of every run (e.g. engine='numba')
+
+    Returns
+    -------
+    n_new : int
+        number of runs that were not already queued or done
+
+    '''
+    names = sorted(ranges)
+    low, high = np.array([ranges[name] for name in names], dtype=np.float64).reshape(-1, 2).T
+    X = low + latin_hypercube(n, len(names), seed) * (high - low)
+    specs = []
+    for x in X:
+        params = flatten(model_kwargs)
+        params.update(zip(names, x.tolist()))
+        kwargs = unflatten(params)
+        for run_seed in range(seeds):
+            specs.append({'model_kwargs': dict(kwargs, seed=run_seed), 'step_count': steps})
+    return WorkQueue(queue).submit(specs)
+
+
+def _parse_value(text):
+    name, value = text.split('=', 1)
+    return name, [float(v) for v in value.split(',')]
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Gaussian-process emulator of SugarscapeTMF run summaries')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('submit', help='queue a Latin hypercube of runs for the training corpus')
+    p.add_argument('queue')
+    p.add_argument('--range', action='append', default=[], type=_parse_value, required=True,
+                   help='parameter range, e.g. famine.duration=50,200')
+    p.add_argument('--n', type=int, default=100, help='number of parameter sets')
+    p.add_argument('--seeds', type=int, default=1, help='runs per parameter set')
+    p.add_argument('--steps', type=int, default=2500)
+    p.add_argument('--engine', default='python')
+
+    p = sub.add_parser('fit', help='train on the finished runs of a queue and save the emulator')
+    p.add_argument('queue')
+    p.add_argument('emulator')
+    p.add_argument('--input', action='append', default=None,
+                   help='parameter to emulate over (repeatable; all that vary by default)')
+
+    p = sub.add_parser('query', help='predict the outputs of a run')
+    p.add_argument('emulator')
+    p.add_argument('params', nargs='*', type=_parse_value, help='e.g. famine.duration=150')
+
+    args = parser.parse_args()
+    if args.command == 'submit':
+        n_new = submit(args.queue, dict(args.range), args.n, args.seeds, args.steps, engine=args.engine)
+        print('%d new runs submitted' % n_new)
+    elif args.command == 'fit':
+        emulator = Emulator.from_queue(args.queue, args.input)
+        emulator.save(args.emulator)
+        print('emulator of %s over %s trained on %d runs'
+              % (', '.join(emulator.outputs), ', '.join(emulator.inputs), len(emulator.X)))
+    else:
+        emulator = Emulator.load(args.emulator)
+        params = {name: values[0] for name, values in args.params}
+        t = time.perf_counter()
+        prediction = emulator.query(**params)
+        elapsed = time.perf_counter() - t
+        for name in emulator.outputs:
+            mean, std = prediction[name]
+            print('%-20s %10.3f +- %.3f' % (name, mean, std))
+        if prediction['ood']:
+            print('OUT OF DISTRIBUTION: run the model for this query')
+        print('(%.2f ms)' % (elapsed * 1000))
@@ -0,0 +1,243 @@
+"""
+Event log for trauma influenced behaviors
+================================
+
+Fixed-width records of the discrete things agents do (mugging, killing,
+cannibalism, pregnancy, birth and death) kept in a NumPy structured buffer
+and flushed to disk in chunks.
+"""
+
+import warnings
+from collections import deque
+
+import numpy as np
+
+# event type codes stored in the "type" field
+MUG = 0
+KILL = 1
+CANNIBALIZE = 2
+PREGNANCY = 3
+BIRTH = 4
+STARVATION_DEATH = 5
+OLD_AGE_DEATH = 6
+
+EVENT_NAMES = {
+    MUG: 'Mugs',
+    KILL: 'Kills',
+    CANNIBALIZE: 'Cannibalizations',
+    PREGNANCY: 'Pregnancies',
+    BIRTH: 'Births',
+    STARVATION_DEATH: 'Starvation deaths',
+    OLD_AGE_DEATH: 'Old age deaths',
+}
+
+# packed record layout, 29 bytes per event
+EVENT_DTYPE = np.dtype([
+    ('actor', np.int64),
+    ('target', np.int64),
+    ('step', np.int32),
+    ('trauma', np.float32),
+    ('x', np.int16),
+    ('y', np.int16),
+    ('type', np.int8),
+])
+
+
+class EventLog:
+    '''
+    Append-only event recorder.
+
+    Records are written into a preallocated structured array. At the end of
+    every model step the number of events of each type in that step is
+    computed from the buffer (this feeds the model reporters) and, once the
+    buffer holds chunk_size records, it is flushed either to the file at
+    path (raw EVENT_DTYPE records, readable with np.fromfile) or, if no path
+    is given, to a list of in-memory chunks.
+
+    The in-memory list keeps at most max_chunks chunks (about 30 MB with
+    the defaults, enough for short and debugging runs); after that the
+    oldest chunk is dropped for every new one and n_dropped counts the
+    events lost, so a long run without a path does not grow without bound.
+    Give a path to keep every event of a long run.
+    '''
+
+    def __init__(self, path=None, chunk_size=65536, max_chunks=16):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self._buf = np.empty(chunk_size, dtype=EVENT_DTYPE)
+        self._n = 0
+        self._step_start = 0
+        self._chunks = deque(maxlen=max_chunks)
+        self.n_flushed = 0
+        # events dropped from the in-memory chunks (see max_chunks)
+        self.n_dropped = 0
+        # number of events of each type recorded in the last completed step
+        self.last_counts = np.zeros(len(EVENT_NAMES), dtype=np.int64)
+        if path is not None:
+            # start a fresh file for this run
+            open(path, 'wb').close()
+
+    def __len__(self):
+        # every event recorded, including any dropped from memory
+        return self.n_flushed + self._n
+
+    def record(self, step, event_type, actor, target, pos, trauma):
+        '''
+        Append one event.
+
+        Parameters
+        ----------
+        step : int
+            schedule step the event happened in
+        event_type : int
+            one of the event type codes of this module
+        actor : int
+            unique_id of the agent doing the action
+        target : int
+            unique_id of the other agent involved (-1 if none)
+        pos : (int,int)
+            pos on the canvas where the event happened
+        trauma : float
+            trauma level of the actor at the time of the event
+
+        Returns
+        -------
+        None.
+
+        '''
+        if self._n == len(self._buf):
+            # a single step produced more events than the buffer holds
+            self._buf = np.concatenate([self._buf, np.empty(len(self._buf), dtype=EVENT_DTYPE)])
+        self._buf[self._n] = (actor, target, step, trauma, pos[0], pos[1], event_type)
+        self._n += 1
+
+    def record_many(self, step, event_type, actor, target, x, y, trauma):
+        '''
+        Append a batch of events of one step, given as equal length arrays
+        (same fields as record, with pos split into x and y).
+        '''
+        n = len(event_type)
+        if self._n + n > len(self._buf):
+            grow = max(len(self._buf), self._n + n - len(self._buf))
+            self._buf = np.concatenate([self._buf, np.empty(grow, dtype=EVENT_DTYPE)])
+        chunk = self._buf[self._n:self._n + n]
+        chunk['actor'] = actor
+        chunk['target'] = target
+        chunk['step'] = step
+        chunk['trauma'] = trauma
+        chunk['x'] = x
+        chunk['y'] = y
+        chunk['type'] = event_type
+        self._n += n
+
+    def end_step(self):
+        '''
+        Called by the model after every step. Counts the events of the step
+        that just finished and flushes the buffer if it is full.
+        '''
+        types = self._buf['type'][self._step_start:self._n]
+        self.last_counts = np.bincount(types, minlength=len(EVENT_NAMES))
+        if self._n >= self.chunk_size:
+            self.flush()
+        self._step_start = self._n
+
+    def flush(self):
+        '''
+        Move all buffered records to disk (or to the in-memory chunk list,
+        dropping its oldest chunk if it holds max_chunks already).
+        '''
+        if self._n == 0:
+            return
+        chunk = self._buf[:self._n]
+        if self.path is not None:
+            with open(self.path, 'ab') as f:
+                chunk.tofile(f)
+        else:
+            if len(self._chunks) == self.max_chunks:
+                if not self.n_dropped:
+                    warnings.warn('the in-memory event log is full (%d chunks), dropping the oldest '
+                                  'events; pass event_log=path to keep every event' % self.max_chunks)
+                self.n_dropped += len(self._chunks[0])
+            self._chunks.append(chunk.copy())
+        self.n_flushed += self._n
+        self._n = 0
+        self._step_start = 0
+
+    def iter_chunks(self):
+        '''
+        Yield the recorded events chunk by chunk (flushed chunks first,
+        followed by whatever is still in the buffer) without loading the
+        whole file into memory. Events dropped from memory (see
+        max_chunks) are not included.
+        '''
+        if self.path is not None:
+            if self.n_flushed:
+                records = np.memmap(self.path, dtype=EVENT_DTYPE, mode='r', shape=(self.n_flushed,))
+                for start in range(0, self.n_flushed, self.chunk_size):
+                    yield np.asarray(records[start:start + self.chunk_size])
+        else:
+            yield from self._chunks
+        if self._n:
+            yield self._buf[:self._n]
+
+    def events(self, types=None, start_step=None, end_step=None):
+        '''
+        Return the recorded events, optionally filtered.
+
+        Parameters
+        ----------
+        types : int or list of int, optional
+            event type codes to keep (default: all)
+        start_step, end_step : int, optional
+            keep only events with start_step <= step < end_step
+
+        Returns
+        -------
+        events : np.ndarray of EVENT_DTYPE
+
+        '''
+        if types is not None:
+            types = np.atleast_1d(types)
+        parts = []
+        for chunk in self.iter_chunks():
+            keep = np.ones(len(chunk), dtype=bool)
+            if types is not None:
+                keep &= np.isin(chunk['type'], types)
+            if start_step is not None:
+                keep &= chunk['step'] >= start_step
+            if end_step is not None:
+                keep &= chunk['step'] < end_step
+            parts.append(chunk[keep])
+        if not parts:
+            return np.empty(0, dtype=EVENT_DTYPE)
+        return np.concatenate(parts)
+
+    def counts_by_step(self, n_steps):
+        '''
+        Number of events of each type in every step.
+
+        Returns
+        -------
+        counts : np.ndarray (n_steps, number of event types)
+
+        '''
+        n_types = len(EVENT_NAMES)
+        counts = np.zeros(n_steps * n_types, dtype=np.int64)
+        for chunk in self.iter_chunks():
+            steps = chunk['step'].astype(np.int64)
+            keep = steps < n_steps
+            counts += np.bincount(steps[keep] * n_types + chunk['type'][keep],
+                                  minlength=n_steps * n_types)
+        return counts.reshape(n_steps, n_types)
+
+
+def read_events(path, types=None):
+    '''
+    Load an event file written by EventLog, optionally keeping only the
+    given event types.
+    '''
+    records = np.fromfile(path, dtype=EVENT_DTYPE)
+    if types is not None:
+        records = records[np.isin(records['type'], np.atleast_1d(types))]
+    return records
@@ -0,0 +1,503 @@
+"""
+Compact binary frames of the model state for visualization and replay
+================================
+
+A keyframe is a fixed header followed by the sugar landscape as a
+palette-indexed raster (one byte per cell) and the non-sugar agents as
+id/coordinate arrays, so a 50x50 canvas is about 2.5KB instead of 2,500 JSON
+portrayal objects. A delta frame only holds the cells whose sugar amount
+bucket changed and the agents that moved (or changed trauma bucket), were born
+or died since the previous frame. Like sugar amounts, trauma levels are
+bucketed into the TRAUMA_LEVELS shades agents are drawn with, so the small
+changes of trauma every step do not put nearly every agent in every delta.
+
+Keyframe layout (little-endian):
+    header  KEYFRAME_HEADER (magic b'TMFK')
+    raster  uint8[raster_height, raster_width]   palette index per cell, row y
+    ids     uint32[n_agents]
+    x, y    uint16[n_agents] each
+    trauma  uint8[n_agents]                      trauma bucket scaled to 0-255
+
+Delta frame layout (little-endian):
+    header  DELTA_HEADER (magic b'TMFD')
+    cells   either uint16 (uint32 for rasters over 65536 cells) flat raster
+            indexes, or a bitmask over the raster if that is smaller
+            (flag CELL_MASK); then uint8[n_cells] new palette indexes
+    updates bitmask over the previous frame's agents (in id order) of the
+            agents that moved or changed trauma bucket, then int8 dx, int8 dy
+            (int16 with flag WIDE_MOVES) and uint8 trauma  (n_updates each)
+    births  uint32 ids, uint16 x, uint16 y, uint8 trauma   (n_births each)
+    deaths  uint32 ids                                     (n_deaths)
+
+A replay file (ReplayWriter/ReplayReader) is a sequence of length-prefixed
+(optionally zlib compressed) frames with a keyframe every keyframe_interval
+frames and an index of the keyframes at the end, so a long run can be played
+back or seeked without re-simulating it.
+"""
+
+import math
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from .agents import SsAgent
+
+# magic, step, width, height, downsample factor, n_agents, average trauma
+KEYFRAME_HEADER = struct.Struct('<4sIHHBIf')
+KEYFRAME_MAGIC = b'TMFK'
+# magic, step, width, height, downsample factor, flags, n_cells, n_updates, n_births,
+# n_deaths, average trauma
+DELTA_HEADER = struct.Struct('<4sIHHBBIIIIf')
+DELTA_MAGIC = b'TMFD'
+# delta frame flags
+CELL_MASK = 1
+WIDE_MOVES = 2
+
+# palette index == sugar amount (0-4), same colors as the mesa canvas in server.py
+PALETTE = ["#D6F5D6", "#00F800", "#00AA00", "#008300", "#005C00"]
+# number of shades of red (black = no trauma) agents are drawn with
+TRAUMA_LEVELS = 16
+
+
+def downsample_raster(raster, factor):
+    '''
+    Reduce a (height, width) raster by an integer factor by taking the max
+    over each factor x factor block (so sugar peaks stay visible).
+    '''
+    if factor <= 1:
+        return raster
+    h, w = raster.shape
+    hp, wp = -(-h // factor) * factor, -(-w // factor) * factor
+    padded = np.zeros((hp, wp), dtype=raster.dtype)
+    padded[:h, :w] = raster
+    return padded.reshape(hp // factor, factor, wp // factor, factor).max(axis=(1, 3))
+
+
+def landscape_raster(model):
+    '''
+    Palette-indexed raster of the sugar landscape, indexed [y, x].
+    '''
+    amounts = model.sugar_amounts()
+    return np.clip(amounts, 0, len(PALETTE) - 1).astype(np.uint8).T
+
+
+def agent_arrays(model):
+    '''
+    Ids, positions and trauma levels of all non-sugar agents as arrays,
+    sorted by id.
+
+    Returns
+    -------
+    ids : np.ndarray of uint32
+    x, y : np.ndarray of uint16
+    trauma : np.ndarray of uint8 (trauma level rounded to one of
+        TRAUMA_LEVELS buckets and scaled to 0-255)
+
+    '''
+    agents = model.schedule.agents_by_type[SsAgent]
+    n = len(agents)
+    ids = np.fromiter(agents.keys(), dtype=np.uint32, count=n)
+    xy = np.fromiter((c for ag in agents.values() for c in ag.pos), dtype=np.uint16, count=2 * n)
+    trauma = np.fromiter((ag.trauma for ag in agents.values()), dtype=np.float64, count=n)
+    levels = np.clip(np.rint(trauma * (TRAUMA_LEVELS - 1)), 0, TRAUMA_LEVELS - 1)
+    trauma = (levels * 255 // (TRAUMA_LEVELS - 1)).astype(np.uint8)
+    x, y = xy[0::2], xy[1::2]
+    order = np.argsort(ids, kind='stable')
+    return ids[order], x[order], y[order], trauma[order]
+
+
+def snapshot(model, max_raster=256):
+    '''
+    Capture the part of the model state that frames are made of.
+
+    Parameters
+    ----------
+    model : SugarscapeTMF
+    max_raster : int
+        largest raster side kept; larger canvases are downsampled by the
+        smallest integer factor that fits (agent coordinates are not)
+
+    Returns
+    -------
+    state : dict
+        step, width, height, factor, avg_trauma, raster, ids, x, y, trauma.
+        Decoded frames (decode_frame) have the same keys.
+
+    '''
+    factor = max(1, math.ceil(max(model.width, model.height) / max_raster))
+    ids, x, y, trauma = agent_arrays(model)
+    return {
+        'step': model.schedule.steps,
+        'width': model.width,
+        'height': model.height,
+        'factor': factor,
+        'avg_trauma': model.datacollector.model_vars['Trauma'][-1],
+        'raster': downsample_raster(landscape_raster(model), factor),
+        'ids': ids, 'x': x, 'y': y, 'trauma': trauma,
+    }
+
+
+def keyframe_from_state(state):
+    '''
+    Encode a snapshot (or decoded state) as a keyframe.
+    '''
+    header = KEYFRAME_HEADER.pack(KEYFRAME_MAGIC, state['step'], state['width'], state['height'],
+                                  state['factor'], len(state['ids']), state['avg_trauma'])
+    return b''.join([header, state['raster'].tobytes(), state['ids'].tobytes(),
+                     state['x'].tobytes(), state['y'].tobytes(), state['trauma'].tobytes()])
+
+
+def encode_keyframe(model, max_raster=256):
+    '''
+    Encode the full current state of the model as one keyframe.
+    '''
+    return keyframe_from_state(snapshot(model, max_raster))
+
+
+def _cell_index_dtype(n_cells):
+    return np.uint16 if n_cells <= 65536 else np.uint32
+
+
+def delta_from_states(prev, state):
+    '''
+    Encode the changes from snapshot prev to snapshot state as a delta frame.
+    Both snapshots must have the same raster size.
+    '''
+    flags = 0
+    changed_cells = (prev['raster'] != state['raster']).ravel()
+    cells = np.flatnonzero(changed_cells)
+    values = state['raster'].ravel()[cells]
+    index_dtype = _cell_index_dtype(changed_cells.size)
+    if len(cells) * np.dtype(index_dtype).itemsize > -(-changed_cells.size // 8):
+        flags |= CELL_MASK
+        cell_bytes = np.packbits(changed_cells, bitorder='little').tobytes()
+    else:
+        cell_bytes = cells.astype(index_dtype).tobytes()
+
+    ids, old_ids = state['ids'], prev['ids']
+    # where each current agent was in prev (agents are always sorted by id)
+    where = np.searchsorted(old_ids, ids).clip(0, max(len(old_ids) - 1, 0))
+    if len(old_ids):
+        existed = old_ids[where] == ids
+    else:
+        existed = np.zeros(len(ids), dtype=bool)
+    births = ~existed
+    where = where[existed]
+    dx = state['x'][existed].astype(np.int32) - prev['x'][where]
+    dy = state['y'][existed].astype(np.int32) - prev['y'][where]
+    trauma = state['trauma'][existed]
+    changed = (dx != 0) | (dy != 0) | (trauma != prev['trauma'][where])
+    # bitmask over the previous frame's agents
+    update_mask = np.zeros(len(old_ids), dtype=bool)
+    update_mask[where[changed]] = True
+    dx, dy, trauma = dx[changed], dy[changed], trauma[changed]
+    move_dtype = np.int8
+    if len(dx) and max(np.abs(dx).max(), np.abs(dy).max()) > 127:
+        flags |= WIDE_MOVES
+        move_dtype = np.int16
+    deaths = old_ids[~np.isin(old_ids, ids, assume_unique=True)]
+
+    header = DELTA_HEADER.pack(DELTA_MAGIC, state['step'], state['width'], state['height'],
+                               state['factor'], flags, len(cells), len(dx), int(births.sum()),
+                               len(deaths), state['avg_trauma'])
+    return b''.join([
+        header, cell_bytes, values.tobytes(),
+        np.packbits(update_mask, bitorder='little').tobytes(),
+        dx.astype(move_dtype).tobytes(), dy.astype(move_dtype).tobytes(), trauma.tobytes(),
+        ids[births].tobytes(), state['x'][births].tobytes(), state['y'][births].tobytes(),
+        state['trauma'][births].tobytes(),
+        deaths.tobytes(),
+    ])
+
+
+def _read(frame, dtype, n, offset):
+    arr = np.frombuffer(frame, dtype, n, offset)
+    return arr, offset + arr.nbytes
+
+
+def decode_frame(frame, state=None):
+    '''
+    Decode a keyframe, or apply a delta frame to the state decoded from the
+    frames before it.
+
+    Parameters
+    ----------
+    frame : bytes
+    state : dict, optional
+        current decoded state (required for delta frames; not modified)
+
+    Returns
+    -------
+    state : dict
+        same keys as snapshot()
+
+    '''
+    magic = bytes(frame[:4])
+    if magic == KEYFRAME_MAGIC:
+        _, step, width, height, factor, n, avg_trauma = KEYFRAME_HEADER.unpack_from(frame)
+        rh, rw = -(-height // factor), -(-width // factor)
+        offset = KEYFRAME_HEADER.size
+        raster, offset = _read(frame, np.uint8, rh * rw, offset)
+        ids, offset = _read(frame, np.uint32, n, offset)
+        x, offset = _read(frame, np.uint16, n, offset)
+        y, offset = _read(frame, np.uint16, n, offset)
+        trauma, offset = _read(frame, np.uint8, n, offset)
+        return {'step': step, 'width': width, 'height': height, 'factor': factor,
+                'avg_trauma': avg_trauma, 'raster': raster.reshape(rh, rw).copy(),
+                'ids': ids.copy(), 'x': x.copy(), 'y': y.copy(), 'trauma': trauma.copy()}
+
+    if magic != DELTA_MAGIC:
+        raise ValueError('Unknown frame type: %r' % magic)
+    if state is None:
+        raise ValueError('A delta frame can only be decoded on top of a previous state')
+    (_, step, width, height, factor, flags, n_cells, n_updates, n_births, n_deaths,
+     avg_trauma) = DELTA_HEADER.unpack_from(frame)
+    offset = DELTA_HEADER.size
+
+    raster = state['raster'].copy()
+    size = raster.size
+    if flags & CELL_MASK:
+        mask, offset = _read(frame, np.uint8, -(-size // 8), offset)
+        cells = np.flatnonzero(np.unpackbits(mask, count=size, bitorder='little'))
+    else:
+        cells, offset = _read(frame, _cell_index_dtype(size), n_cells, offset)
+    values, offset = _read(frame, np.uint8, n_cells, offset)
+    raster.ravel()[cells] = values
+
+    n_prev = len(state['ids'])
+    mask, offset = _read(frame, np.uint8, -(-n_prev // 8), offset)
+    updated = np.flatnonzero(np.unpackbits(mask, count=n_prev, bitorder='little'))
+    move_dtype = np.int16 if flags & WIDE_MOVES else np.int8
+    dx, offset = _read(frame, move_dtype, n_updates, offset)
+    dy, offset = _read(frame, move_dtype, n_updates, offset)
+    upd_trauma, offset = _read(frame, np.uint8, n_updates, offset)
+    b_ids, offset = _read(frame, np.uint32, n_births, offset)
+    b_x, offset = _read(frame, np.uint16, n_births, offset)
+    b_y, offset = _read(frame, np.uint16, n_births, offset)
+    b_trauma, offset = _read(frame, np.uint8, n_births, offset)
+    deaths, offset = _read(frame, np.uint32, n_deaths, offset)
+
+    x, y, trauma = state['x'].copy(), state['y'].copy(), state['trauma'].copy()
+    x[updated] = x[updated] + dx
+    y[updated] = y[updated] + dy
+    trauma[updated] = upd_trauma
+
+    keep = ~np.isin(state['ids'], deaths, assume_unique=True)
+    ids = np.concatenate([state['ids'][keep], b_ids])
+    order = np.argsort(ids, kind='stable')
+    return {'step': step, 'width': width, 'height': height, 'factor': factor,
+            'avg_trauma': avg_trauma, 'raster': raster, 'ids': ids[order],
+            'x': np.concatenate([x[keep], b_x])[order], 'y': np.concatenate([y[keep], b_y])[order],
+            'trauma': np.concatenate([trauma[keep], b_trauma])[order]}
+
+
+def decode_keyframe(frame):
+    '''
+    Decode a keyframe (see decode_frame).
+    '''
+    return decode_frame(frame)
+
+
+class FrameEncoder:
+    '''
+    Turns a sequence of model states into frames: a keyframe first and then
+    every keyframe_interval frames, delta frames in between.
+    '''
+
+    def __init__(self, keyframe_interval=100, max_raster=256):
+        self.keyframe_interval = keyframe_interval
+        self.max_raster = max_raster
+        self.prev = None
+        self.n = 0
+
+    def encode(self, model):
+        '''
+        Returns (is_keyframe, frame bytes) for the current model state.
+        '''
+        state = snapshot(model, self.max_raster)
+        key = self.prev is None or self.n % self.keyframe_interval == 0
+        frame = keyframe_from_state(state) if key else delta_from_states(self.prev, state)
+        self.prev = state
+        self.n += 1
+        return key, frame
+
+
+# replay files #
+REPLAY_MAGIC = b'TMFR'
+# magic, version, flags, keyframe interval
+REPLAY_HEADER = struct.Struct('<4sHBI')
+REPLAY_VERSION = 1
+# replay file flags
+COMPRESSED = 1
+RECORD_LENGTH = struct.Struct('<I')
+# keyframe index offset, number of keyframes, magic
+REPLAY_FOOTER = struct.Struct('<QI4s')
+INDEX_MAGIC = b'TMFI'
+
+
+class ReplayWriter:
+    '''
+    Records frames of a run to a replay file. Call write(model) after every
+    step you want in the replay and close() when the run is done (which
+    appends the keyframe index used for seeking).
+    '''
+
+    def __init__(self, path, keyframe_interval=100, max_raster=256, compress=True):
+        self.path = path
+        self.encoder = FrameEncoder(keyframe_interval, max_raster)
+        self.compress = compress
+        self.keyframes = []
+        self._f = open(path, 'wb')
+        flags = COMPRESSED if compress else 0
+        self._f.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, flags, keyframe_interval))
+
+    def write(self, model):
+        key, frame = self.encoder.encode(model)
+        if key:
+            self.keyframes.append((model.schedule.steps, self._f.tell()))
+        if self.compress:
+            frame = zlib.compress(frame, 1)
+        self._f.write(RECORD_LENGTH.pack(len(frame)))
+        self._f.write(frame)
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        if self._f.closed:
+            return
+        index_offset = self._f.tell()
+        steps = np.array([k[0] for k in self.keyframes], dtype=np.uint32)
+        offsets = np.array([k[1] for k in self.keyframes], dtype=np.uint64)
+        self._f.write(steps.tobytes())
+        self._f.write(offsets.tobytes())
+        self._f.write(REPLAY_FOOTER.pack(index_offset, len(self.keyframes), INDEX_MAGIC))
+        self._f.close()
+
+
+class ReplayReader:
+    '''
+    Plays back a replay file written by ReplayWriter.
+
+    Iterating over the reader yields the decoded state (same keys as
+    snapshot()) of every recorded frame; seek(step) jumps to the nearest
+    keyframe at or before step and applies deltas from there.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'rb')
+        magic, version, flags, self.keyframe_interval = REPLAY_HEADER.unpack(self._f.read(REPLAY_HEADER.size))
+        if magic != REPLAY_MAGIC:
+            raise ValueError('%s is not a replay file' % path)
+        self.compressed = bool(flags & COMPRESSED)
+        self._end, self.key_steps, self.key_offsets = self._read_index()
+
+    def close(self):
+        self._f.close()
+
+    def _read_index(self):
+        size = os.path.getsize(self.path)
+        if size >= REPLAY_HEADER.size + REPLAY_FOOTER.size:
+            self._f.seek(size - REPLAY_FOOTER.size)
+            index_offset, k, magic = REPLAY_FOOTER.unpack(self._f.read(REPLAY_FOOTER.size))
+            if magic == INDEX_MAGIC:
+                self._f.seek(index_offset)
+                steps = np.frombuffer(self._f.read(4 * k), np.uint32)
+                offsets = np.frombuffer(self._f.read(8 * k), np.uint64)
+                return index_offset, steps, offsets
+        # no index (the writer was not closed): rebuild it by scanning the records
+        steps, offsets = [], []
+        offset = REPLAY_HEADER.size
+        self._f.seek(offset)
+        while True:
+            head = self._f.read(RECORD_LENGTH.size)
+            if len(head) < RECORD_LENGTH.size:
+                break
+            (length,) = RECORD_LENGTH.unpack(head)
+            frame = self._f.read(length)
+            if len(frame) < length:
+                break
+            if self.compressed:
+                frame = zlib.decompress(frame)
+            if frame[:4] == KEYFRAME_MAGIC:
+                steps.append(KEYFRAME_HEADER.unpack_from(frame)[1])
+                offsets.append(offset)
+            offset += RECORD_LENGTH.size + length
+        return offset, np.array(steps, np.uint32), np.array(offsets, np.uint64)
+
+    def _frames_from(self, offset):
+        self._f.seek(offset)
+        while self._f.tell() < self._end:
+            (length,) = RECORD_LENGTH.unpack(self._f.read(RECORD_LENGTH.size))
+            frame = self._f.read(length)
+            yield zlib.decompress(frame) if self.compressed else frame
+
+    def __iter__(self):
+        state = None
+        for frame in self._frames_from(REPLAY_HEADER.size):
+            state = decode_frame(frame, state)
+            yield state
+
+    def seek(self, step):
+        '''
+        Decoded state of the last recorded frame at or before step.
+        '''
+        i = np.searchsorted(self.key_steps, step, side='right') - 1
+        if i < 0:
+            raise ValueError('Step %d is before the first keyframe' % step)
+        state = None
+        for frame in self._frames_from(int(self.key_offsets[i])):
+            magic = bytes(frame[:4])
+            header = KEYFRAME_HEADER if magic == KEYFRAME_MAGIC else DELTA_HEADER
+            if state is not None and header.unpack_from(frame)[1] > step:
+                break
+            state = decode_frame(frame, state)
+        return state
+
+
+def render_rgb(state, scale=10):
+    '''
+    Render a decoded state as an RGB image (y = 0 at the bottom like the
+    mesa canvas), with agents drawn as squares from black (no trauma) to
+    red (max trauma). Used for exporting replays to video.
+    '''
+    palette = np.array([[int(c[i:i + 2], 16) for i in (1, 3, 5)] for c in PALETTE], dtype=np.uint8)
+    # each raster cell covers factor x factor grid cells
+    block = state['factor'] * scale
+    h, w = state['height'] * scale, state['width'] * scale
+    img = palette[state['raster']]
+    img = np.repeat(np.repeat(img, block, axis=0), block, axis=1)[:h, :w].copy()
+    x = state['x'].astype(np.int64) * scale
+    y = state['y'].astype(np.int64) * scale
+    pad = max(1, scale // 5)
+    for i in range(len(x)):
+        img[y[i] + pad:y[i] + scale - pad, x[i] + pad:x[i] + scale - pad] = (state['trauma'][i], 0, 0)
+    return img[::-1]
+
+
+def export_video(replay_path, out_path, fps=30, scale=10):
+    '''
+    Export a replay file to a video with matplotlib's ffmpeg writer.
+    '''
+    # plotting is only loaded when a video is actually exported
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.animation import FFMpegWriter
+
+    reader = ReplayReader(replay_path)
+    first = next(iter(reader))
+    fig = plt.figure(figsize=(first['width'] * scale / 100, first['height'] * scale / 100), dpi=100)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.axis('off')
+    image = ax.imshow(render_rgb(first, scale))
+    writer = FFMpegWriter(fps=fps)
+    with writer.saving(fig, out_path, dpi=100):
+        for state in reader:
+            image.set_data(render_rgb(state, scale))
+            writer.grab_frame()
+    plt.close(fig)
+    reader.close()
@@ -0,0 +1,383 @@
+"""
+Golden traces for checking faster engines against the reference model
+================================
+
+A golden trace is a compact record of one seeded run: every model
+reporter's time series (SsAgent, Trauma and the event counts), the
+milestone markers, and a hash of each part of the model state (landscape,
+agent positions, sugar, trauma, life cycle, epigenetics, random state)
+every hash_every steps. Traces of a set of seeds are recorded once with
+the reference engine and kept in a directory (one .npz file per seed):
+
+    python -m trauma_model_framework.golden record golden/ --seeds 10 --steps 2500
+
+A candidate engine (or any change to SsAgent.move, Sugar.step,
+SugarscapeTMF.step, ...) is then run on the same seeds and compared:
+
+    python -m trauma_model_framework.golden check golden/ --engine numba
+
+which reports the first step at which a run diverges and in which series
+or part of the state. Engines that legitimately draw random numbers
+differently cannot match a trace exactly; for these --statistical
+compares the distributions of the runs instead (two-sample KS tests on
+the post-famine trauma levels plotted by run_and_analyze.py and on
+recovery time and population minimum), and fails if any of them differs
+significantly. Both modes exit with status 1 on failure.
+"""
+
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from .agents import SsAgent
+from .model import SugarscapeTMF
+
+# parts of the model state hashed in a trace, in the order they are checked
+STATE_FIELDS = ('landscape', 'positions', 'sugar', 'trauma', 'life_cycle', 'epigenetics', 'random')
+
+MARKERS = ('steps', 'te_start', 'te_end', 't_recovery', 'trauma_recovery')
+
+# steps after the famine end at which the post-famine trauma levels are
+# compared in the statistical mode
+KS_OFFSETS = tuple(range(0, 801, 50))
+
+Divergence = namedtuple('Divergence', ['seed', 'step', 'field', 'expected', 'actual'])
+
+
+def _canonical(value):
+    # numbers as floats, so an engine writing back 5.0 or np.int64(5) where
+    # the reference has 5 hashes the same (like the == checks of kernels.py)
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value)
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, dict):
+        return sorted((k, _canonical(v)) for k, v in value.items())
+    return value
+
+
+def _digest(value):
+    h = hashlib.blake2b(repr(_canonical(value)).encode(), digest_size=8)
+    return int.from_bytes(h.digest(), 'little')
+
+
+def state_hashes(model):
+    '''
+    Hash of every part of the model state (see STATE_FIELDS).
+
+    Returns
+    -------
+    hashes : dict of int
+        64-bit hash per field
+
+    '''
+    agents = sorted(model.schedule.agents_by_type[SsAgent].values(), key=lambda a: a.unique_id)
+    grid = model.grid
+    return {
+        'landscape': _digest(model.sugar_amounts().ravel().tolist()),
+        # cell order decides who is found first in a cell, so it is state too
+        'positions': _digest([(a.unique_id, a.pos, grid.get_cell_list_contents([a.pos]).index(a))
+                              for a in agents]),
+        'sugar': _digest([(a.sugar, a.max_sugar_hold, a.metabolism, a.vision) for a in agents]),
+        'trauma': _digest([(a.trauma, a.trauma_min, a.trauma_lifemax, a.cortisol) for a in agents]),
+        'life_cycle': _digest([(a.age, a.starvation, a.death, a.sex, a.pregnant, a.pregnancy_countdown,
+                                a.next_birth_sex, a.generation, a.family) for a in agents]),
+        'epigenetics': _digest([(a.epigenetic_symptoms, a.future_epigenetic_symptoms,
+                                 a.epigenetic_lifespan_decrease_prenatal,
+                                 a.epigenetic_lifespan_increase_prepubecent) for a in agents]),
+        'random': _digest(model.random.getstate()[1]),
+    }
+
+
+def record_trace(seed, steps=2500, hash_every=10, engine='python', model_cls=SugarscapeTMF, **model_kwargs):
+    '''
+    Runs the model like run_model does and records its trace.
+
+    Parameters
+    ----------
+    seed : int
+    steps : int
+        step_count of the run (it ends earlier like run_model's)
+    hash_every : int
+        steps between state hashes (0 for none)
+    engine : str
+        engine of the model
+    model_cls : class
+        model class, for engines that are not an engine of SugarscapeTMF
+    **model_kwargs :
+        any other model arguments
+
+    Returns
+    -------
+    trace : dict
+        'meta' (seed, steps, hash_every, engine, model_kwargs), 'series'
+        (array per model reporter), 'markers' and 'hashes' (array of
+        hashes per field, at steps 0, hash_every, 2 * hash_every, ...)
+
+    '''
+    m = model_cls(seed=seed, engine=engine, **model_kwargs)
+    m.set_markers(steps)
+    hashes = {field: [] for field in STATE_FIELDS}
+    for step in range(steps + 1):
+        if hash_every and step % hash_every == 0:
+            for field, h in state_hashes(m).items():
+                hashes[field].append(h)
+        if step == steps or m.end:
+            break
+        m.step()
+    m.events.flush()
+    markers = {'steps': m.schedule.steps, 'te_start': m.te_start, 'te_end': m.te_end,
+               't_recovery': m.t_recovery, 'trauma_recovery': int(m.trauma_recovery)}
+    return {
+        'meta': {'seed': seed, 'steps': steps, 'hash_every': hash_every, 'engine': engine,
+                 'model_kwargs': model_kwargs},
+        'series': {name: np.asarray(vals) for name, vals in m.datacollector.model_vars.items()},
+        'markers': markers,
+        'hashes': {field: np.array(vals, dtype=np.uint64) for field, vals in hashes.items()},
+    }
+
+
+def save_trace(path, trace):
+    arrays = {'meta': json.dumps(trace['meta']), 'markers': json.dumps(trace['markers'])}
+    arrays.update({'series/' + name: vals for name, vals in trace['series'].items()})
+    arrays.update({'hashes/' + field: vals for field, vals in trace['hashes'].items()})
+    np.savez_compressed(path, **arrays)
+
+
+def load_trace(path):
+    with np.load(path) as data:
+        trace = {'meta': json.loads(str(data['meta'])), 'markers': json.loads(str(data['markers'])),
+                 'series': {}, 'hashes': {}}
+        for key in data.files:
+            if '/' in key:
+                kind, name = key.split('/', 1)
+                trace[kind][name] = data[key]
+    return trace
+
+
+def load_traces(directory):
+    '''
+    Golden traces of a directory, ordered by seed.
+    '''
+    traces = [load_trace(path) for path in glob.glob(os.path.join(directory, 'seed-*.npz'))]
+    return sorted(traces, key=lambda trace: trace['meta']['seed'])
+
+
+def _record(args):
+    seed, kwargs = args
+    return record_trace(seed, **kwargs)
+
+
+def record_traces(seeds, processes=1, **kwargs):
+    '''
+    record_trace for every seed, in processes worker processes.
+    '''
+    jobs = [(seed, kwargs) for seed in seeds]
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            return pool.map(_record, jobs)
+    return [_record(job) for job in jobs]
+
+
+def diff_traces(golden, candidate):
+    '''
+    First divergence of candidate from golden: the earliest step at which a
+    reporter series or a state hash differs (state hashes first at the same
+    step, since they say what diverged), or the first differing marker.
+
+    Returns
+    -------
+    divergence : Divergence or None
+        None if the traces are identical. For a state field, step is the
+        first hashed step that differs, so the divergence happened at most
+        hash_every steps before it.
+
+    '''
+    seed = golden['meta']['seed']
+    first = None
+
+    every = golden['meta']['hash_every']
+    if every and every == candidate['meta']['hash_every']:
+        for field in STATE_FIELDS:
+            a, b = golden['hashes'][field], candidate['hashes'][field]
+            n = min(len(a), len(b))
+            diff = np.flatnonzero(a[:n] != b[:n])
+            if len(diff) and (first is None or diff[0] * every < first.step):
+                first = Divergence(seed, int(diff[0]) * every, field, '%016x' % a[diff[0]], '%016x' % b[diff[0]])
+
+    for name, a in golden['series'].items():
+        b = candidate['series'].get(name)
+        if b is None:
+            return Divergence(seed, 0, name, 'series', None)
+        n = min(len(a), len(b))
+        diff = np.flatnonzero(a[:n] != b[:n])
+        # datacollector row i is the state after step i
+        step = int(diff[0]) if len(diff) else (n if len(a) != len(b) else None)
+        if step is not None and (first is None or step < first.step):
+            first = Divergence(seed, step, name,
+                               a[step].item() if step < len(a) else None,
+                               b[step].item() if step < len(b) else None)
+    if first is not None:
+        return first
+
+    for marker in MARKERS:
+        if golden['markers'][marker] != candidate['markers'][marker]:
+            return Divergence(seed, golden['markers']['steps'], marker,
+                              golden['markers'][marker], candidate['markers'][marker])
+    return None
+
+
+def ks_2samp(a, b):
+    '''
+    Two-sample Kolmogorov-Smirnov test.
+
+    Returns
+    -------
+    d : float
+        largest distance between the empirical distribution functions
+    p : float
+        asymptotic p-value of d under the hypothesis that a and b come from
+        the same distribution
+
+    '''
+    a, b = np.sort(a), np.sort(b)
+    pooled = np.concatenate([a, b])
+    cdf_a = np.searchsorted(a, pooled, side='right') / len(a)
+    cdf_b = np.searchsorted(b, pooled, side='right') / len(b)
+    d = float(np.max(np.abs(cdf_a - cdf_b)))
+    en = np.sqrt(len(a) * len(b) / (len(a) + len(b)))
+    lam = (en + 0.12 + 0.11 / en) * d
+    if lam < 1e-3:
+        return d, 1.0
+    k = np.arange(1, 101)
+    p = 2 * np.sum((-1.0) ** (k - 1) * np.exp(-2 * k ** 2 * lam ** 2))
+    return d, float(min(max(p, 0.0), 1.0))
+
+
+def run_summaries(traces):
+    '''
+    Per-run quantities compared in the statistical mode: post-famine trauma
+    levels at every KS_OFFSETS step after the famine end, steps from the
+    famine end to trauma recovery and the population minimum.
+
+    Returns
+    -------
+    samples : dict of lists
+        one value per run (runs too short for an offset are left out)
+
+    '''
+    samples = {'recovery_time': [], 'population_min': []}
+    samples.update({'trauma_post_%d' % offset: [] for offset in KS_OFFSETS})
+    for trace in traces:
+        markers = trace['markers']
+        trauma = trace['series']['Trauma'][markers['te_end']:]
+        for offset in KS_OFFSETS:
+            if offset < len(trauma):
+                samples['trauma_post_%d' % offset].append(float(trauma[offset]))
+        samples['recovery_time'].append(markers['t_recovery'] - markers['te_end'])
+        samples['population_min'].append(int(np.min(trace['series']['SsAgent'])))
+    return samples
+
+
+def compare_statistics(golden, candidate, alpha=0.05):
+    '''
+    KS test of every run summary (see run_summaries) between the golden
+    and the candidate runs.
+
+    Returns
+    -------
+    ok : bool
+        False if any summary differs at level alpha (Bonferroni corrected
+        for the number of summaries tested)
+    rows : list of (name, d, p)
+
+    '''
+    a, b = run_summaries(golden), run_summaries(candidate)
+    rows = [(name, *ks_2samp(a[name], b[name])) for name in a if len(a[name]) > 1 and len(b[name]) > 1]
+    ok = all(p >= alpha / len(rows) for _, _, p in rows)
+    return ok, rows
+
+
+def quantile_bands(traces, quantiles=(0, 0.1, 0.25, 0.5, 0.75, 0.9, 1)):
+    '''
+    Quantiles over runs of the post-famine average trauma level at every
+    step after the famine end (the bands plotted by run_and_analyze.py).
+
+    Returns
+    -------
+    bands : np.ndarray, shape (steps, len(quantiles))
+        steps is 0 if there are no traces or none goes past its famine end
+
+    '''
+    post = [trace['series']['Trauma'][trace['markers']['te_end']:] for trace in traces]
+    bands = np.empty((max((len(p) for p in post), default=0), len(quantiles)))
+    for step in range(len(bands)):
+        bands[step] = np.quantile([p[step] for p in post if len(p) > step], quantiles)
+    return bands
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Record golden traces or check an engine against them')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('record', help='record golden traces of the reference engine')
+    p.add_argument('directory')
+    p.add_argument('--seeds', type=int, default=10, help='record seeds 0..SEEDS-1')
+    p.add_argument('--steps', type=int, default=2500)
+    p.add_argument('--hash-every', type=int, default=10, help='steps between state hashes (0 for none)')
+    p.add_argument('--engine', default='python')
+    p.add_argument('--processes', type=int, default=1)
+
+    p = sub.add_parser('check', help='run an engine on the golden seeds and compare')
+    p.add_argument('directory')
+    p.add_argument('--engine', default='numba')
+    p.add_argument('--statistical', action='store_true',
+                   help='compare distributions over the runs instead of exact traces')
+    p.add_argument('--alpha', type=float, default=0.05)
+    p.add_argument('--processes', type=int, default=1)
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        os.makedirs(args.directory, exist_ok=True)
+        for trace in record_traces(range(args.seeds), args.processes, steps=args.steps,
+                                   hash_every=args.hash_every, engine=args.engine):
+            save_trace(os.path.join(args.directory, 'seed-%d.npz' % trace['meta']['seed']), trace)
+        print('%d traces recorded in %s' % (args.seeds, args.directory))
+        sys.exit(0)
+
+    golden = load_traces(args.directory)
+    if not golden:
+        sys.exit('no golden traces in %s' % args.directory)
+    meta = golden[0]['meta']
+    candidate = record_traces([trace['meta']['seed'] for trace in golden], args.processes,
+                              steps=meta['steps'], engine=args.engine,
+                              hash_every=0 if args.statistical else meta['hash_every'],
+                              **meta['model_kwargs'])
+    if args.statistical:
+        ok, rows = compare_statistics(golden, candidate, args.alpha)
+        for name, d, p in rows:
+            print('%-20s D=%.3f p=%.3f' % (name, d, p))
+        n = min(len(b) for b in (quantile_bands(golden), quantile_bands(candidate)))
+        band_diff = np.abs(quantile_bands(golden)[:n] - quantile_bands(candidate)[:n]).max(axis=0)
+        print('largest quantile band differences:', np.round(band_diff, 3).tolist())
+        print('statistically equivalent' if ok else 'distributions differ')
+    else:
+        ok = True
+        for g, c in zip(golden, candidate):
+            divergence = diff_traces(g, c)
+            if divergence is not None:
+                ok = False
+                print('seed %d: first divergence at step %d in %s (expected %s, got %s)' % divergence)
+        if ok:
+            print('engine %r matches all %d golden traces' % (args.engine, len(golden)))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,105 @@
+"""
+Import time budget of the headless simulation path
+================================
+
+Sweep workers start a fresh Python process per run (or per pool worker),
+so the time it takes to import the model is paid over and over. The
+headless path (model.py, sweep.py and what they import) must not import
+the visualization (mesa, tornado), plotting (matplotlib), pandas, networkx,
+tqdm or the compiled kernel (numba); these are only imported by the code
+that uses them.
+
+This module checks that, and that importing each headless module in a
+fresh interpreter stays within a time budget (the fastest of a few tries,
+to leave out disk cache effects):
+
+    python -m trauma_model_framework.import_budget
+    python -m trauma_model_framework.import_budget --budget 0.5
+
+It exits with status 1 if a check fails, so it can be run before starting
+a sweep or from CI.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+# modules the headless simulation path must be importable without
+HEAVY_MODULES = ('mesa', 'tornado', 'matplotlib', 'pandas', 'networkx', 'tqdm', 'numba', 'scipy')
+
+HEADLESS_MODULES = ('trauma_model_framework.model', 'trauma_model_framework.sweep')
+
+# seconds; importing numpy alone takes about 0.1 s
+DEFAULT_BUDGET = 0.3
+
+_PROBE = '''
+import json, sys, time
+t = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - t
+print(json.dumps({'seconds': elapsed,
+                  'heavy': [m for m in %r if m in sys.modules]}))
+'''
+
+
+def measure_import(module, repeat=3):
+    '''
+    Imports module in fresh interpreters.
+
+    Parameters
+    ----------
+    module : str
+        dotted module name
+    repeat : int
+        number of interpreters started
+
+    Returns
+    -------
+    seconds : float
+        fastest import time
+    heavy : list of str
+        HEAVY_MODULES that were imported along with module
+
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    results = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', _PROBE % (module, HEAVY_MODULES)],
+                             env=env, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    return min(r['seconds'] for r in results), results[0]['heavy']
+
+
+def check_import_budget(budget=DEFAULT_BUDGET, modules=HEADLESS_MODULES, repeat=3):
+    '''
+    Checks every module of the headless path against the time budget and
+    the list of heavy modules. Prints one line per module.
+
+    Returns
+    -------
+    ok : bool
+        True if every module passed
+
+    '''
+    ok = True
+    for module in modules:
+        seconds, heavy = measure_import(module, repeat)
+        passed = seconds <= budget and not heavy
+        ok = ok and passed
+        print('%-4s %-32s %.3f s (budget %.3f s)%s'
+              % ('ok' if passed else 'FAIL', module, seconds, budget,
+                 ', imports ' + ', '.join(heavy) if heavy else ''))
+    return ok
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Check the import time of the headless simulation path')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET, help='seconds per module')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    sys.exit(0 if check_import_budget(args.budget, repeat=args.repeat) else 1)
@@ -0,0 +1,630 @@
+"""
+Compiled activation loop for non-sugar agents
+================================
+
+SsAgent.step has to run agent by agent in the schedule's random order:
+every agent sees the cells claimed, the sugar eaten and the agents killed
+by the ones that went before it. This module runs that whole loop (move,
+eat, reproduce, traumatize, aging and death) as one kernel over flat
+arrays, compiled with Numba when it is installed and run as plain Python
+when it is not.
+
+The kernel draws from the same random stream as the reference agents:
+it works on the Mersenne Twister state of the model's random.Random
+(random.getstate()) and reproduces random(), shuffle() and choice()
+exactly, so a model run with engine='numba' follows the same trajectory
+as one run with engine='python'. check_equivalence compares the two step
+by step.
+
+Anything that is not plain arithmetic stays in Python around the kernel:
+trigger_genes is run for every agent before the loop (the built-in
+triggers only look at generation, age and sex, which other agents cannot
+change during a step), and births, deaths, grid moves, event records and
+epigenetic symptom dicts are applied to the agent objects after it, in
+the order they happened in the kernel.
+"""
+
+import warnings
+
+import numpy as np
+
+from . import events, lineage
+
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+    jit = numba.njit(cache=True)
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def jit(func):
+        return func
+
+
+# columns of the float agent array
+F_SUGAR = 0
+F_MAX_SUGAR_HOLD = 1
+F_TRAUMA = 2
+F_TRAUMA_MIN = 3
+F_TRAUMA_LIFEMAX = 4
+F_CORTISOL = 5
+F_DEATH = 6
+F_PRENATAL = 7      # epigenetic_lifespan_decrease_prenatal
+F_PREPUBECENT = 8   # epigenetic_lifespan_increase_prepubecent
+N_FLOAT = 9
+
+# columns of the integer agent array
+I_ID = 0
+I_X = 1
+I_Y = 2
+I_ORDER = 3         # when the agent was last placed in its cell (cell list order)
+I_ALIVE = 4
+I_METABOLISM = 5
+I_VISION = 6
+I_MOORE = 7
+I_AGE = 8
+I_STARVATION = 9
+I_PREGNANT = 10
+I_COUNTDOWN = 11
+I_GENERATION = 12
+I_FAMILY = 13
+I_NEXT_BIRTH_SEX = 14   # 0 for None, 1 for 'm', 2 for 'f'
+I_CREATED = 15          # epigenetic symptoms created this step (see below)
+N_INT = 16
+
+# bits of I_CREATED
+CREATED_PRENATAL = 1
+CREATED_PREPUBECENT = 2
+
+SEXES = (None, 'm', 'f')
+
+# entries of the trauma parameter array (model.trauma_params, see
+# agents.TRAUMA_PARAMS)
+P_CORTISOL_THRESHOLD = 0
+P_CORTISOL_INCREMENT = 1
+P_CORTISOL_MAX = 2
+P_STARVATION_TRAUMA = 3
+P_CANNIBALIZE = 4
+P_KILL = 5
+P_MUG = 6
+P_CANNIBALIZE_TRAUMA = 7
+P_PRENATAL_STEP = 8
+P_PREPUBECENT_STEP = 9
+P_PRENATAL_CAP = 10
+P_PREPUBECENT_CAP = 11
+PARAM_NAMES = (
+    'offspring_cortisol_threshold', 'offspring_cortisol_increment', 'offspring_cortisol_max',
+    'starvation_trauma', 'cannibalize_prob', 'kill_prob', 'mug_prob', 'cannibalize_trauma',
+    'prenatal_lifespan_step', 'prepubecent_lifespan_step', 'prenatal_lifespan_cap',
+    'prepubecent_lifespan_cap',
+)
+
+
+# Mersenne Twister, as implemented by CPython's random module #
+
+@jit
+def _genrand(mt):
+    '''
+    Next 32 bit output of the generator. mt holds the 624 state words
+    followed by the position in the state, like random.getstate()[1].
+    '''
+    if mt[624] >= 624:
+        for kk in range(624):
+            y = (mt[kk] & 0x80000000) | (mt[(kk + 1) % 624] & 0x7fffffff)
+            v = mt[(kk + 397) % 624] ^ (y >> 1)
+            if y & 1:
+                v ^= 0x9908b0df
+            mt[kk] = v
+        mt[624] = 0
+    y = mt[mt[624]]
+    mt[624] += 1
+    y ^= y >> 11
+    y ^= (y << 7) & 0x9d2c5680
+    y ^= (y << 15) & 0xefc60000
+    y ^= y >> 18
+    return y
+
+
+@jit
+def _random(mt):
+    '''random.random()'''
+    a = _genrand(mt) >> 5
+    b = _genrand(mt) >> 6
+    return (a * 67108864.0 + b) * (1.0 / 9007199254740992.0)
+
+
+@jit
+def _randbelow(mt, n):
+    '''random._randbelow(n) for 0 < n < 2**32'''
+    k = 0
+    while (n >> k) > 0:
+        k += 1
+    r = _genrand(mt) >> (32 - k)
+    while r >= n:
+        r = _genrand(mt) >> (32 - k)
+    return r
+
+
+@jit
+def _shuffle(mt, xs, ys, n):
+    '''random.shuffle over the first n (x, y) pairs'''
+    for i in range(n - 1, 0, -1):
+        j = _randbelow(mt, i + 1)
+        xs[i], xs[j] = xs[j], xs[i]
+        ys[i], ys[j] = ys[j], ys[i]
+
+
+# activation loop #
+
+@jit
+def _place(ia, occ, row, x, y, order):
+    # grid.move_agent: leave the old cell and go to the back of the new one
+    occ[ia[row, I_X], ia[row, I_Y]] -= 1
+    occ[x, y] += 1
+    ia[row, I_X] = x
+    ia[row, I_Y] = y
+    ia[row, I_ORDER] = order
+    return order + 1
+
+
+@jit
+def _record(ev, ev_trauma, k, event_type, actor, target, x, y, trauma):
+    ev[k, 0] = event_type
+    ev[k, 1] = actor
+    ev[k, 2] = target
+    ev[k, 3] = x
+    ev[k, 4] = y
+    ev_trauma[k] = trauma
+    return k + 1
+
+
+@jit
+def _remove(ia, occ, deaths, n_deaths, row, cause):
+    ia[row, I_ALIVE] = 0
+    occ[ia[row, I_X], ia[row, I_Y]] -= 1
+    deaths[n_deaths, 0] = row
+    deaths[n_deaths, 1] = cause
+    return n_deaths + 1
+
+
+@jit
+def activate(fa, ia, n, amount, mt, next_id, order, puberty_age, pregnancy_time, tp,
+             ev, ev_trauma, births, births_f, deaths, eaten):
+    '''
+    Steps agents 0..n-1 of fa/ia in row order, which is their activation
+    order. Newborns are appended after row n (fa and ia need room for n of
+    them) and do not step. amount is the (width, height) sugar array and mt
+    the random state, both changed in place. tp holds the trauma
+    parameters in PARAM_NAMES order.
+
+    Returns
+    -------
+    n_rows, n_events, n_births, n_deaths, n_eaten : int
+        number of rows used in fa/ia and of records written to ev,
+        births, deaths and eaten
+
+    '''
+    width, height = amount.shape
+    occ = np.zeros((width, height), dtype=np.int64)
+    max_vision = 0
+    for i in range(n):
+        if ia[i, I_ALIVE]:
+            occ[ia[i, I_X], ia[i, I_Y]] += 1
+        max_vision = max(max_vision, ia[i, I_VISION])
+    size = (2 * max_vision + 1) ** 2
+    agent_x = np.empty(size, dtype=np.int64)
+    agent_y = np.empty(size, dtype=np.int64)
+    free_x = np.empty(size, dtype=np.int64)
+    free_y = np.empty(size, dtype=np.int64)
+    cand_x = np.empty(size, dtype=np.int64)
+    cand_y = np.empty(size, dtype=np.int64)
+
+    n_rows = n
+    n_events = 0
+    n_births = 0
+    n_deaths = 0
+    n_eaten = 0
+    for i in range(n):
+        if not ia[i, I_ALIVE]:
+            continue
+        x = ia[i, I_X]
+        y = ia[i, I_Y]
+        actor = ia[i, I_ID]
+
+        # move #
+        # neighborhood within vision in grid.get_neighborhood order,
+        # split into cells with and without other non-sugar agents
+        r = ia[i, I_VISION]
+        moore = ia[i, I_MOORE]
+        n_agent = 0
+        n_free = 0
+        for nx in range(max(0, x - r), min(width, x + r + 1)):
+            for ny in range(max(0, y - r), min(height, y + r + 1)):
+                if not moore and abs(nx - x) + abs(ny - y) > r:
+                    continue
+                if nx == x and ny == y:
+                    continue
+                if occ[nx, ny] > 0:
+                    agent_x[n_agent] = nx
+                    agent_y[n_agent] = ny
+                    n_agent += 1
+                else:
+                    free_x[n_free] = nx
+                    free_y[n_free] = ny
+                    n_free += 1
+        free_x[n_free] = x
+        free_y[n_free] = y
+        n_free += 1
+        max_sugar = amount[free_x[0], free_y[0]]
+        for k in range(1, n_free):
+            max_sugar = max(max_sugar, amount[free_x[k], free_y[k]])
+
+        trauma_move = False
+        if n_agent > 0:
+            trauma_move = _random(mt) < fa[i, F_TRAUMA] and max_sugar < ia[i, I_METABOLISM]
+        if trauma_move:
+            _shuffle(mt, agent_x, agent_y, n_agent)
+            px = agent_x[0]
+            py = agent_y[0]
+            # the victim is the non-sugar agent that has been in the cell longest
+            victim = -1
+            for j in range(n_rows):
+                if ia[j, I_ALIVE] and ia[j, I_X] == px and ia[j, I_Y] == py:
+                    if victim < 0 or ia[j, I_ORDER] < ia[victim, I_ORDER]:
+                        victim = j
+            starvation = ia[i, I_STARVATION]
+            trauma = fa[i, F_TRAUMA]
+            if starvation > 15 and _random(mt) < trauma * tp[P_CANNIBALIZE]:
+                n_events = _record(ev, ev_trauma, n_events, events.CANNIBALIZE, actor,
+                                   ia[victim, I_ID], px, py, trauma)
+                n_deaths = _remove(ia, occ, deaths, n_deaths, victim, lineage.CANNIBALIZED)
+                fa[i, F_SUGAR] += fa[victim, F_SUGAR] + 5
+                fa[i, F_TRAUMA] += tp[P_CANNIBALIZE_TRAUMA]
+            elif starvation > 5 and _random(mt) < trauma * tp[P_KILL]:
+                n_events = _record(ev, ev_trauma, n_events, events.KILL, actor,
+                                   ia[victim, I_ID], px, py, trauma)
+                n_deaths = _remove(ia, occ, deaths, n_deaths, victim, lineage.KILLED)
+                fa[i, F_SUGAR] += fa[victim, F_SUGAR]
+            elif starvation <= 5 and _random(mt) < trauma * tp[P_MUG]:
+                n_events = _record(ev, ev_trauma, n_events, events.MUG, actor,
+                                   ia[victim, I_ID], px, py, trauma)
+                give = float(int(fa[victim, F_SUGAR] * 1.0))
+                fa[victim, F_SUGAR] = 0.0
+                fa[i, F_SUGAR] += give
+            order = _place(ia, occ, i, px, py, order)
+        elif max_sugar == 0:
+            _shuffle(mt, free_x, free_y, n_free)
+            order = _place(ia, occ, i, free_x[0], free_y[0], order)
+        else:
+            # nearest of the cells with the most sugar
+            n_cand = 0
+            min_dist = np.inf
+            for k in range(n_free):
+                if amount[free_x[k], free_y[k]] == max_sugar:
+                    dist = np.sqrt((x - free_x[k]) ** 2 + (y - free_y[k]) ** 2)
+                    if dist < min_dist:
+                        min_dist = dist
+                        n_cand = 0
+                    if dist == min_dist:
+                        cand_x[n_cand] = free_x[k]
+                        cand_y[n_cand] = free_y[k]
+                        n_cand += 1
+            _shuffle(mt, cand_x, cand_y, n_cand)
+            order = _place(ia, occ, i, cand_x[0], cand_y[0], order)
+        x = ia[i, I_X]
+        y = ia[i, I_Y]
+
+        # eat #
+        if fa[i, F_SUGAR] < fa[i, F_MAX_SUGAR_HOLD]:
+            fa[i, F_SUGAR] = max(0.0, fa[i, F_SUGAR] - ia[i, I_METABOLISM] + amount[x, y])
+            amount[x, y] = 0
+            eaten[n_eaten] = x * height + y
+            n_eaten += 1
+        else:
+            fa[i, F_SUGAR] = fa[i, F_SUGAR] - ia[i, I_METABOLISM]
+        if fa[i, F_SUGAR] == 0:
+            ia[i, I_STARVATION] += 1
+        else:
+            ia[i, I_STARVATION] = 0
+
+        # reproduce #
+        pr = 0.005 + 0.015 * fa[i, F_SUGAR] / fa[i, F_MAX_SUGAR_HOLD]
+        if fa[i, F_SUGAR] == fa[i, F_MAX_SUGAR_HOLD]:
+            pr = pr + 0.01
+        if _random(mt) < pr and ia[i, I_AGE] > puberty_age and not ia[i, I_PREGNANT]:
+            ia[i, I_PREGNANT] = 1
+            n_events = _record(ev, ev_trauma, n_events, events.PREGNANCY, actor, -1,
+                               x, y, fa[i, F_TRAUMA])
+        if ia[i, I_COUNTDOWN] == 0:
+            ia[i, I_COUNTDOWN] = pregnancy_time
+            ia[i, I_PREGNANT] = 0
+            lifemax = fa[i, F_TRAUMA_LIFEMAX]
+            if lifemax >= tp[P_CORTISOL_THRESHOLD]:
+                cortisol_offspring = fa[i, F_CORTISOL] * (1 - lifemax)
+            else:
+                cortisol_offspring = min(fa[i, F_CORTISOL] + tp[P_CORTISOL_INCREMENT], tp[P_CORTISOL_MAX])
+            fa[i, F_SUGAR] = float(int(fa[i, F_SUGAR] * .5))
+
+            c = n_rows
+            n_rows += 1
+            fa[c, :] = 0.0
+            ia[c, :] = 0
+            fa[c, F_SUGAR] = float(int(fa[i, F_SUGAR] * .5))
+            fa[c, F_TRAUMA] = fa[i, F_TRAUMA] * 0.5
+            fa[c, F_TRAUMA_MIN] = lifemax / 2
+            fa[c, F_CORTISOL] = cortisol_offspring
+            ia[c, I_ID] = next_id
+            next_id += 1
+            ia[c, I_X] = x
+            ia[c, I_Y] = y
+            ia[c, I_ORDER] = order
+            order += 1
+            ia[c, I_ALIVE] = 1
+            ia[c, I_COUNTDOWN] = pregnancy_time
+            ia[c, I_GENERATION] = ia[i, I_GENERATION] + 1
+            ia[c, I_FAMILY] = ia[i, I_FAMILY]
+            occ[x, y] += 1
+            births[n_births, 0] = i
+            births[n_births, 1] = c
+            births[n_births, 2] = ia[i, I_NEXT_BIRTH_SEX]
+            births_f[n_births, 0] = fa[i, F_TRAUMA]
+            births_f[n_births, 1] = fa[c, F_SUGAR]
+            n_births += 1
+            ia[i, I_NEXT_BIRTH_SEX] = 0
+            n_events = _record(ev, ev_trauma, n_events, events.BIRTH, actor, ia[c, I_ID],
+                               x, y, fa[i, F_TRAUMA])
+        if ia[i, I_PREGNANT]:
+            ia[i, I_COUNTDOWN] -= 1
+
+        # traumatize #
+        if ia[i, I_STARVATION] > 0:
+            fa[i, F_TRAUMA] = max(fa[i, F_TRAUMA] + tp[P_STARVATION_TRAUMA], 1.0)
+            if ia[i, I_AGE] <= puberty_age:
+                fa[i, F_PREPUBECENT] = min(fa[i, F_PREPUBECENT] + tp[P_PREPUBECENT_STEP], tp[P_PREPUBECENT_CAP])
+                ia[i, I_CREATED] |= CREATED_PREPUBECENT
+            if ia[i, I_PREGNANT]:
+                fa[i, F_PRENATAL] = min(fa[i, F_PRENATAL] + tp[P_PRENATAL_STEP], tp[P_PRENATAL_CAP])
+                ia[i, I_NEXT_BIRTH_SEX] = 1 + _randbelow(mt, 2)
+                ia[i, I_CREATED] |= CREATED_PRENATAL
+        else:
+            fa[i, F_TRAUMA] *= 1 - fa[i, F_CORTISOL]
+        fa[i, F_TRAUMA] = max(min(fa[i, F_TRAUMA], 1.0), fa[i, F_TRAUMA_MIN])
+        if fa[i, F_TRAUMA] > fa[i, F_TRAUMA_LIFEMAX]:
+            fa[i, F_TRAUMA_LIFEMAX] = fa[i, F_TRAUMA]
+
+        # age and death #
+        ia[i, I_AGE] += 1
+        if ia[i, I_STARVATION] > 20:
+            n_events = _record(ev, ev_trauma, n_events, events.STARVATION_DEATH, actor, -1,
+                               x, y, fa[i, F_TRAUMA])
+            n_deaths = _remove(ia, occ, deaths, n_deaths, i, lineage.STARVATION)
+        elif ia[i, I_AGE] > fa[i, F_DEATH]:
+            n_events = _record(ev, ev_trauma, n_events, events.OLD_AGE_DEATH, actor, -1,
+                               x, y, fa[i, F_TRAUMA])
+            n_deaths = _remove(ia, occ, deaths, n_deaths, i, lineage.OLD_AGE)
+
+    return n_rows, n_events, n_births, n_deaths, n_eaten
+
+
+# glue between the kernel and the model's agent objects #
+
+def step_agents(model):
+    '''
+    Replacement for model.schedule.step_type(SsAgent): shuffles the agents
+    like the scheduler does, runs trigger_genes, steps everyone in the
+    kernel and applies the results to the agent objects, grid, schedule,
+    event log and lineage table.
+    '''
+    from .agents import SsAgent
+
+    by_id = model.schedule.agents_by_type[SsAgent]
+    keys = list(by_id.keys())
+    model.random.shuffle(keys)
+    agents = [by_id[k] for k in keys]
+    n = len(agents)
+    if n == 0:
+        return
+    for agent in agents:
+        if agent.epigenetic_symptoms:
+            agent.trigger_genes()
+
+    grid = model.grid
+    fa = np.zeros((2 * n, N_FLOAT))
+    ia = np.zeros((2 * n, N_INT), dtype=np.int64)
+    fa[:n, F_SUGAR] = [a.sugar for a in agents]
+    fa[:n, F_MAX_SUGAR_HOLD] = [a.max_sugar_hold for a in agents]
+    fa[:n, F_TRAUMA] = [a.trauma for a in agents]
+    fa[:n, F_TRAUMA_MIN] = [a.trauma_min for a in agents]
+    fa[:n, F_TRAUMA_LIFEMAX] = [a.trauma_lifemax for a in agents]
+    fa[:n, F_CORTISOL] = [a.cortisol for a in agents]
+    fa[:n, F_DEATH] = [a.death for a in agents]
+    fa[:n, F_PRENATAL] = [a.epigenetic_lifespan_decrease_prenatal for a in agents]
+    fa[:n, F_PREPUBECENT] = [a.epigenetic_lifespan_increase_prepubecent for a in agents]
+    ia[:n, I_ID] = keys
+    ia[:n, I_X] = [a.pos[0] for a in agents]
+    ia[:n, I_Y] = [a.pos[1] for a in agents]
+    # position of each agent in its cell list; only the order within a cell matters
+    ia[:n, I_ORDER] = [grid.get_cell_list_contents([a.pos]).index(a) for a in agents]
+    ia[:n, I_ALIVE] = 1
+    ia[:n, I_METABOLISM] = [a.metabolism for a in agents]
+    ia[:n, I_VISION] = [a.vision for a in agents]
+    ia[:n, I_MOORE] = [a.moore for a in agents]
+    ia[:n, I_AGE] = [a.age for a in agents]
+    ia[:n, I_STARVATION] = [a.starvation for a in agents]
+    ia[:n, I_PREGNANT] = [a.pregnant for a in agents]
+    ia[:n, I_COUNTDOWN] = [a.pregnancy_countdown for a in agents]
+    ia[:n, I_GENERATION] = [a.generation for a in agents]
+    ia[:n, I_FAMILY] = [a.family for a in agents]
+    ia[:n, I_NEXT_BIRTH_SEX] = [SEXES.index(a.next_birth_sex) for a in agents]
+
+    sugar_cells = model.sugar_cells
+    amount = np.array([cell.amount for cell in sugar_cells], dtype=np.float64)
+    amount = amount.reshape(model.width, model.height)
+    state = model.random.getstate()
+    mt = np.array(state[1], dtype=np.int64)
+
+    order0 = 1 << 40
+    ev = np.empty((4 * n, 5), dtype=np.int64)
+    ev_trauma = np.empty(4 * n)
+    births = np.empty((n, 3), dtype=np.int64)
+    births_f = np.empty((n, 2))
+    deaths = np.empty((2 * n, 2), dtype=np.int64)
+    eaten = np.empty(n, dtype=np.int64)
+    tp = np.array([model.trauma_params[name] for name in PARAM_NAMES], dtype=np.float64)
+    n_rows, n_events, n_births, n_deaths, n_eaten = activate(
+        fa, ia, n, amount, mt, model.agent_id, order0, SsAgent.puberty_age,
+        SsAgent.pregnancy_time, tp, ev, ev_trauma, births, births_f, deaths, eaten)
+    model.random.setstate((state[0], tuple(mt.tolist()), state[2]))
+
+    step = model.schedule.steps
+    for cell in set(eaten[:n_eaten].tolist()):
+        sugar_cells[cell].amount = 0
+    model.events.record_many(step, ev[:n_events, 0], ev[:n_events, 1], ev[:n_events, 2],
+                             ev[:n_events, 3], ev[:n_events, 4], ev_trauma[:n_events])
+
+    # moves and births, in the order agents were put at the back of their cells
+    rows = agents + [None] * (n_rows - n)
+    birth_of = {int(c): b for b, c in enumerate(births[:n_births, 1])}
+    moved = np.flatnonzero((ia[:n_rows, I_ORDER] >= order0) &
+                           ((ia[:n_rows, I_ALIVE] == 1) | (np.arange(n_rows) >= n)))
+    for row in moved[np.argsort(ia[moved, I_ORDER])].tolist():
+        pos = (int(ia[row, I_X]), int(ia[row, I_Y]))
+        if row < n:
+            grid.move_agent(rows[row], pos)
+            continue
+        b = birth_of[row]
+        parent = rows[births[b, 0]]
+        rows[row], = model.spawn_agents(
+            1, pos=pos, parent=parent,
+            sugar=int(births_f[b, 1]), trauma=births_f[b, 0],
+            trauma_min=fa[row, F_TRAUMA_MIN], cortisol=fa[row, F_CORTISOL],
+            generation=parent.generation, family=parent.family,
+            sex=SEXES[births[b, 2]],
+            epigenetic_symptoms=parent.epigenetic_symptoms + parent.get_epigenetics_for_birth(),
+        )
+
+    # state of the agents that stepped (newborns can only have been mugged)
+    for row in range(n, n_rows):
+        rows[row].sugar = int(fa[row, F_SUGAR])
+    fl = fa[:n].tolist()
+    il = ia[:n].tolist()
+    for agent, f, i in zip(agents, fl, il):
+        agent.sugar = f[F_SUGAR]
+        agent.trauma = f[F_TRAUMA]
+        agent.trauma_lifemax = f[F_TRAUMA_LIFEMAX]
+        agent.age = i[I_AGE]
+        agent.starvation = i[I_STARVATION]
+        agent.pregnant = bool(i[I_PREGNANT])
+        agent.pregnancy_countdown = i[I_COUNTDOWN]
+        agent.next_birth_sex = SEXES[i[I_NEXT_BIRTH_SEX]]
+        created = i[I_CREATED]
+        if created & CREATED_PREPUBECENT:
+            agent.epigenetic_lifespan_increase_prepubecent = f[F_PREPUBECENT]
+            agent.future_epigenetic_symptoms['prepubecent1'] = [
+                {'generation': agent.generation + 2, 'age': 0},
+                ['prepubescent_trauma_express', f[F_PREPUBECENT]]]
+        if created & CREATED_PRENATAL:
+            agent.epigenetic_lifespan_decrease_prenatal = f[F_PRENATAL]
+            agent.future_epigenetic_symptoms['prenatal1'] = [
+                {'generation': agent.generation + 3, 'age': 0, 'sex': agent.next_birth_sex},
+                ['prenatal_trauma_express', f[F_PRENATAL]]]
+
+    for row, cause in deaths[:n_deaths].tolist():
+        rows[row].die(cause)
+
+
+# equivalence with the reference SsAgent implementation #
+
+def _model_state(model):
+    from .agents import SsAgent
+
+    grid = model.grid
+    agents = []
+    for key, a in model.schedule.agents_by_type[SsAgent].items():
+        agents.append((
+            key, a.pos, grid.get_cell_list_contents([a.pos]).index(a), a.sugar, a.trauma,
+            a.trauma_min, a.trauma_lifemax, a.cortisol, a.max_sugar_hold, a.metabolism,
+            a.vision, a.sex, a.age, a.starvation, a.death, a.pregnant, a.pregnancy_countdown,
+            a.next_birth_sex, a.generation, a.family, a.epigenetic_lifespan_decrease_prenatal,
+            a.epigenetic_lifespan_increase_prepubecent, a.epigenetic_symptoms,
+            list(a.future_epigenetic_symptoms.items()), a.lineage_row,
+        ))
+    return {
+        'agents': agents,
+        'sugar': model.sugar_amounts().tolist(),
+        'random': model.random.getstate(),
+        'events': model.events.events().tolist(),
+        'lineage': {col: getattr(model.lineage, col).tobytes() for col in model.lineage._data},
+        'reporters': {key: vals[-1] for key, vals in model.datacollector.model_vars.items()},
+    }
+
+
+def check_equivalence(steps=300, seed=1, **model_kwargs):
+    '''
+    Runs the model with engine='python' and engine='numba' side by side and
+    compares everything the agents touch after every step: agent state and
+    cell order, sugar, the random state, events, lineage and reporters.
+
+    Returns
+    -------
+    mismatch : (int, str) or None
+        first step and part of the state that differ, None if the runs
+        are identical
+
+    '''
+    from .model import SugarscapeTMF
+
+    # the random stream itself first
+    rng = np.random.default_rng(seed)
+    import random
+    ref = random.Random(seed)
+    mt = np.array(ref.getstate()[1], dtype=np.int64)
+    for n in rng.integers(1, 200, 1000).tolist():
+        if ref.random() != _random(mt) or ref._randbelow(n) != _randbelow(mt, n):
+            return (-1, 'random')
+    xs = np.arange(50, dtype=np.int64)
+    expected = list(range(50))
+    ref.shuffle(expected)
+    _shuffle(mt, xs, xs.copy(), 50)
+    if xs.tolist() != expected:
+        return (-1, 'shuffle')
+
+    reference = SugarscapeTMF(seed=seed, engine='python', **model_kwargs)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        kernel = SugarscapeTMF(seed=seed, engine='numba', **model_kwargs)
+    # without numba the model falls back to the agents; the kernel is still
+    # checked, uncompiled
+    kernel.engine = 'numba'
+    for model in (reference, kernel):
+        model.set_markers(steps)
+    for step in range(steps + 1):
+        a = _model_state(reference)
+        b = _model_state(kernel)
+        for part in a:
+            if a[part] != b[part]:
+                return (step, part)
+        if reference.end or step == steps:
+            break
+        reference.step()
+        kernel.step()
+    return None
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description=check_equivalence.__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if not NUMBA_AVAILABLE:
+        warnings.warn('numba is not installed, checking the uncompiled kernel')
+    t = time.perf_counter()
+    mismatch = check_equivalence(args.steps, args.seed)
+    if mismatch is None:
+        print('engines identical over %d steps (%.1f s)' % (args.steps, time.perf_counter() - t))
+    else:
+        print('engines differ at step %d: %s' % mismatch)
+        raise SystemExit(1)
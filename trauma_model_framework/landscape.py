@@ -0,0 +1,235 @@
+"""
+Read-only base landscape shared between runs and worker processes
+================================
+
+Everything about the sugar landscape that is the same for every run on a
+map: the max sugar capacity of every cell (sugar-map.txt or a generated
+map) and the von Neumann neighborhood tables of every vision radius (the
+cells an agent at each cell sees, in grid.get_neighborhood order). Only
+the sugar amounts change during a run, and those stay with each model's
+Sugar agents.
+
+A process that runs many models (e.g. a sweep worker) loads the default
+map once instead of once per model. Processes on the same host can share
+a single copy of a landscape through multiprocessing.shared_memory: one
+process publishes it and the others attach to it by name without copying,
+which is what sweep.work_processes does for its workers:
+
+    with Landscape.from_file('big-map.txt').publish() as shared:
+        # in any process on this host, while the block is published
+        m = SugarscapeTMF(landscape=shared.name)
+"""
+
+import os
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+DEFAULT_MAP = os.path.join(os.path.dirname(__file__), "sugar-map.txt")
+
+# agents see at most this far (SsAgent vision is drawn from 1 to 5)
+MAX_VISION = 5
+
+# first header word of a published landscape block
+_MAGIC = 0x544D464C
+
+# landscapes loaded or attached by this process, so each is set up once
+_loaded = {}
+
+
+def neighborhood_table(width, height, radius):
+    '''
+    Von Neumann neighborhoods (center excluded) of every cell of a
+    non-toroidal width x height grid, in grid.get_neighborhood order.
+
+    Returns
+    -------
+    offsets : np.ndarray of int64, shape (width * height + 1,)
+        the neighbors of cell x * height + y are cells[offsets[c]:offsets[c + 1]]
+    cells : np.ndarray of int64
+        neighbor cells as x * height + y
+
+    '''
+    # relative positions in x then y order, shared by every cell
+    d = np.arange(-radius, radius + 1)
+    dx, dy = np.meshgrid(d, d, indexing='ij')
+    keep = (np.abs(dx) + np.abs(dy) <= radius) & ((dx != 0) | (dy != 0))
+    dx, dy = dx[keep], dy[keep]
+
+    x, y = np.divmod(np.arange(width * height), height)
+    nx = x[:, None] + dx[None, :]
+    ny = y[:, None] + dy[None, :]
+    inside = (nx >= 0) & (nx < width) & (ny >= 0) & (ny < height)
+    offsets = np.zeros(width * height + 1, dtype=np.int64)
+    np.cumsum(inside.sum(axis=1), out=offsets[1:])
+    cells = (nx * height + ny)[inside].astype(np.int64)
+    return offsets, cells
+
+
+class Landscape:
+    '''
+    Max sugar capacity of every cell and neighborhood tables for vision
+    radii 1 to max_vision. The arrays are read-only; they may live in a
+    shared memory block (see publish and attach).
+
+    Parameters
+    ----------
+    max_sugar : array of shape (width, height)
+        max sugar capacity of every cell, [0, 0] being the bottom-left cell
+    max_vision : int
+        largest radius neighborhood tables are made for
+
+    '''
+
+    def __init__(self, max_sugar, max_vision=MAX_VISION, tables=None, shm=None, owner=False):
+        self.max_sugar = max_sugar
+        self.width, self.height = max_sugar.shape
+        self.max_vision = max_vision
+        if tables is None:
+            tables = {r: neighborhood_table(self.width, self.height, r)
+                      for r in range(1, max_vision + 1)}
+        self.tables = tables
+        for array in (max_sugar, *(a for table in tables.values() for a in table)):
+            array.flags.writeable = False
+        self._shm = shm
+        self._owner = owner
+        # neighborhoods as (x, y) tuples, built on first use and shared by
+        # every model of this process on this landscape
+        self._neighborhoods = {}
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_MAP, max_vision=MAX_VISION):
+        '''
+        Landscape of a whitespace separated text file of max sugar values
+        (one line per x, one column per y, like sugar-map.txt).
+        '''
+        return cls(np.genfromtxt(path), max_vision)
+
+    @classmethod
+    def default(cls):
+        '''
+        The landscape of sugar-map.txt, loaded once per process.
+        '''
+        if DEFAULT_MAP not in _loaded:
+            _loaded[DEFAULT_MAP] = cls.from_file(DEFAULT_MAP)
+        return _loaded[DEFAULT_MAP]
+
+    @property
+    def name(self):
+        '''
+        Name of the shared memory block holding this landscape (None if it
+        is not shared).
+        '''
+        return self._shm.name if self._shm is not None else None
+
+    def neighborhood(self, pos, radius):
+        '''
+        Von Neumann neighborhood of pos (center excluded) as a tuple of
+        (x, y), in grid.get_neighborhood order. Made once per cell and
+        radius for the whole process, not once per model.
+        '''
+        key = (pos, radius)
+        neighborhood = self._neighborhoods.get(key)
+        if neighborhood is None:
+            offsets, cells = self.tables[radius]
+            c = pos[0] * self.height + pos[1]
+            neighborhood = tuple(divmod(cell, self.height)
+                                 for cell in cells[offsets[c]:offsets[c + 1]].tolist())
+            self._neighborhoods[key] = neighborhood
+        return neighborhood
+
+    def publish(self, name=None):
+        '''
+        Copies this landscape into a new shared memory block that other
+        processes on this host can attach to by name (see attach). The
+        returned landscape owns the block: closing it (or leaving its with
+        block) unlinks the block, so it has to stay open while others use it.
+
+        Returns
+        -------
+        shared : Landscape
+            the same landscape, backed by the shared memory block
+
+        '''
+        header = np.array([_MAGIC, self.width, self.height, self.max_vision], dtype=np.int64)
+        arrays = [header, self.max_sugar.astype(np.float64)]
+        for r in range(1, self.max_vision + 1):
+            arrays.extend(self.tables[r])
+        shm = shared_memory.SharedMemory(name=name, create=True, size=sum(a.nbytes for a in arrays))
+        start = 0
+        for a in arrays:
+            np.ndarray(a.shape, a.dtype, shm.buf, start)[:] = a
+            start += a.nbytes
+        shared = self._from_block(shm, owner=True)
+        # models of this process given the name use it too
+        _loaded[shm.name] = shared
+        return shared
+
+    @classmethod
+    def attach(cls, name):
+        '''
+        Landscape published by another process as shared memory block name.
+        Attached once per process; the arrays are views of the block, not
+        copies.
+        '''
+        if name not in _loaded:
+            _loaded[name] = cls._from_block(_open_block(name), owner=False)
+        return _loaded[name]
+
+    @classmethod
+    def _from_block(cls, shm, owner):
+        header = np.ndarray(4, np.int64, shm.buf)
+        magic, width, height, max_vision = header.tolist()
+        if magic != _MAGIC:
+            raise ValueError('shared memory block %r is not a published landscape' % shm.name)
+        start = header.nbytes
+        max_sugar = np.ndarray((width, height), np.float64, shm.buf, start)
+        start += max_sugar.nbytes
+        tables = {}
+        for r in range(1, max_vision + 1):
+            offsets = np.ndarray(width * height + 1, np.int64, shm.buf, start)
+            start += offsets.nbytes
+            cells = np.ndarray(int(offsets[-1]), np.int64, shm.buf, start)
+            start += cells.nbytes
+            tables[r] = (offsets, cells)
+        return cls(max_sugar, max_vision, tables, shm, owner)
+
+    def close(self):
+        '''
+        Releases the shared memory block (and unlinks it if this landscape
+        published it). Models using the landscape must not be stepped after.
+        '''
+        if self._shm is None:
+            return
+        shm, self._shm = self._shm, None
+        # drop the views of the block before closing it
+        self.max_sugar = self.tables = None
+        self._neighborhoods = {}
+        _loaded.pop(shm.name, None)
+        try:
+            shm.close()
+        except BufferError:
+            # views of the block are still referenced somewhere; the mapping
+            # is released together with them
+            pass
+        if self._owner:
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _open_block(name):
+    # only the publishing process may unlink a block; before Python 3.13
+    # attaching registers the block with this process's resource tracker,
+    # which would unlink it when an unrelated attaching process exits, so
+    # the registration is taken back right after attaching
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    shm = shared_memory.SharedMemory(name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
@@ -0,0 +1,286 @@
+"""
+Lineage tracking for the trauma model framework
+================================
+
+Append-only table of parent -> child edges that is filled in as agents are
+born and die, so descendants of famine-exposed agents can be followed after
+a run without collecting per-agent data every step.
+"""
+
+import numpy as np
+
+# cause of death codes stored in the "cause" column
+ALIVE = 0
+STARVATION = 1
+OLD_AGE = 2
+KILLED = 3
+CANNIBALIZED = 4
+
+CAUSE_NAMES = {
+    ALIVE: 'alive',
+    STARVATION: 'starvation',
+    OLD_AGE: 'old age',
+    KILLED: 'killed',
+    CANNIBALIZED: 'cannibalized',
+}
+
+
+class LineageTable:
+    '''
+    Compact lineage store made of preallocated NumPy columns. Rows are appended
+    in birth order (which is also unique_id order, since the model hands out
+    ids incrementally) and the arrays double in size when they are full.
+
+    Each row holds:
+        child_id, parent_id (-1 for the initial population), family and
+        generation at birth, birth_step, death_step (-1 while alive),
+        cause (see the cause of death codes above), trauma_birth and
+        trauma_death.
+    '''
+
+    columns = {
+        'child_id': np.int64,
+        'parent_id': np.int64,
+        'family': np.int64,
+        'generation': np.int32,
+        'birth_step': np.int32,
+        'death_step': np.int32,
+        'cause': np.int8,
+        'trauma_birth': np.float32,
+        'trauma_death': np.float32,
+    }
+
+    def __init__(self, capacity=1024):
+        self.n = 0
+        self._data = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.columns.items()}
+
+    def __len__(self):
+        return self.n
+
+    def __getattr__(self, name):
+        # expose the filled part of each column as a read-only-by-convention view,
+        # e.g. table.birth_step
+        data = self.__dict__.get('_data')
+        if data is not None and name in data:
+            return data[name][:self.n]
+        raise AttributeError(name)
+
+    def _grow(self):
+        for name, arr in self._data.items():
+            new = np.empty(2 * len(arr), dtype=arr.dtype)
+            new[:self.n] = arr[:self.n]
+            self._data[name] = new
+
+    def record_birth(self, agent, parent_id, step):
+        '''
+        Append a row for a newly created agent.
+
+        Parameters
+        ----------
+        agent : SsAgent
+            the agent that was just added to the model
+        parent_id : int
+            unique_id of the parent, or -1 for the initial population
+        step : int
+            schedule step during which the agent was born
+
+        Returns
+        -------
+        row : int
+            row index of the agent in the table (stored on the agent so its
+            death can be recorded without a lookup)
+
+        '''
+        if self.n == len(self._data['child_id']):
+            self._grow()
+        row = self.n
+        d = self._data
+        d['child_id'][row] = agent.unique_id
+        d['parent_id'][row] = parent_id
+        d['family'][row] = agent.family
+        d['generation'][row] = agent.generation
+        d['birth_step'][row] = step
+        d['death_step'][row] = -1
+        d['cause'][row] = ALIVE
+        d['trauma_birth'][row] = agent.trauma
+        d['trauma_death'][row] = np.nan
+        self.n += 1
+        return row
+
+    def record_death(self, row, step, cause, trauma):
+        '''
+        Fill in the death columns of an existing row.
+
+        Parameters
+        ----------
+        row : int
+            row returned by record_birth
+        step : int
+            schedule step during which the agent died
+        cause : int
+            one of the cause of death codes of this module
+        trauma : float
+            trauma level of the agent when it died
+
+        Returns
+        -------
+        None.
+
+        '''
+        d = self._data
+        d['death_step'][row] = step
+        d['cause'][row] = cause
+        d['trauma_death'][row] = trauma
+
+    # queries #
+    def rows_of(self, ids):
+        '''
+        Row index for each unique_id in ids (-1 if the id is not in the table).
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.n == 0:
+            return np.full(ids.shape, -1, dtype=np.int64)
+        child_id = self.child_id
+        rows = np.searchsorted(child_id, ids).clip(0, self.n - 1)
+        return np.where(child_id[rows] == ids, rows, -1)
+
+    def alive_at(self, step):
+        '''
+        Boolean mask of the rows that were alive at the end of the given step.
+        '''
+        death_step = self.death_step
+        return (self.birth_step <= step) & ((death_step < 0) | (death_step > step))
+
+    def founder_of(self, ancestor_ids):
+        '''
+        For every row, find which of the given ancestors it descends from
+        (an ancestor is counted as its own descendant). This is done with
+        vectorized pointer jumping up the parent column, so it takes a
+        number of passes proportional to the log of the lineage depth.
+
+        Parameters
+        ----------
+        ancestor_ids : array-like of int
+            unique_ids of the agents to treat as the roots of family trees,
+            e.g. all agents alive when the famine started
+
+        Returns
+        -------
+        founder : np.ndarray of int64
+            unique_id of the ancestor each row descends from, or -1
+
+        '''
+        anc_rows = self.rows_of(ancestor_ids)
+        anc_rows = anc_rows[anc_rows >= 0]
+
+        root = np.full(self.n, -1, dtype=np.int64)
+        root[anc_rows] = anc_rows
+        up = self.rows_of(self.parent_id)
+        up[anc_rows] = -1
+
+        pending = np.flatnonzero((root < 0) & (up >= 0))
+        while pending.size:
+            parent = up[pending]
+            resolved = root[parent]
+            root[pending] = resolved
+            # rows whose parent is not resolved yet jump to the parent's pointer
+            up[pending] = np.where(resolved < 0, up[parent], -1)
+            pending = pending[(resolved < 0) & (up[pending] >= 0)]
+
+        return np.where(root >= 0, self.child_id[np.maximum(root, 0)], -1)
+
+    def family_survival(self, ancestor_ids, step=None):
+        '''
+        Family level survival statistics for the descendants of the given
+        ancestors, computed with bincount group-bys.
+
+        Parameters
+        ----------
+        ancestor_ids : array-like of int
+            unique_ids of the family founders
+        step : int, optional
+            step to count survivors at (default: end of the recorded run)
+
+        Returns
+        -------
+        stats : dict of np.ndarray
+            keyed by 'founder', 'descendants', 'alive', 'max_generation'
+            and one entry per cause of death name, each with one value per
+            founder (in the order of np.unique(ancestor_ids))
+
+        '''
+        founders = np.unique(np.asarray(ancestor_ids, dtype=np.int64))
+        founder = self.founder_of(founders)
+        member = founder >= 0
+        group = np.searchsorted(founders, founder[member])
+        k = len(founders)
+
+        if step is None:
+            alive = self.death_step[member] < 0
+        else:
+            alive = self.alive_at(step)[member]
+
+        max_gen = np.full(k, -1, dtype=np.int64)
+        np.maximum.at(max_gen, group, self.generation[member])
+        founder_rows = self.rows_of(founders)
+        gen_founder = np.where(founder_rows >= 0, self.generation[founder_rows], 0)
+
+        stats = {
+            'founder': founders,
+            'descendants': np.bincount(group, minlength=k),
+            'alive': np.bincount(group, weights=alive, minlength=k).astype(np.int64),
+            'max_generation': np.where(max_gen >= 0, max_gen - gen_founder, -1),
+        }
+        cause = self.cause[member]
+        for code, name in CAUSE_NAMES.items():
+            if code == ALIVE:
+                continue
+            stats[name] = np.bincount(group, weights=cause == code, minlength=k).astype(np.int64)
+        return stats
+
+    def trauma_trajectories(self, ancestor_ids, bin_size=50, field='trauma_birth'):
+        '''
+        Mean trauma of each family's members, grouped by the step they were
+        born in (binned). Used to follow how trauma carries down family lines
+        after the famine.
+
+        Parameters
+        ----------
+        ancestor_ids : array-like of int
+            unique_ids of the family founders
+        bin_size : int
+            width of the birth step bins
+        field : str
+            'trauma_birth' or 'trauma_death'
+
+        Returns
+        -------
+        founders : np.ndarray
+            sorted unique founder ids (rows of the returned matrices)
+        bin_starts : np.ndarray
+            first birth step of each bin (columns of the returned matrices)
+        mean_trauma : np.ndarray (n_founders, n_bins)
+            mean of the trauma field per family and bin (nan if empty)
+        counts : np.ndarray (n_founders, n_bins)
+            number of members contributing to each cell
+
+        '''
+        founders = np.unique(np.asarray(ancestor_ids, dtype=np.int64))
+        founder = self.founder_of(founders)
+        values = getattr(self, field)
+        member = (founder >= 0) & ~np.isnan(values)
+
+        group = np.searchsorted(founders, founder[member])
+        births = self.birth_step[member]
+        first = births.min() // bin_size * bin_size if births.size else 0
+        bins = (births - first) // bin_size
+        n_bins = int(bins.max()) + 1 if bins.size else 0
+
+        flat = group * n_bins + bins
+        size = len(founders) * n_bins
+        counts = np.bincount(flat, minlength=size).reshape(len(founders), n_bins)
+        sums = np.bincount(flat, weights=values[member], minlength=size).reshape(len(founders), n_bins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_trauma = sums / counts
+        bin_starts = first + bin_size * np.arange(n_bins)
+        return founders, bin_starts, mean_trauma, counts
@@ -0,0 +1,491 @@
+"""
+Memory benchmark of long multi-generation runs
+================================
+
+Runs SugarscapeTMF for a long horizon and, every N steps, records where
+its memory is:
+
+    - the resident set size of the process (current and peak) and, with
+      tracemalloc on, the memory traced for Python objects and the source
+      lines it grew the most at since the previous snapshot
+    - the size of each subsystem of the model, measured by walking the
+      objects it holds (an object reachable from several subsystems is
+      counted once, in the first of SUBSYSTEMS); the collector, which
+      grows every step, is sized from its number of records and an evenly
+      spaced sample of them instead, so a snapshot takes as long late in
+      a run as early on:
+        epigenetics  the live agents' epigenetic_symptoms lists and
+                     future_epigenetic_symptoms dicts
+        agents       the live non-sugar agents
+        schedule     the schedule's agent dicts
+        landscape    the Sugar agents, the grid and the base landscape
+        collector    the DataCollector (model and agent records)
+        events       the event log buffer and in-memory chunks
+        lineage      the lineage table
+    - removed agents that are still kept alive by a reference somewhere
+      (non-sugar agents the garbage collector still tracks that are no
+      longer in the schedule)
+
+From the snapshots after a warm-up (while the initial population grows
+into its steady state) it works out the bytes per live agent and the
+bytes the run grows by per step, for the whole process and for each
+subsystem. Thresholds on these make the benchmark exit with status 1, so
+it can size sweep worker memory and catch leaks before a batch does:
+
+    python -m trauma_model_framework.membench --steps 5000 --every 250
+    python -m trauma_model_framework.membench --steps 20000 --engine numba \\
+        --max-peak-rss 400 --max-bytes-per-agent 3000 --max-bytes-per-step 2000 --max-leaked 0
+
+tracemalloc slows the run down several times and adds its own memory to
+the RSS; --no-tracemalloc leaves it off (the growth per step is then
+taken from the RSS). The peak RSS of the benchmarked process includes
+tracemalloc and the measuring; the peak RSS reported and checked against
+--max-peak-rss comes from a separate run of the model in a fresh
+interpreter with neither (see plain_peak_rss), which --plain-peak also
+asks for without a threshold.
+"""
+
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+from collections import deque
+
+import numpy as np
+
+from .agents import SsAgent
+from .core import Agent, Model
+from .model import SugarscapeTMF
+
+SUBSYSTEMS = ('epigenetics', 'agents', 'schedule', 'landscape', 'collector', 'events', 'lineage')
+
+EPIGENETIC_FIELDS = ('epigenetic_symptoms', 'future_epigenetic_symptoms')
+
+# objects that are code or shared interpreter state rather than data of a model
+_NOT_DATA = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+             types.MethodType, types.CodeType)
+
+_ATOMIC = (int, float, complex, bool, str, bytes, type(None))
+
+# records sampled per list by collector_size
+COLLECTOR_SAMPLE = 20
+
+_PLAIN_RUN = '''
+import json, sys
+from trauma_model_framework.membench import plain_run
+print(json.dumps(plain_run(**json.loads(sys.argv[1]))))
+'''
+
+
+def deep_sizeof(roots, seen=None, skip=(Model, Agent)):
+    '''
+    Bytes held by roots and everything reachable from them.
+
+    Parameters
+    ----------
+    roots : iterable
+        objects to measure
+    seen : set, optional
+        ids of objects already counted (updated); objects in it are not
+        counted again, which is how sizes are split between subsystems
+    skip : tuple of types
+        objects of these types are not walked into unless they are roots
+        (by default models and agents, so measuring one agent does not
+        measure the whole model)
+
+    Returns
+    -------
+    size : int
+
+    '''
+    seen = set() if seen is None else seen
+    stack = list(roots)
+    root_ids = {id(obj) for obj in stack}
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _NOT_DATA):
+            continue
+        if isinstance(obj, skip) and id(obj) not in root_ids:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, _ATOMIC):
+            continue
+        if isinstance(obj, np.ndarray):
+            # getsizeof only counts the data of arrays that own it
+            if isinstance(obj.base, np.ndarray):
+                stack.append(obj.base)
+            elif obj.base is not None:
+                size += obj.nbytes
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        else:
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+            for cls in type(obj).__mro__:
+                for name in getattr(cls, '__slots__', ()):
+                    if hasattr(obj, name):
+                        stack.append(getattr(obj, name))
+    return size
+
+
+def _sampled_sizeof(items, sample, seen):
+    # bytes of the items of a list (not of the list itself), from the
+    # sizes of an evenly spaced sample of them; values the sampled items
+    # share (like agent ids, which are the same objects in every step's
+    # records) are counted once, as in a full walk
+    if not items:
+        return 0
+    picks = np.linspace(0, len(items) - 1, min(sample, len(items))).astype(int)
+    return int(len(items) / len(picks) * sum(deep_sizeof([items[i]], seen) for i in picks))
+
+
+def collector_size(datacollector, sample=COLLECTOR_SAMPLE, seen=None):
+    '''
+    Bytes held by a DataCollector, estimated from the number of records it
+    holds and the size of an evenly spaced sample of them (sample per
+    reporter series and sample steps of agent records), so the estimate
+    takes the same time however long the run has been going.
+
+    Parameters
+    ----------
+    datacollector : DataCollector
+    sample : int
+        records sampled per list
+    seen : set, optional
+        ids of objects already counted (see deep_sizeof); the objects
+        counted here are added to it
+
+    '''
+    seen = set() if seen is None else seen
+    model_vars, agent_records = datacollector.model_vars, datacollector._agent_records
+    series_ids = [id(series) for series in model_vars.values()]
+    # everything but the records is walked as usual
+    seen.update([id(model_vars), id(agent_records)] + series_ids)
+    size = deep_sizeof([datacollector], seen)
+    size += sys.getsizeof(model_vars) + sys.getsizeof(agent_records)
+    for series in model_vars.values():
+        size += sys.getsizeof(series) + _sampled_sizeof(series, sample, seen)
+    size += _sampled_sizeof(list(agent_records.values()), sample, seen)
+    return size
+
+
+def subsystem_sizes(model):
+    '''
+    Bytes held by each of the model's SUBSYSTEMS.
+
+    Returns
+    -------
+    sizes : dict
+        subsystem name -> bytes
+
+    '''
+    agents = list(model.schedule.agents_by_type.get(SsAgent, {}).values())
+    roots = {
+        'epigenetics': [getattr(agent, name) for agent in agents for name in EPIGENETIC_FIELDS],
+        'agents': agents,
+        'schedule': [model.schedule],
+        'landscape': list(model.sugar_cells) + [model.grid, model.landscape],
+        'events': [model.events],
+        'lineage': [model.lineage],
+    }
+    seen = set()
+    return {name: collector_size(model.datacollector, seen=seen) if name == 'collector'
+            else deep_sizeof(roots[name], seen) for name in SUBSYSTEMS}
+
+
+def leaked_agents(model):
+    '''
+    Non-sugar agents of model that were removed from it but are still
+    alive (found through the garbage collector after a full collection).
+    '''
+    gc.collect()
+    live = model.schedule.agents_by_type.get(SsAgent, {})
+    return [obj for obj in gc.get_objects()
+            if type(obj) is SsAgent and obj.model is model and live.get(obj.unique_id) is not obj]
+
+
+def rss():
+    '''
+    Current and peak resident set size of this process in bytes (None
+    where the platform does not report them).
+    '''
+    current = peak = None
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return current, peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return current, peak
+
+
+def plain_run(steps, seed=1, **model_kwargs):
+    '''
+    Runs a model like run_benchmark does but without tracemalloc or any
+    measuring, and returns the peak RSS of the process in bytes (meant to
+    be run in a fresh interpreter, see plain_peak_rss).
+    '''
+    model = SugarscapeTMF(seed=seed, **model_kwargs)
+    model.set_markers(steps)
+    for _ in range(steps):
+        if not model.schedule.get_type_count(SsAgent):
+            break
+        model.step()
+    return {'steps': model.schedule.steps, 'peak_rss': rss()[1]}
+
+
+def plain_peak_rss(steps, seed=1, **model_kwargs):
+    '''
+    Peak RSS in bytes of a plain run of steps steps in a fresh interpreter,
+    i.e. of the model alone (None where the platform does not report it).
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    args = json.dumps(dict(model_kwargs, steps=steps, seed=seed))
+    out = subprocess.run([sys.executable, '-c', _PLAIN_RUN, args], env=env, check=True,
+                         capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])['peak_rss']
+
+
+def _snapshot(model, traced_previous, top):
+    current_rss, peak_rss = rss()
+    agents = list(model.schedule.agents_by_type.get(SsAgent, {}).values())
+    lengths = [len(agent.epigenetic_symptoms) for agent in agents] or [0]
+    snap = {
+        'step': model.schedule.steps,
+        'agents': len(agents),
+        'rss': current_rss,
+        'peak_rss': peak_rss,
+        'epigenetic_symptoms_mean': float(np.mean(lengths)),
+        'epigenetic_symptoms_max': int(max(lengths)),
+    }
+    traced = None
+    if tracemalloc.is_tracing():
+        # before measuring, which allocates itself
+        snap['traced'], snap['traced_peak'] = tracemalloc.get_traced_memory()
+        traced = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ])
+        if traced_previous is not None:
+            snap['top_growth'] = [
+                '%s:%d %+d B' % (stat.traceback[0].filename, stat.traceback[0].lineno, stat.size_diff)
+                for stat in traced.compare_to(traced_previous, 'lineno')[:top] if stat.size_diff > 0
+            ]
+    snap['subsystems'] = subsystem_sizes(model)
+    snap['leaked'] = len(leaked_agents(model))
+    if tracemalloc.is_tracing():
+        # the peak between this snapshot and the next is the run's, not ours
+        tracemalloc.reset_peak()
+    return snap, traced
+
+
+def _slope(steps, values):
+    # least squares growth per step
+    if len(steps) < 2:
+        return None
+    return float(np.polyfit(np.asarray(steps, dtype=float), np.asarray(values, dtype=float), 1)[0])
+
+
+def run_benchmark(steps=5000, every=250, warmup=500, seed=1, trace=True, top=5, verbose=False,
+                  plain_peak=False, **model_kwargs):
+    '''
+    Runs a model for steps steps (or until its population dies out),
+    taking a memory snapshot before the first step and every every steps.
+
+    Parameters
+    ----------
+    steps : int
+        horizon of the run; it keeps going after the model's own end flag
+    every : int
+        steps between snapshots
+    warmup : int
+        snapshots before this step are left out of the per agent and per
+        step figures
+    seed : int
+        model seed
+    trace : bool
+        run with tracemalloc
+    top : int
+        number of source lines listed per snapshot in top_growth
+    verbose : bool
+        print each snapshot as it is taken
+    plain_peak : bool
+        also measure the peak RSS of a plain run (see plain_peak_rss)
+    **model_kwargs
+        passed on to SugarscapeTMF (e.g. engine='numba')
+
+    Returns
+    -------
+    report : dict
+        snapshots (list of dicts), bytes_per_agent, bytes_per_step,
+        subsystem_bytes_per_step, peak_rss (of the plain run, None without
+        plain_peak), measured_peak_rss (of this process, measuring
+        included), max_leaked and runtime
+
+    '''
+    if trace:
+        tracemalloc.start()
+    try:
+        t = time.perf_counter()
+        model = SugarscapeTMF(seed=seed, **model_kwargs)
+        model.set_markers(steps)
+        snapshots = []
+        traced = None
+        for step in range(steps + 1):
+            if step % every == 0 or step == steps:
+                snap, traced = _snapshot(model, traced, top)
+                snapshots.append(snap)
+                if verbose:
+                    print(format_snapshot(snap), flush=True)
+            if step == steps or not model.schedule.get_type_count(SsAgent):
+                break
+            model.step()
+        runtime = time.perf_counter() - t
+    finally:
+        if trace:
+            tracemalloc.stop()
+
+    steady = [s for s in snapshots if s['step'] >= warmup] or snapshots[-1:]
+    per_agent = [(s['subsystems']['agents'] + s['subsystems']['epigenetics']) / s['agents']
+                 for s in steady if s['agents']]
+    total = 'traced' if trace else 'rss'
+    return {
+        'snapshots': snapshots,
+        'bytes_per_agent': max(per_agent) if per_agent else None,
+        'bytes_per_step': _slope([s['step'] for s in steady], [s[total] for s in steady])
+        if all(s[total] is not None for s in steady) else None,
+        'subsystem_bytes_per_step': {
+            name: _slope([s['step'] for s in steady], [s['subsystems'][name] for s in steady])
+            for name in SUBSYSTEMS
+        },
+        'peak_rss': plain_peak_rss(steps, seed, **model_kwargs) if plain_peak else None,
+        'measured_peak_rss': snapshots[-1]['peak_rss'],
+        'max_leaked': max(s['leaked'] for s in snapshots),
+        'runtime': runtime,
+    }
+
+
+def check_thresholds(report, max_peak_rss=None, max_bytes_per_agent=None, max_bytes_per_step=None,
+                     max_leaked=None):
+    '''
+    Compares a run_benchmark report against thresholds (None: not checked).
+
+    Parameters
+    ----------
+    max_peak_rss : float
+        megabytes, checked against the peak RSS of the plain run
+    max_bytes_per_agent, max_bytes_per_step : float
+        bytes
+    max_leaked : int
+        removed agents still alive at any snapshot
+
+    Returns
+    -------
+    failures : list of str
+        one message per threshold exceeded or that could not be checked
+        because the report has no value for it (e.g. the peak RSS where
+        the platform does not report it); empty if all passed
+
+    '''
+    # name, value, limit, unit, why the value can be missing
+    checks = [
+        ('peak RSS', None if report['peak_rss'] is None else report['peak_rss'] / 2**20,
+         max_peak_rss, 'MB', 'this platform does not report it'),
+        ('bytes per live agent', report['bytes_per_agent'], max_bytes_per_agent, 'B',
+         'no agents were alive in the snapshots after the warm-up'),
+        ('bytes per step', report['bytes_per_step'], max_bytes_per_step, 'B',
+         'fewer than two snapshots after the warm-up, or no RSS on this platform '
+         'without tracemalloc'),
+        ('leaked agents', report['max_leaked'], max_leaked, '', ''),
+    ]
+    failures = []
+    for name, value, limit, unit, missing in checks:
+        if limit is None:
+            continue
+        if value is None:
+            failures.append('%s cannot be checked against the limit of %g%s: %s'
+                            % (name, limit, unit, missing))
+        elif value > limit:
+            failures.append('%s %.1f%s over the limit of %g%s' % (name, value, unit, limit, unit))
+    return failures
+
+
+def format_snapshot(snap):
+    '''
+    One line summary of a snapshot, sizes in kilobytes.
+    '''
+    line = 'step %6d  agents %4d  rss %s  ' % (
+        snap['step'], snap['agents'],
+        '%.1f MB' % (snap['rss'] / 2**20) if snap['rss'] is not None else '-')
+    if 'traced' in snap:
+        line += 'traced %.1f MB  ' % (snap['traced'] / 2**20)
+    line += '  '.join('%s %.0f kB' % (name, size / 1024) for name, size in snap['subsystems'].items())
+    line += '  epigenetics/agent %.1f (max %d)  leaked %d' % (
+        snap['epigenetic_symptoms_mean'], snap['epigenetic_symptoms_max'], snap['leaked'])
+    for growth in snap.get('top_growth', ()):
+        line += '\n    ' + growth
+    return line
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Memory benchmark of a long SugarscapeTMF run')
+    parser.add_argument('--steps', type=int, default=5000)
+    parser.add_argument('--every', type=int, default=250, help='steps between snapshots')
+    parser.add_argument('--warmup', type=int, default=500,
+                        help='leave snapshots before this step out of the per agent and per step figures')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--engine', default='python', choices=('python', 'numba'))
+    parser.add_argument('--no-tracemalloc', dest='trace', action='store_false')
+    parser.add_argument('--top', type=int, default=5, help='source lines listed per snapshot')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--plain-peak', action='store_true',
+                        help='measure the peak RSS of a plain run (implied by --max-peak-rss)')
+    parser.add_argument('--max-peak-rss', type=float, help='MB, of the plain run')
+    parser.add_argument('--max-bytes-per-agent', type=float)
+    parser.add_argument('--max-bytes-per-step', type=float)
+    parser.add_argument('--max-leaked', type=int)
+    args = parser.parse_args()
+
+    report = run_benchmark(args.steps, args.every, args.warmup, args.seed, args.trace, args.top,
+                           verbose=True, plain_peak=args.plain_peak or args.max_peak_rss is not None,
+                           engine=args.engine)
+    print('ran %d steps in %.1f s' % (report['snapshots'][-1]['step'], report['runtime']))
+    print('bytes per live agent %s, bytes per step %s, peak RSS %s (plain run), %s (measured run)' % (
+        '%.0f' % report['bytes_per_agent'] if report['bytes_per_agent'] is not None else '-',
+        '%.0f' % report['bytes_per_step'] if report['bytes_per_step'] is not None else '-',
+        '%.1f MB' % (report['peak_rss'] / 2**20) if report['peak_rss'] is not None else '-',
+        '%.1f MB' % (report['measured_peak_rss'] / 2**20)
+        if report['measured_peak_rss'] is not None else '-'))
+    print('bytes per step by subsystem: ' + ', '.join(
+        '%s %.0f' % (name, slope) for name, slope in report['subsystem_bytes_per_step'].items()
+        if slope is not None))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+    failures = check_thresholds(report, args.max_peak_rss, args.max_bytes_per_agent,
+                                args.max_bytes_per_step, args.max_leaked)
+    for failure in failures:
+        print('FAIL ' + failure)
+    sys.exit(1 if failures else 0)
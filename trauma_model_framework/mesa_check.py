@@ -0,0 +1,195 @@
+"""
+Check of the copied mesa classes against mesa
+================================
+
+core.py holds copies of the mesa classes the model is built on, so that
+the headless path does not import mesa (see import_budget.py). The copies
+have to keep behaving exactly like the mesa release they were copied from
+(core.MESA_VERSION). This module checks that against the installed mesa:
+
+    - the installed mesa is that release
+    - every public method and property of the copies exists in mesa with
+      the same parameters (the copies may add parameters after mesa's,
+      like MultiGrid's landscape, or leave out trailing ones the model
+      does not use, like DataCollector's tables)
+    - Model seeds its random number generator like mesa.Model
+    - a model run on mesa's scheduler, grid and data collector goes
+      through exactly the same states (see golden.state_hashes) and
+      reporter values as one run on the copies
+
+    python -m trauma_model_framework.mesa_check
+    python -m trauma_model_framework.mesa_check --steps 500 --seed 3
+
+It exits with status 1 if a check fails. Run it after upgrading mesa or
+changing core.py.
+"""
+
+import inspect
+
+from . import core
+
+# core class -> (mesa module, class name)
+COPIED_CLASSES = {
+    'Model': ('mesa.model', 'Model'),
+    'Agent': ('mesa.agent', 'Agent'),
+    'RandomActivationByType': ('mesa.time', 'RandomActivationByType'),
+    'MultiGrid': ('mesa.space', 'MultiGrid'),
+    'DataCollector': ('mesa.datacollection', 'DataCollector'),
+}
+
+# classes the model module takes from core and a run on mesa replaces
+_RUN_CLASSES = ('RandomActivationByType', 'MultiGrid', 'DataCollector')
+
+
+def _mesa_class(name):
+    import importlib
+    module, cls = COPIED_CLASSES[name]
+    return getattr(importlib.import_module(module), cls)
+
+
+def _unwrap(func):
+    # mesa decorates some grid methods with wrappers (functions defined in
+    # the decorator) that take (grid_instance, positions) and keep the
+    # decorated method in their closure
+    if '<locals>' not in getattr(func, '__qualname__', ''):
+        return func
+    for cell in func.__closure__ or ():
+        if inspect.isfunction(cell.cell_contents):
+            return _unwrap(cell.cell_contents)
+    return func
+
+
+def _parameters(member):
+    if isinstance(member, property):
+        return []
+    member = _unwrap(member)
+    try:
+        return list(inspect.signature(member).parameters)
+    except (TypeError, ValueError):
+        return None
+
+
+def api_differences():
+    '''
+    Public members of the copied classes that mesa does not have, or that
+    take other parameters in mesa.
+
+    Returns
+    -------
+    differences : list of str
+        one message per difference (empty if there are none)
+
+    '''
+    differences = []
+    for name in COPIED_CLASSES:
+        ours, theirs = getattr(core, name), _mesa_class(name)
+        slots = getattr(ours, '__slots__', ())
+        for attr, member in vars(ours).items():
+            if attr.startswith('_') and attr not in ('__init__', '__getitem__', '__iter__'):
+                continue
+            # slotted attributes are plain instance attributes in mesa
+            if attr in slots:
+                continue
+            if not hasattr(theirs, attr):
+                differences.append('%s.%s is not in mesa' % (name, attr))
+                continue
+            params, mesa_params = _parameters(member), _parameters(inspect.getattr_static(theirs, attr))
+            if params is None or mesa_params is None:
+                continue
+            # mesa's __init__ of some classes only takes *args, **kwargs
+            if attr == '__init__' and mesa_params[1:] == ['args', 'kwargs']:
+                continue
+            n = min(len(params), len(mesa_params))
+            if params[:n] != mesa_params[:n]:
+                differences.append('%s.%s takes (%s), mesa\'s takes (%s)'
+                                   % (name, attr, ', '.join(params), ', '.join(mesa_params)))
+    return differences
+
+
+def check_run(steps=300, seed=1, **model_kwargs):
+    '''
+    Runs the model on the copied classes and on mesa's scheduler, grid and
+    data collector side by side with the same seed, comparing the state
+    hashes and reporter values after every step.
+
+    Returns
+    -------
+    mismatch : (int, str) or None
+        step and part of the state of the first difference, None if the
+        runs were identical
+
+    '''
+    from . import model as model_module
+    from .golden import state_hashes
+
+    class MesaMultiGrid(_mesa_class('MultiGrid')):
+        # mesa's grid has no landscape tables; it computes neighborhoods
+        def __init__(self, width, height, torus, landscape=None):
+            super().__init__(width, height, torus)
+
+    replacements = {name: _mesa_class(name) for name in _RUN_CLASSES}
+    replacements['MultiGrid'] = MesaMultiGrid
+
+    ours = model_module.SugarscapeTMF(seed=seed, **model_kwargs)
+    saved = {name: getattr(model_module, name) for name in _RUN_CLASSES}
+    try:
+        for name, cls in replacements.items():
+            setattr(model_module, name, cls)
+        theirs = model_module.SugarscapeTMF(seed=seed, **model_kwargs)
+    finally:
+        for name, cls in saved.items():
+            setattr(model_module, name, cls)
+    for m in (ours, theirs):
+        m.set_markers(steps)
+
+    for step in range(steps + 1):
+        if step:
+            ours.step()
+            theirs.step()
+        for name, value in state_hashes(ours).items():
+            if state_hashes(theirs)[name] != value:
+                return step, name
+        for name, series in ours.datacollector.model_vars.items():
+            if theirs.datacollector.model_vars[name] != series:
+                return step, 'reporter ' + name
+        if ours.end:
+            break
+    return None
+
+
+def check_against_mesa(steps=300, seed=1):
+    '''
+    Runs every check and prints one line per check.
+
+    Returns
+    -------
+    ok : bool
+        True if every check passed
+
+    '''
+    import mesa
+
+    results = []
+    results.append((mesa.__version__ == core.MESA_VERSION, 'mesa version',
+                    'installed %s, copied from %s' % (mesa.__version__, core.MESA_VERSION)))
+    differences = api_differences()
+    results.append((not differences, 'methods and parameters', '; '.join(differences)))
+    same_seed = core.Model(seed=seed).random.getstate() == mesa.Model(seed=seed).random.getstate()
+    results.append((same_seed, 'random number generator seeding', ''))
+    mismatch = check_run(steps, seed)
+    results.append((mismatch is None, 'run of %d steps' % steps,
+                    'first difference at step %d in %s' % mismatch if mismatch else ''))
+    for passed, name, detail in results:
+        print('%-4s %s%s' % ('ok' if passed else 'FAIL', name, ': ' + detail if detail else ''))
+    return all(passed for passed, _, _ in results)
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Check the copied mesa classes of core.py against mesa')
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    sys.exit(0 if check_against_mesa(args.steps, args.seed) else 1)
@@ -4,14 +4,21 @@ Sugarscape Constant Growback model adjusted for a trauma model framework
 
 """
 
-import mesa
+import warnings
+
 import numpy as np
 # import random
 
-from .agents import SsAgent, Sugar
+from .agents import TRAUMA_PARAMS, SsAgent, Sugar
+from .core import DataCollector, Model, MultiGrid, RandomActivationByType
+from .events import EVENT_NAMES, EventLog
+from .frames import ReplayWriter
+from .landscape import Landscape
+from .lineage import LineageTable
+from .scenario import ScenarioScheduler, SteadyStateFamine
 
 
-class SugarscapeTMF(mesa.Model):
+class SugarscapeTMF(Model):
     """
     Sugarscape 2 Constant Growback
     """
@@ -53,93 +60,298 @@ class SugarscapeTMF(mesa.Model):
         
         return avg_trauma
 
-    def __init__(self, width=50, height=50, initial_population=100, seed=None):
+    def __init__(self, width=None, height=None, initial_population=100, seed=None, event_log=None,
+                 replay=None, engine='python', scenario=None, landscape=None, trauma_params=None,
+                 famine=None):
         """
         Create a new Collective Trauma model based on Constant Growback model with the given parameters.
 
         Args:
+            width, height: Size of the canvas (the landscape's size if None)
             initial_population: Number of population to start with
             seed: Random seed value for MESA to use
+            event_log: Optional file path the agent event records are flushed to
+                       (kept in memory if None)
+            replay: Optional file path to record a replay of the run to
+                    (keyframes plus delta frames, see frames.py)
+            engine: 'python' to step non-sugar agents one SsAgent.step at a time,
+                    'numba' to step them all in the compiled kernel of kernels.py
+                    (same results; 'python' is used if numba is not installed)
+            scenario: Optional list of scenario events (famines, growback changes,
+                      see scenario.py); by default a single famine starts once
+                      the average trauma level is in a steady state
+            landscape: Optional Landscape (max sugar capacities and neighborhood
+                       tables, see landscape.py), or the name of a landscape
+                       published to shared memory; sugar-map.txt by default
+            trauma_params: Optional dict overriding constants of the agents'
+                           trauma rules (see agents.TRAUMA_PARAMS)
+            famine: Optional dict of arguments of the default scenario's famine
+                    (duration, growback, wipe, region, see scenario.Famine and
+                    SteadyStateFamine), e.g. from a sweep run spec
         """
         
         self.verbose = False # Print-monitoring
         
         self.trauma_recovery = False
         self.te_end = self.te_start = -1
+        # average trauma level before the first famine
+        self.avg_baseline_trauma = 0
+        # (start step, end step, region) of every famine so far
+        self.famines = []
+        # timed changes to the landscape, fired at the start of each step
+        if scenario is None:
+            scenario = [SteadyStateFamine(**(famine or {}))]
+        elif famine is not None:
+            raise ValueError('famine only sets up the default scenario; add the Famine to scenario instead')
+        self.scenario = ScenarioScheduler(scenario)
+
+        unknown = set(trauma_params or ()) - set(TRAUMA_PARAMS)
+        if unknown:
+            raise ValueError('unknown trauma parameters: %s' % ', '.join(sorted(unknown)))
+        self.trauma_params = dict(TRAUMA_PARAMS, **(trauma_params or {}))
+
+        # NumPy generator used for drawing agent attributes in bulk
+        # (self.random is still used for everything agents do each step);
+        # a seed does not give the same run as before attributes were drawn
+        # from it, when they came from self.random one agent at a time
+        self.np_random = np.random.default_rng(seed)
+        self._draw_pool = None
+        self._draw_pool_idx = 0
+
+        # read-only base landscape, shared by every run of this process
+        # (and by other processes if it was published to shared memory)
+        if landscape is None:
+            landscape = Landscape.default()
+        elif isinstance(landscape, str):
+            landscape = Landscape.attach(landscape)
+        if (width, height) != (None, None) and (width, height) != (landscape.width, landscape.height):
+            raise ValueError('canvas size %r does not match the %dx%d landscape'
+                             % ((width, height), landscape.width, landscape.height))
+        self.landscape = landscape
 
         # Set parameters
         self.end = False
-        self.width = width
-        self.height = height
+        self.width = landscape.width
+        self.height = landscape.height
         self.initial_population = initial_population
+        if engine not in ('python', 'numba'):
+            raise ValueError("engine must be 'python' or 'numba', not %r" % (engine,))
+        if engine == 'numba':
+            from . import kernels
+            if not kernels.NUMBA_AVAILABLE:
+                # the uncompiled kernel gives the same results as the agents,
+                # only slower
+                warnings.warn("numba is not installed, running engine='python' instead")
+                engine = 'python'
+        self.engine = engine
 
-        self.schedule = mesa.time.RandomActivationByType(self)
-        self.grid = mesa.space.MultiGrid(self.width, self.height, torus=False)
-        self.datacollector = mesa.DataCollector(
-            model_reporters={"SsAgent": lambda m: m.schedule.get_type_count(SsAgent),
-                             "Trauma": self.reporter_trauma,
-            },
+        self.schedule = RandomActivationByType(self)
+        self.grid = MultiGrid(self.width, self.height, torus=False, landscape=landscape)
+        # mugging, killing, cannibalism, pregnancy, birth and death events
+        self.events = EventLog(event_log)
+        model_reporters = {"SsAgent": lambda m: m.schedule.get_type_count(SsAgent),
+                           "Trauma": self.reporter_trauma,
+        }
+        # number of events of each type per step
+        for event_type, name in EVENT_NAMES.items():
+            model_reporters[name] = lambda m, event_type=event_type: int(m.events.last_counts[event_type])
+        self.datacollector = DataCollector(
+            model_reporters=model_reporters,
             agent_reporters = {"test": lambda agent: agent.sugar if isinstance(agent, SsAgent) else None}
         )
 
+        # parent -> child edges of every agent born in the simulation
+        self.lineage = LineageTable()
+
         # Create sugar
-        sugar_distribution = np.genfromtxt("trauma_model_framework/sugar-map.txt")
+        sugar_distribution = landscape.max_sugar
         self.agent_id = 0
+        # sugar agents in [x * height + y] order, for reading the landscape as an array
+        self.sugar_cells = []
         for _, (x, y) in self.grid.coord_iter():
             max_sugar = sugar_distribution[x, y]
             sugar = Sugar(self.agent_id, (x, y), self, max_sugar)
+            self.sugar_cells.append(sugar)
             self.agent_id += 1
             self.grid.place_agent(sugar, (x, y))
             self.schedule.add(sugar)
 
         # Create agent:
-        for i in range(self.initial_population):
-            ssa = SsAgent(self.agent_id, self, False, family=i)
-            x,y = ssa.pos
-            self.agent_id += 1
-            self.grid.place_agent(ssa, (x, y))
-            self.schedule.add(ssa)
+        self.spawn_agents(self.initial_population, family=range(self.initial_population),
+                          cortisol=self.trauma_params['initial_cortisol'])
 
         # logistics vars
         self.running = True
         self.datacollector.collect(self)
+
+        # frames of every step for replaying the run without re-simulating it
+        self.replay = ReplayWriter(replay) if replay is not None else None
+        if self.replay is not None:
+            self.replay.write(self)
         
 
+    def draw_agent_attributes(self, n):
+        '''
+        Takes n rows of the random attributes every new agent needs
+        (max_sugar_hold, metabolism, vision, sex and death age) from a pool
+        that is refilled with one vectorized draw per attribute, so single
+        births do not pay for a round of RNG calls each.
+
+        Parameters
+        ----------
+        n : int
+            number of agents to draw attributes for
+
+        Returns
+        -------
+        draws : dict of lists
+            one list of n python values per attribute
+
+        '''
+        pool = self._draw_pool
+        i = self._draw_pool_idx
+        if pool is None or i + n > len(pool['death']):
+            size = max(n, 256)
+            rng = self.np_random
+            new = {
+                'max_sugar_hold': rng.integers(20, 61, size).tolist(),
+                'metabolism': rng.integers(2, 4, size).tolist(),
+                'vision': rng.integers(1, 6, size).tolist(),
+                'sex': [('m', 'f')[k] for k in rng.integers(0, 2, size).tolist()],
+                'death': rng.integers(90, 111, size).tolist(),
+            }
+            # keep whatever was left of the old pool so draws are used in order
+            if pool is not None:
+                new = {key: pool[key][i:] + vals for key, vals in new.items()}
+            self._draw_pool = pool = new
+            self._draw_pool_idx = i = 0
+        self._draw_pool_idx = i + n
+        return {key: vals[i:i + n] for key, vals in pool.items()}
+
+    def spawn_agents(self, n, pos=None, parent=None, family=-1, sex=None, **kwargs):
+        '''
+        Creates n non-sugar agents, placing each on the canvas and adding it
+        to the schedule one at a time. Only the random attributes are drawn
+        in bulk (from the pool of draw_agent_attributes, instead of per-agent
+        RNG calls); positions are only drawn when no pos is given (births are
+        placed at their parent's pos).
+
+        Parameters
+        ----------
+        n : int
+            number of agents to create
+        pos : (int,int), optional
+            pos for all new agents; drawn uniformly over the canvas if None
+        parent : SsAgent, optional
+            parent of the new agents (None for the initial population)
+        family : int or sequence of int
+            family identifier for all agents, or one per agent
+        sex : str, optional
+            sex of all new agents; drawn if None
+        **kwargs :
+            any other SsAgent arguments (sugar, trauma, generation, ...)
+
+        Returns
+        -------
+        agents : list of SsAgent
+
+        '''
+        draws = self.draw_agent_attributes(n)
+        if pos is None:
+            positions = list(zip(self.np_random.integers(0, self.width, n).tolist(),
+                                 self.np_random.integers(0, self.height, n).tolist()))
+        else:
+            positions = [tuple(pos)] * n
+        if family is None or np.ndim(family) == 0:
+            family = [family] * n
+        sexes = draws['sex'] if sex is None else [sex] * n
+
+        agents = []
+        for i in range(n):
+            ssa = SsAgent(self.agent_id, self, False, family=family[i], sex=sexes[i],
+                          pos=positions[i], max_sugar_hold=draws['max_sugar_hold'][i],
+                          metabolism=draws['metabolism'][i], vision=draws['vision'][i],
+                          death=draws['death'][i], **kwargs)
+            self.agent_id += 1
+            self.add_agent(ssa, positions[i], parent=parent)
+            agents.append(ssa)
+        return agents
+
+    def add_agent(self, ssa, pos, parent=None):
+        '''
+        Places a new non-sugar agent on the canvas, adds it to the schedule
+        and records it in the lineage table.
+
+        Parameters
+        ----------
+        ssa : SsAgent
+            newly created agent
+        pos : (int,int)
+            pos on the canvas to place the agent
+        parent : SsAgent, optional
+            agent that gave birth to ssa (None for the initial population)
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.grid.place_agent(ssa, pos)
+        self.schedule.add(ssa)
+        parent_id = -1 if parent is None else parent.unique_id
+        ssa.lineage_row = self.lineage.record_birth(ssa, parent_id, self.schedule.steps)
+
+    def step_schedule(self):
+        '''
+        One step of the schedule. With engine='numba' this does what
+        RandomActivationByType.step does (same shuffles, same order), except
+        that the non-sugar agents are stepped by kernels.step_agents.
+        '''
+        if self.engine == 'python':
+            self.schedule.step()
+            return
+        from . import kernels
+        type_keys = list(self.schedule.agents_by_type.keys())
+        self.random.shuffle(type_keys)
+        for agent_class in type_keys:
+            if agent_class is SsAgent:
+                kernels.step_agents(self)
+            else:
+                self.schedule.step_type(agent_class)
+        self.schedule.steps += 1
+        self.schedule.time += 1
+
     def step(self):
-        self.schedule.step()
+        self.scenario.fire_due(self)
+        self.step_schedule()
+        self.events.end_step()
         # collect data
         self.datacollector.collect(self)
+        if self.replay is not None:
+            self.replay.write(self)
         if self.verbose:
             print([self.schedule.time, self.schedule.get_type_count(SsAgent)])
         
         # calculations used for marking milestones
         avg_trauma = self.datacollector.model_vars['Trauma'][-1]
         
-        # instances of each type of agent for easy type checking
-        sugar_agent = self.schedule.agents[0]
-        reg_agent = self.schedule.agents[-1]
-        
         sn = self.schedule.steps
         
-        # check for famine start marker and record or print 
-        # in addition to resetting family identifiers for easy tracking of 
-        # agent descendents in famine
-        if sugar_agent.famine == sugar_agent.step_num:
+        # famine start and end markers are set by the scenario events (see
+        # scenario.Famine); print them or reset family identifiers for easy
+        # tracking of agent descendents in famine
+        if sn == self.te_start:
             if self.verbose:
-                print('Famine start:',sn,round(sugar_agent.avg_baseline_trauma,3))
-            # set famine start marker
-            self.te_start = sn
+                print('Famine start:',sn,round(self.avg_baseline_trauma,3))
             # reset all family IDs
             for uid,ssag in self.schedule.agents_by_type[SsAgent].items():
                 ssag.reset_family()
         # check if famine has stopped
-        elif sn == self.te_start+100:
+        elif sn == self.te_end:
             if self.verbose:
                 print('Famine end:',sn,round(avg_trauma,3))
-            # record famine stop marker
-            self.te_end = sn
         # check if trauma levels drop to below pre-trauma event level
-        elif avg_trauma < sugar_agent.avg_baseline_trauma and (not self.trauma_recovery) and sn > self.te_end:
+        elif avg_trauma < self.avg_baseline_trauma and (not self.trauma_recovery) and sn > self.te_end:
             if self.verbose:
                 print('Trauma recovery:',sn,round(avg_trauma,3))
             self.trauma_recovery = True
@@ -150,16 +362,32 @@ class SugarscapeTMF(mesa.Model):
         # but it might be worth trying methods of steady state detection
         # of trauma levels after the trauma event to decide an end time 
         # for the simulation
-        if sn >= self.te_end + 800:
+        if sn >= self.te_end + 800 and not self.scenario:
             # turn on "end" flag to stop simulation
             self.end = True
             
 
-    def run_model(self, step_count=2000):
+    def set_markers(self, step_count):
+        '''
+        Sets the sim mile markers to their "not happened yet" value before a
+        run of step_count steps. Used by run_model and by anything else that
+        steps the model itself (e.g. the asynchronous visualization server).
+        '''
         # sim mile markers (useful for debugging or plotting important sim events)
         self.te_start = step_count # traumatic event start
         self.te_end = step_count # traumatic event end
         self.t_recovery = step_count # trauma response full recovery
+
+    def sugar_amounts(self):
+        '''
+        Returns the current amount of sugar on every cell as a (width, height)
+        integer array (indexed [x, y] like the grid).
+        '''
+        amounts = np.array([sugar.amount for sugar in self.sugar_cells], dtype=np.int16)
+        return amounts.reshape(self.width, self.height)
+
+    def run_model(self, step_count=2000):
+        self.set_markers(step_count)
         
         if self.verbose:
             print(
@@ -172,6 +400,9 @@ class SugarscapeTMF(mesa.Model):
             self.step()
             if self.end:
                 break
+        self.events.flush()
+        if self.replay is not None:
+            self.replay.close()
 
         if self.verbose:
             print("")
@@ -0,0 +1,244 @@
+"""
+Scenario events for the sugar landscape
+================================
+
+Timed changes to the landscape (famines and changes of the sugar growback
+rate) kept by the model in a priority queue ordered by step. At the start
+of every model step, before any agent moves, all events due at that step
+are fired; each one changes the landscape once (wipes sugar, sets the
+growback rate of the cells it covers) instead of every sugar cell checking
+every step whether something should happen to it.
+
+The default scenario is the framework's original one: a single famine
+that starts once the average trauma level reaches a steady state
+(SteadyStateFamine). Other scenarios are given as a list of events, e.g.
+
+    SugarscapeTMF(scenario=Famine.repeated(start=600, every=400, count=3))
+    SugarscapeTMF(scenario=[Famine(600, region=(0, 0, 25, 50)),
+                            GrowbackChange(1200, rate=0.5)])
+"""
+
+import abc
+import heapq
+
+import numpy as np
+
+
+def region_cells(model, region=None):
+    '''
+    Sugar agents of a rectangular region of the canvas.
+
+    Parameters
+    ----------
+    model : SugarscapeTMF
+    region : (x_min, y_min, x_max, y_max), optional
+        cells with x_min <= x < x_max and y_min <= y < y_max
+        (the whole canvas if None)
+
+    Returns
+    -------
+    cells : list of Sugar
+        in [x * height + y] order
+
+    '''
+    if region is None:
+        return model.sugar_cells
+    x_min, y_min, x_max, y_max = region
+    x_min, y_min = max(x_min, 0), max(y_min, 0)
+    x_max, y_max = min(x_max, model.width), min(y_max, model.height)
+    return [model.sugar_cells[x * model.height + y]
+            for x in range(x_min, x_max) for y in range(y_min, y_max)]
+
+
+def update_growback(model, cells):
+    '''
+    Sets the growback rate of the given cells to their base rate times the
+    growback factor of every famine still going on over them.
+    '''
+    famines = model.scenario.active_famines
+    for cell in cells:
+        rate = cell.base_growback
+        for famine in famines:
+            if famine.covers(cell.pos):
+                rate *= famine.growback
+        cell.growback = rate
+
+
+class ScenarioEvent(abc.ABC):
+    '''
+    Something that happens to the landscape at a given step. Subclasses
+    implement fire(model), which may push further events (e.g. the end of
+    a famine) onto model.scenario.
+    '''
+
+    def __init__(self, step):
+        self.step = step
+
+    @abc.abstractmethod
+    def fire(self, model):
+        '''
+        Apply the event to the model's landscape.
+        '''
+
+    def __repr__(self):
+        return '%s(step=%d)' % (type(self).__name__, self.step)
+
+
+class GrowbackChange(ScenarioEvent):
+    '''
+    Sets the base probability of a sugar cell growing back one unit of sugar
+    per step (1 at the start of a run) for the whole canvas or a region.
+    Famines going on at the time still reduce it until they end.
+    '''
+
+    def __init__(self, step, rate, region=None):
+        super().__init__(step)
+        self.rate = rate
+        self.region = region
+
+    def fire(self, model):
+        cells = region_cells(model, self.region)
+        for cell in cells:
+            cell.base_growback = self.rate
+        update_growback(model, cells)
+
+
+class Famine(ScenarioEvent):
+    '''
+    Famine starting at step start: every cell of the region loses all of its
+    sugar with probability wipe, and grows back at growback times its
+    base rate for duration steps.
+
+    The first famine of a run sets the model's trauma event markers
+    (te_start and avg_baseline_trauma) and the end of every famine moves
+    te_end, so the run ends 800 steps after the last one.
+    '''
+
+    def __init__(self, start, duration=100, growback=0.1, wipe=0.9, region=None):
+        super().__init__(start)
+        self.duration = duration
+        self.growback = growback
+        self.wipe = wipe
+        self.region = region
+
+    @classmethod
+    def repeated(cls, start, every, count, **kwargs):
+        '''
+        count famines, the first at step start and then one every steps.
+        '''
+        return [cls(start + i * every, **kwargs) for i in range(count)]
+
+    def covers(self, pos):
+        if self.region is None:
+            return True
+        x_min, y_min, x_max, y_max = self.region
+        return x_min <= pos[0] < x_max and y_min <= pos[1] < y_max
+
+    def fire(self, model):
+        step = model.schedule.steps
+        if not model.famines:
+            # markers index the datacollector rows, which lag the steps by one
+            model.te_start = step + 1
+            # trauma level before the trauma event
+            model.avg_baseline_trauma = np.average(model.datacollector.model_vars['Trauma'][-201:])
+        model.famines.append((step, step + self.duration, self.region))
+
+        cells = region_cells(model, self.region)
+        random = model.random
+        for cell in cells:
+            if random.random() < self.wipe:
+                cell.amount = 0
+        model.scenario.active_famines.append(self)
+        update_growback(model, cells)
+        model.scenario.push(FamineEnd(step + self.duration, self))
+
+    def __repr__(self):
+        return 'Famine(start=%d, duration=%d, region=%r)' % (self.step, self.duration, self.region)
+
+
+class FamineEnd(ScenarioEvent):
+    '''
+    Ends a famine: its cells grow back at their base rate again (unless
+    another famine is still going on over them).
+    '''
+
+    def __init__(self, step, famine):
+        super().__init__(step)
+        self.famine = famine
+
+    def fire(self, model):
+        model.scenario.active_famines.remove(self.famine)
+        update_growback(model, region_cells(model, self.famine.region))
+        model.te_end = model.schedule.steps + 1
+
+
+class SteadyStateFamine(ScenarioEvent):
+    '''
+    Starts a Famine once the average trauma level is in a steady state.
+
+    Checked once per step from step after+1 on, with the Conway-like rule
+    of the original framework: the last average trauma level must lie
+    within the range of the window steps before it for more than
+    consecutive steps in a row.
+    '''
+
+    def __init__(self, after=500, window=200, consecutive=100, **famine_kwargs):
+        super().__init__(max(after, window) + 1)
+        self.window = window
+        self.consecutive = consecutive
+        self.famine_kwargs = famine_kwargs
+        self.counter = 0
+
+    def fire(self, model):
+        step = model.schedule.steps
+        last_steps = model.datacollector.model_vars['Trauma'][-(self.window + 1):]
+        previous = last_steps[:-1]
+        if min(previous) <= last_steps[-1] <= max(previous):
+            self.counter += 1
+        else:
+            self.counter = 0
+
+        if self.counter > self.consecutive:
+            model.scenario.push(Famine(step, **self.famine_kwargs))
+        else:
+            # check again next step
+            self.step = step + 1
+            model.scenario.push(self)
+
+
+class ScenarioScheduler:
+    '''
+    Priority queue of ScenarioEvents ordered by step (events due at the same
+    step fire in the order they were pushed).
+    '''
+
+    def __init__(self, events=()):
+        self._queue = []
+        self._count = 0
+        # famines that have started and not ended yet
+        self.active_famines = []
+        for event in events:
+            self.push(event)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def push(self, event):
+        heapq.heappush(self._queue, (event.step, self._count, event))
+        self._count += 1
+
+    def next_step(self):
+        '''
+        Step of the next event (None if there is none left).
+        '''
+        return self._queue[0][0] if self._queue else None
+
+    def fire_due(self, model):
+        '''
+        Fire every event due at or before the current step of the model,
+        including events pushed by the ones fired.
+        '''
+        step = model.schedule.steps
+        while self._queue and self._queue[0][0] <= step:
+            _, _, event = heapq.heappop(self._queue)
+            event.fire(model)
@@ -0,0 +1,374 @@
+"""
+Global sensitivity analysis of the trauma parameters
+================================
+
+Which constants of the agents' trauma rules (agents.TRAUMA_PARAMS: the
+offspring cortisol rules, the mugging, killing and cannibalism
+probabilities, the epigenetic lifespan steps and caps, ...) drive the time
+to recovery after the famine and the post-famine trauma level?
+
+A design (Saltelli's scheme for Sobol indices, or Morris trajectories for
+elementary effects) is drawn over PARAM_BOUNDS and submitted to a sweep
+work queue (see sweep.py) as one run per design point and seed. The queue
+is the result cache: runs already done (by this or any earlier design)
+are not run again, and the runs can be spread over any number of workers
+and hosts. The indices are then computed from the results with
+bootstrap confidence intervals:
+
+    python -m trauma_model_framework.sensitivity submit QUEUE --method sobol --n 64 --seeds 2
+    python -m trauma_model_framework.sweep work QUEUE --processes 8
+    python -m trauma_model_framework.sensitivity analyze QUEUE --method sobol
+
+or all three on this host with the run command. The output of a design
+point is the mean over its seeds.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from .agents import TRAUMA_PARAMS
+from .sweep import WorkQueue, job_id, work_processes
+
+# range every parameter is varied over. starvation_trauma is left out: a
+# starving agent's trauma is set to max(trauma + starvation_trauma, 1)
+# (SsAgent.traumatize), so the increment has no effect on a run
+PARAM_BOUNDS = {
+    'initial_cortisol': (0.01, 0.1),
+    'offspring_cortisol_threshold': (0.3, 0.7),
+    'offspring_cortisol_increment': (0.0, 0.02),
+    'offspring_cortisol_max': (0.05, 0.15),
+    'cannibalize_prob': (0.05, 0.2),
+    'kill_prob': (0.25, 0.75),
+    'mug_prob': (0.5, 1.0),
+    'cannibalize_trauma': (0.0, 0.1),
+    'prenatal_lifespan_step': (0.02, 0.06),
+    'prepubecent_lifespan_step': (0.005, 0.015),
+    'prenatal_lifespan_cap': (0.1, 0.3),
+    'prepubecent_lifespan_cap': (0.1, 0.3),
+}
+
+# post-famine window the trauma level is averaged over
+POST_FAMINE_STEPS = 200
+
+
+def recovery_time(summary):
+    # steps from the famine end until the average trauma level is back below
+    # its pre-famine level (runs that do not recover count up to the last step)
+    return summary['t_recovery'] - summary['te_end']
+
+
+def post_famine_trauma(summary):
+    trauma = summary['model_vars']['Trauma']
+    return float(np.mean(trauma[summary['te_end']:summary['te_end'] + POST_FAMINE_STEPS]))
+
+
+# outputs analyzed, as functions of a sweep.run_spec summary
+OUTPUTS = {
+    'recovery_time': recovery_time,
+    'post_famine_trauma': post_famine_trauma,
+}
+
+
+def _design_path(queue, method):
+    return os.path.join(queue, 'sensitivity-%s.json' % method)
+
+
+def saltelli_design(d, n, seed=0):
+    '''
+    Saltelli's sampling scheme for first-order and total Sobol indices:
+    base matrices A and B (n points each) and, for every parameter i, A
+    with column i taken from B. Points come from a scrambled Sobol sequence
+    when scipy is installed (n should then be a power of 2), otherwise
+    from a uniform random sample.
+
+    Returns
+    -------
+    X : np.ndarray, shape (n * (d + 2), d)
+        points in the unit cube: A, then B, then AB_1 ... AB_d
+
+    '''
+    try:
+        from scipy.stats import qmc
+        base = qmc.Sobol(2 * d, scramble=True, seed=seed).random(n)
+    except ImportError:
+        base = np.random.default_rng(seed).random((n, 2 * d))
+    a, b = base[:, :d], base[:, d:]
+    ab = np.repeat(a[None], d, axis=0)
+    ab[np.arange(d), :, np.arange(d)] = b.T
+    return np.concatenate([a, b, ab.reshape(d * n, d)])
+
+
+def morris_design(d, r, levels=4, seed=0):
+    '''
+    r Morris trajectories on a grid of levels values per parameter: each
+    starts at a random grid point and moves one parameter at a time, in a
+    random order, by delta = levels / (2 * (levels - 1)) (down if up would
+    leave the unit cube).
+
+    Returns
+    -------
+    X : np.ndarray, shape (r * (d + 1), d)
+        points in the unit cube, trajectory after trajectory
+
+    '''
+    rng = np.random.default_rng(seed)
+    delta = levels / (2 * (levels - 1))
+    grid = np.arange(levels) / (levels - 1)
+    points = []
+    for _ in range(r):
+        x = rng.choice(grid, d)
+        points.append(x.copy())
+        for i in rng.permutation(d):
+            x[i] = x[i] + delta if x[i] + delta <= 1 else x[i] - delta
+            points.append(x.copy())
+    return np.array(points)
+
+
+def make_design(method, names, n, seed=0):
+    '''
+    Design over the bounds of the named parameters.
+
+    Returns
+    -------
+    U : np.ndarray
+        points in the unit cube
+    X : np.ndarray
+        the same points scaled to PARAM_BOUNDS
+
+    '''
+    if method == 'sobol':
+        u = saltelli_design(len(names), n, seed)
+    elif method == 'morris':
+        u = morris_design(len(names), n, seed=seed)
+    else:
+        raise ValueError("method must be 'sobol' or 'morris', not %r" % (method,))
+    low, high = np.array([PARAM_BOUNDS[name] for name in names]).T
+    return u, low + u * (high - low)
+
+
+def design_specs(design):
+    '''
+    Sweep run specs of a design: one per design point and seed.
+    '''
+    specs = []
+    for x in design['X']:
+        trauma_params = dict(zip(design['names'], x))
+        for seed in range(design['seeds']):
+            model_kwargs = dict(design['model_kwargs'], seed=seed, trauma_params=trauma_params)
+            specs.append({'model_kwargs': model_kwargs, 'step_count': design['steps']})
+    return specs
+
+
+def submit(queue, method='sobol', n=64, seeds=2, steps=2500, names=None, seed=0, **model_kwargs):
+    '''
+    Draws a design, saves it in the queue directory and submits its runs.
+
+    Parameters
+    ----------
+    queue : str
+        sweep queue directory
+    method : str
+        'sobol' (n base points, n * (d + 2) design points) or 'morris'
+        (n trajectories, n * (d + 1) design points)
+    seeds : int
+        runs per design point (seeds 0..seeds-1)
+    steps : int
+        step_count of every run
+    names : list of str, optional
+        parameters to vary (all of PARAM_BOUNDS by default); the others
+        keep their TRAUMA_PARAMS value
+    seed : int
+        seed of the design
+    **model_kwargs :
+        other SugarscapeTMF arguments of every run (e.g. engine='numba')
+
+    Returns
+    -------
+    n_new : int
+        number of runs that were not already queued or done
+
+    '''
+    names = list(names or PARAM_BOUNDS)
+    unknown = set(names) - set(TRAUMA_PARAMS)
+    if unknown:
+        raise ValueError('unknown trauma parameters: %s' % ', '.join(sorted(unknown)))
+    u, x = make_design(method, names, n, seed)
+    design = {'method': method, 'names': names, 'n': n, 'seeds': seeds, 'steps': steps,
+              'model_kwargs': model_kwargs, 'U': u.tolist(), 'X': x.tolist()}
+    work_queue = WorkQueue(queue)
+    with open(_design_path(queue, method), 'w') as f:
+        json.dump(design, f)
+    return work_queue.submit(design_specs(design))
+
+
+def design_outputs(queue, design):
+    '''
+    Outputs of every design point, averaged over its seeds.
+
+    Returns
+    -------
+    Y : dict of np.ndarray
+        one value per design point for every output in OUTPUTS
+    n_missing : int
+        number of runs without a result yet (Y is None if there are any)
+
+    '''
+    work_queue = WorkQueue(queue)
+    values = {name: [] for name in OUTPUTS}
+    n_missing = 0
+    for spec in design_specs(design):
+        path = work_queue.result_path(job_id(spec))
+        if not os.path.exists(path):
+            n_missing += 1
+            continue
+        with open(path) as f:
+            summary = json.load(f)['summary']
+        for name, output in OUTPUTS.items():
+            values[name].append(output(summary))
+    if n_missing:
+        return None, n_missing
+    return {name: np.array(vals).reshape(-1, design['seeds']).mean(axis=1)
+            for name, vals in values.items()}, 0
+
+
+def sobol_indices(y, d):
+    '''
+    First-order (Saltelli 2010) and total (Jansen) Sobol indices of every
+    parameter, from outputs of a saltelli_design. Any leading axes of y are
+    kept (used for bootstrap resamples).
+
+    Parameters
+    ----------
+    y : np.ndarray, shape (..., n * (d + 2))
+    d : int
+        number of parameters
+
+    Returns
+    -------
+    s1, st : np.ndarray, shape (..., d)
+
+    '''
+    n = y.shape[-1] // (d + 2)
+    f_a, f_b = y[..., :n], y[..., n:2 * n]
+    f_ab = y[..., 2 * n:].reshape(*y.shape[:-1], d, n)
+    var = np.var(np.concatenate([f_a, f_b], axis=-1), axis=-1)[..., None]
+    s1 = np.mean(f_b[..., None, :] * (f_ab - f_a[..., None, :]), axis=-1) / var
+    st = 0.5 * np.mean((f_a[..., None, :] - f_ab) ** 2, axis=-1) / var
+    return s1, st
+
+
+def elementary_effects(y, u, d):
+    '''
+    Elementary effects of every parameter along every Morris trajectory.
+
+    Returns
+    -------
+    ee : np.ndarray, shape (r, d)
+
+    '''
+    y = y.reshape(-1, d + 1)
+    u = u.reshape(-1, d + 1, d)
+    steps = np.diff(u, axis=1)
+    # the parameter each move changed, and by how much
+    moved = np.argmax(np.abs(steps), axis=2)
+    r = np.arange(len(y))[:, None]
+    delta = steps[r, np.arange(d)[None, :], moved]
+    ee = np.empty((len(y), d))
+    ee[r, moved] = np.diff(y, axis=1) / delta
+    return ee
+
+
+def analyze(queue, method='sobol', n_boot=1000, confidence=0.95, seed=0):
+    '''
+    Sensitivity indices of every output for the design saved in the queue
+    directory, with bootstrap confidence intervals (over base points for
+    Sobol indices, over trajectories for Morris).
+
+    Returns
+    -------
+    indices : dict
+        per output, per index name ('S1' and 'ST', or 'mu', 'mu_star' and
+        'sigma'), an array of shape (d, 3): estimate, lower and upper
+        confidence bound per parameter; plus 'names'
+
+    '''
+    with open(_design_path(queue, method)) as f:
+        design = json.load(f)
+    outputs, n_missing = design_outputs(queue, design)
+    if n_missing:
+        raise RuntimeError('%d runs of the design have no result yet' % n_missing)
+    d = len(design['names'])
+    rng = np.random.default_rng(seed)
+    q = [(1 - confidence) / 2 * 100, (1 + confidence) / 2 * 100]
+    indices = {'names': design['names']}
+    for name, y in outputs.items():
+        if method == 'sobol':
+            n = design['n']
+            s1, st = sobol_indices(y, d)
+            # resample base points, keeping each point's A, B and AB rows together
+            idx = rng.integers(0, n, (n_boot, n))
+            rows = np.concatenate([idx + k * n for k in range(d + 2)], axis=1)
+            b1, bt = sobol_indices(y[rows], d)
+            estimates = {'S1': (s1, b1), 'ST': (st, bt)}
+        else:
+            ee = elementary_effects(y, np.array(design['U']), d)
+            idx = rng.integers(0, len(ee), (n_boot, len(ee)))
+            boot = ee[idx]
+            estimates = {
+                'mu': (ee.mean(axis=0), boot.mean(axis=1)),
+                'mu_star': (np.abs(ee).mean(axis=0), np.abs(boot).mean(axis=1)),
+                'sigma': (ee.std(axis=0, ddof=1), boot.std(axis=1, ddof=1)),
+            }
+        indices[name] = {key: np.column_stack([est, *np.percentile(boot, q, axis=0)])
+                         for key, (est, boot) in estimates.items()}
+    return indices
+
+
+def format_indices(indices):
+    lines = []
+    names = indices['names']
+    for output, by_index in indices.items():
+        if output == 'names':
+            continue
+        lines.append(output)
+        keys = list(by_index)
+        lines.append('  %-30s' % 'parameter' + ''.join('%24s' % key for key in keys))
+        for i, name in enumerate(names):
+            cells = ['%8.3f [%6.3f, %6.3f]' % tuple(by_index[key][i]) for key in keys]
+            lines.append('  %-30s' % name + ''.join('%24s' % cell for cell in cells))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Sobol/Morris sensitivity analysis of the trauma parameters')
+    sub = parser.add_subparsers(dest='command', required=True)
+    for command, text in (('submit', 'draw a design and queue its runs'),
+                          ('analyze', 'compute indices from the finished runs'),
+                          ('run', 'submit, run the queue with local workers and analyze')):
+        p = sub.add_parser(command, help=text)
+        p.add_argument('queue')
+        p.add_argument('--method', choices=('sobol', 'morris'), default='sobol')
+        p.add_argument('--n-boot', type=int, default=1000, help='bootstrap resamples')
+        if command == 'analyze':
+            continue
+        p.add_argument('--n', type=int, default=64, help='Sobol base points or Morris trajectories')
+        p.add_argument('--seeds', type=int, default=2, help='runs per design point')
+        p.add_argument('--steps', type=int, default=2500)
+        p.add_argument('--param', action='append', default=None,
+                       help='parameter to vary (repeatable; all of PARAM_BOUNDS by default)')
+        p.add_argument('--engine', default='python')
+        p.add_argument('--processes', type=int, default=os.cpu_count())
+
+    args = parser.parse_args()
+    if args.command in ('submit', 'run'):
+        n_new = submit(args.queue, args.method, args.n, args.seeds, args.steps, args.param,
+                       engine=args.engine)
+        print('%d new runs submitted' % n_new)
+    if args.command == 'run':
+        work_processes(args.queue, args.processes, poll=1)
+    if args.command in ('analyze', 'run'):
+        print(format_indices(analyze(args.queue, args.method, args.n_boot)))
@@ -1,5 +1,3 @@
-import mesa
-
 from .agents import SsAgent, Sugar
 from .model import SugarscapeTMF
 
@@ -27,16 +25,39 @@ def SsAgent_portrayal(agent):
     return {}
 
 
-canvas_element = mesa.visualization.CanvasGrid(SsAgent_portrayal, 50, 50, 500, 500)
-chart_element = mesa.visualization.ChartModule(
-    [{"Label": "SsAgent", "Color": "#AA0000"}]
-)
-
-chart_element2 = mesa.visualization.ChartModule(
-    [{"Label": "Trauma", "Color": "#000000"}]
-)
-
-server = mesa.visualization.ModularServer(
-    SugarscapeTMF, [canvas_element, chart_element, chart_element2], "Basic Trauma Model Framework"
-)
-# server.launch()
+def build_server():
+    '''
+    Creates the mesa visualization elements and server. mesa (and with it
+    the tornado webserver) is only imported here, when the visualization is
+    actually used, and not by everything that imports this module.
+    '''
+    import mesa
+
+    canvas_element = mesa.visualization.CanvasGrid(SsAgent_portrayal, 50, 50, 500, 500)
+    chart_element = mesa.visualization.ChartModule(
+        [{"Label": "SsAgent", "Color": "#AA0000"}]
+    )
+
+    chart_element2 = mesa.visualization.ChartModule(
+        [{"Label": "Trauma", "Color": "#000000"}]
+    )
+
+    server = mesa.visualization.ModularServer(
+        SugarscapeTMF, [canvas_element, chart_element, chart_element2], "Basic Trauma Model Framework"
+    )
+    # server.launch()
+    return {
+        'canvas_element': canvas_element,
+        'chart_element': chart_element,
+        'chart_element2': chart_element2,
+        'server': server,
+    }
+
+
+def __getattr__(name):
+    # server, canvas_element, chart_element and chart_element2 are built on
+    # first access (e.g. "from trauma_model_framework.server import server")
+    if name in ('canvas_element', 'chart_element', 'chart_element2', 'server'):
+        globals().update(build_server())
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
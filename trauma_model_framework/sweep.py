@@ -0,0 +1,487 @@
+"""
+Parameter sweeps over a shared-directory work queue
+================================
+
+Runs of SugarscapeTMF (parameter combinations x seeds) are written as
+small JSON run specs into a queue directory that every machine of the
+sweep can see (e.g. an NFS share). Any number of worker processes on any
+number of hosts pull jobs from it, run the model headless and write one
+result file per job. Nothing else is needed: no database or server.
+
+Queue directory layout:
+
+    pending/<job>.json            run specs waiting for a worker
+    claimed/<job>.<worker>.json   run specs being run; the file's mtime is
+                                  the worker's lease and is refreshed while
+                                  the run goes on
+    results/<job>.json            run summaries
+    failed/<job>.json             run specs whose run raised, with the error
+    .clock                        touched to read the file server's clock
+
+A worker claims a job by renaming its spec from pending/ to claimed/, which
+only one worker can do. Leases that are not refreshed for longer than the
+lease time (the worker died or lost its host) are given back by renaming
+the spec to pending/ again. Lease ages are measured against the mtime of a
+freshly touched file in the queue directory, not the local clock, since
+the mtimes are set by the file server and the hosts' clocks may differ. Job ids are hashes of the run specs, so
+submitting the same spec twice does nothing, and results are written to
+a temporary file and renamed into place, so a job run twice (e.g. by a
+worker whose lease was taken over) still leaves one complete result.
+
+    python -m trauma_model_framework.sweep submit QUEUE --seeds 10 --param initial_population=50,100
+    python -m trauma_model_framework.sweep work QUEUE --processes 4
+    python -m trauma_model_framework.sweep status QUEUE
+"""
+
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+
+from .landscape import Landscape
+from .model import SugarscapeTMF
+
+STATES = ('pending', 'claimed', 'results', 'failed')
+
+
+def make_specs(params=None, seeds=10, step_count=2500):
+    '''
+    Run specs for every combination of the given model parameters and seeds.
+
+    Parameters
+    ----------
+    params : dict of lists, optional
+        SugarscapeTMF keyword arguments and the values to sweep over
+    seeds : int or list of int
+        seeds to run every combination with (range(seeds) if an int)
+    step_count : int
+        step_count given to run_model
+
+    Returns
+    -------
+    specs : list of dict
+
+    '''
+    params = params or {}
+    if isinstance(seeds, int):
+        seeds = range(seeds)
+    names = sorted(params)
+    specs = []
+    for values in itertools.product(*(params[name] for name in names)):
+        for seed in seeds:
+            model_kwargs = dict(zip(names, values), seed=seed)
+            specs.append({'model_kwargs': model_kwargs, 'step_count': step_count})
+    return specs
+
+
+def job_id(spec):
+    '''
+    Id of a run spec: a hash of its canonical JSON form.
+    '''
+    text = json.dumps(spec, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def run_spec(spec, landscape=None):
+    '''
+    Runs the model of a run spec headless and summarizes the run.
+
+    Parameters
+    ----------
+    spec : dict
+        run spec (see make_specs)
+    landscape : Landscape or str, optional
+        landscape (or name of a published landscape) to run the model on
+
+    Returns
+    -------
+    summary : dict
+        number of steps, trauma event markers, famines, runtime and every
+        model reporter's time series
+
+    '''
+    t = time.perf_counter()
+    m = SugarscapeTMF(landscape=landscape, **spec['model_kwargs'])
+    m.run_model(step_count=spec['step_count'])
+    return {
+        'steps': m.schedule.steps,
+        'te_start': m.te_start,
+        'te_end': m.te_end,
+        't_recovery': m.t_recovery,
+        'trauma_recovery': m.trauma_recovery,
+        'avg_baseline_trauma': float(m.avg_baseline_trauma),
+        'famines': [[start, end, region] for start, end, region in m.famines],
+        'runtime': time.perf_counter() - t,
+        'model_vars': {name: list(vals) for name, vals in m.datacollector.model_vars.items()},
+    }
+
+
+def _write_json(path, data):
+    # write to a temporary file and rename it into place so readers never
+    # see half a file and a second writer just replaces it
+    tmp = '%s.%s.%d.tmp' % (path, socket.gethostname(), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+class WorkQueue:
+    '''
+    Shared-directory work queue of run specs (see the module docstring for
+    the layout).
+
+    Parameters
+    ----------
+    path : str
+        queue directory (created if needed)
+    lease : float
+        seconds a claim stays valid without being refreshed
+    '''
+
+    def __init__(self, path, lease=600):
+        self.path = path
+        self.lease = lease
+        for state in STATES:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def _dir(self, state):
+        return os.path.join(self.path, state)
+
+    def _now(self):
+        # current time on the clock that sets the mtimes of the queue files
+        clock = os.path.join(self.path, '.clock')
+        with open(clock, 'a'):
+            pass
+        os.utime(clock)
+        return os.path.getmtime(clock)
+
+    def _jobs(self, state):
+        # job ids in a state directory (claimed names also carry the worker)
+        return [name.split('.', 1)[0] for name in os.listdir(self._dir(state))
+                if name.endswith('.json')]
+
+    def submit(self, specs):
+        '''
+        Adds run specs to the queue, skipping any that are already queued,
+        running, done or failed.
+
+        Returns
+        -------
+        n_new : int
+            number of jobs added
+
+        '''
+        known = set()
+        for state in STATES:
+            known.update(self._jobs(state))
+        n_new = 0
+        for spec in specs:
+            job = job_id(spec)
+            if job in known:
+                continue
+            known.add(job)
+            _write_json(os.path.join(self._dir('pending'), job + '.json'), spec)
+            n_new += 1
+        return n_new
+
+    def claim(self, worker):
+        '''
+        Claims one pending job for worker.
+
+        Returns
+        -------
+        job : (str, str, dict) or None
+            job id, path of the claimed spec (the lease) and the run spec;
+            None if nothing is pending
+
+        '''
+        for name in sorted(os.listdir(self._dir('pending'))):
+            if not name.endswith('.json'):
+                continue
+            job = name[:-len('.json')]
+            pending = os.path.join(self._dir('pending'), name)
+            lease = os.path.join(self._dir('claimed'), '%s.%s.json' % (job, worker))
+            try:
+                # the lease starts now, not when the spec was submitted
+                os.utime(pending)
+                os.rename(pending, lease)
+            except FileNotFoundError:
+                # another worker got it first
+                continue
+            if os.path.exists(self.result_path(job)):
+                # finished by a worker whose lease had been taken over
+                os.remove(lease)
+                continue
+            with open(lease) as f:
+                return job, lease, json.load(f)
+        return None
+
+    def result_path(self, job):
+        return os.path.join(self._dir('results'), job + '.json')
+
+    def complete(self, job, lease, spec, summary):
+        '''
+        Stores the result of a job and releases its lease.
+        '''
+        _write_json(self.result_path(job), {'job': job, 'spec': spec, 'summary': summary})
+        self._release(lease)
+
+    def fail(self, job, lease, spec, error):
+        '''
+        Moves a job whose run raised to failed/ with the error message.
+        '''
+        _write_json(os.path.join(self._dir('failed'), job + '.json'), dict(spec, error=error))
+        self._release(lease)
+
+    def _release(self, lease):
+        try:
+            os.remove(lease)
+        except FileNotFoundError:
+            # the lease went stale and the job was given back meanwhile
+            pass
+
+    def leases(self):
+        '''
+        Running jobs.
+
+        Returns
+        -------
+        leases : list of (str, str, float)
+            job id, worker and seconds since the lease was last refreshed
+
+        '''
+        now = self._now()
+        leases = []
+        for name in os.listdir(self._dir('claimed')):
+            if not name.endswith('.json'):
+                continue
+            try:
+                age = now - os.path.getmtime(os.path.join(self._dir('claimed'), name))
+            except FileNotFoundError:
+                continue
+            job, worker = name[:-len('.json')].split('.', 1)
+            leases.append((job, worker, age))
+        return leases
+
+    def recover_stale(self):
+        '''
+        Gives jobs whose lease has not been refreshed for longer than the
+        lease time back to pending/.
+
+        Returns
+        -------
+        n_recovered : int
+
+        '''
+        n_recovered = 0
+        for job, worker, age in self.leases():
+            if age <= self.lease:
+                continue
+            lease = os.path.join(self._dir('claimed'), '%s.%s.json' % (job, worker))
+            try:
+                if os.path.exists(self.result_path(job)):
+                    os.remove(lease)
+                else:
+                    os.rename(lease, os.path.join(self._dir('pending'), job + '.json'))
+                    n_recovered += 1
+            except FileNotFoundError:
+                # finished or recovered by someone else meanwhile
+                pass
+        return n_recovered
+
+    def requeue_failed(self):
+        '''
+        Moves failed jobs back to pending/ (without their error message).
+
+        Returns
+        -------
+        n_requeued : int
+
+        '''
+        n_requeued = 0
+        for job in self._jobs('failed'):
+            path = os.path.join(self._dir('failed'), job + '.json')
+            with open(path) as f:
+                spec = json.load(f)
+            spec.pop('error', None)
+            _write_json(os.path.join(self._dir('pending'), job + '.json'), spec)
+            os.remove(path)
+            n_requeued += 1
+        return n_requeued
+
+    def counts(self):
+        return {state: len(self._jobs(state)) for state in STATES}
+
+    def results(self):
+        '''
+        All finished runs as a list of {'job', 'spec', 'summary'} dicts.
+        '''
+        out = []
+        for job in sorted(self._jobs('results')):
+            with open(self.result_path(job)) as f:
+                out.append(json.load(f))
+        return out
+
+    def status(self):
+        '''
+        Human readable progress report.
+        '''
+        counts = self.counts()
+        total = sum(counts.values())
+        leases = self.leases()
+        n_stale = sum(age > self.lease for _, _, age in leases)
+        lines = ['%d jobs: %d pending, %d running (%d stale), %d done, %d failed' % (
+            total, counts['pending'], counts['claimed'], n_stale, counts['results'], counts['failed'])]
+        runtimes = []
+        for result in self.results():
+            runtimes.append(result['summary']['runtime'])
+        if runtimes and leases:
+            mean = sum(runtimes) / len(runtimes)
+            remaining = counts['pending'] + counts['claimed']
+            lines.append('mean runtime %.1f s, about %.0f s left at %d workers' % (
+                mean, mean * remaining / len(leases), len(leases)))
+        for job, worker, age in sorted(leases, key=lambda lease: lease[1]):
+            lines.append('  %s on %s, lease refreshed %.0f s ago%s' % (
+                job, worker, age, ' (stale)' if age > self.lease else ''))
+        return '\n'.join(lines)
+
+
+def _heartbeat(lease, interval, done):
+    # refresh the lease until the run is over
+    while not done.wait(interval):
+        try:
+            os.utime(lease)
+        except FileNotFoundError:
+            # taken over as stale; the run still finishes and its result is
+            # written, which is harmless since results are idempotent
+            return
+
+
+def work(path, lease=600, max_jobs=None, poll=10, worker=None, landscape=None):
+    '''
+    Worker loop: claims and runs jobs until the queue is drained (nothing
+    pending and nothing running anywhere, so stale jobs of dead workers are
+    picked up too) or max_jobs have been run. Every job is run on landscape
+    (see run_spec).
+
+    Returns
+    -------
+    n_done : int
+        number of jobs this worker ran
+
+    '''
+    queue = WorkQueue(path, lease)
+    if worker is None:
+        worker = '%s-%d' % (socket.gethostname().replace('.', '_'), os.getpid())
+    n_done = 0
+    while max_jobs is None or n_done < max_jobs:
+        claimed = queue.claim(worker)
+        if claimed is None:
+            if queue.recover_stale():
+                continue
+            if not queue.leases():
+                break
+            # other workers are still running jobs that may go stale
+            time.sleep(poll)
+            continue
+        job, lease_path, spec = claimed
+        done = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(lease_path, lease / 4, done), daemon=True)
+        beat.start()
+        try:
+            summary = run_spec(spec, landscape)
+        except Exception:
+            queue.fail(job, lease_path, spec, traceback.format_exc())
+        else:
+            summary['worker'] = worker
+            queue.complete(job, lease_path, spec, summary)
+        finally:
+            done.set()
+            beat.join()
+        n_done += 1
+    return n_done
+
+
+def work_processes(path, processes, landscape=None, **kwargs):
+    '''
+    Runs several local worker processes on the queue and waits for them.
+    The landscape (sugar-map.txt by default) is published to shared memory
+    once, and every worker runs its jobs on that single copy.
+    '''
+    if landscape is None:
+        landscape = Landscape.default()
+    with landscape.publish() as shared:
+        kwargs['landscape'] = shared.name
+        with multiprocessing.Pool(processes) as pool:
+            return sum(pool.starmap(_work, [(path, kwargs)] * processes))
+
+
+def _work(path, kwargs):
+    return work(path, **kwargs)
+
+
+def _parse_param(text):
+    # "name=v1,v2,..." with JSON values (plain strings are kept as strings)
+    name, values = text.split('=', 1)
+    parsed = []
+    for value in values.split(','):
+        try:
+            parsed.append(json.loads(value))
+        except ValueError:
+            parsed.append(value)
+    return name, parsed
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='SugarscapeTMF sweeps over a shared-directory work queue')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('submit', help='add runs (parameter grid x seeds) to the queue')
+    p.add_argument('queue')
+    p.add_argument('--param', action='append', default=[], type=_parse_param,
+                   help='model parameter and values to sweep over, e.g. initial_population=50,100')
+    p.add_argument('--seeds', type=int, default=10, help='run every combination with seeds 0..SEEDS-1')
+    p.add_argument('--steps', type=int, default=2500, help='step_count of every run')
+
+    p = sub.add_parser('work', help='run jobs until the queue is drained')
+    p.add_argument('queue')
+    p.add_argument('--processes', type=int, default=1, help='number of local worker processes')
+    p.add_argument('--lease', type=float, default=600, help='seconds before a silent worker\'s job is given back')
+    p.add_argument('--max-jobs', type=int, default=None, help='stop each worker after this many jobs')
+    p.add_argument('--poll', type=float, default=10, help='seconds between checks while others finish')
+
+    p = sub.add_parser('status', help='show progress')
+    p.add_argument('queue')
+    p.add_argument('--lease', type=float, default=600)
+
+    p = sub.add_parser('recover', help='give stale jobs back to pending now')
+    p.add_argument('queue')
+    p.add_argument('--lease', type=float, default=600)
+    p.add_argument('--failed', action='store_true', help='also requeue failed jobs')
+
+    args = parser.parse_args()
+    if args.command == 'submit':
+        specs = make_specs(dict(args.param), args.seeds, args.steps)
+        n_new = WorkQueue(args.queue).submit(specs)
+        print('%d runs submitted, %d already known' % (n_new, len(specs) - n_new))
+    elif args.command == 'work':
+        kwargs = dict(lease=args.lease, max_jobs=args.max_jobs, poll=args.poll)
+        if args.processes > 1:
+            n_done = work_processes(args.queue, args.processes, **kwargs)
+        else:
+            n_done = work(args.queue, **kwargs)
+        print('%d runs done' % n_done)
+    elif args.command == 'status':
+        print(WorkQueue(args.queue, args.lease).status())
+    elif args.command == 'recover':
+        queue = WorkQueue(args.queue, args.lease)
+        print('%d stale jobs given back' % queue.recover_stale())
+        if args.failed:
+            print('%d failed jobs requeued' % queue.requeue_failed())